@@ -0,0 +1,81 @@
+"""
+Regression benchmark for nested entity list responses (`?nested=true`):
+building the nested entities per entity vs. once per response
+
+    python -m benchmarks.nested [limit]
+"""
+
+import sys
+import timeit
+
+from fastapi import Request
+from followthemoney.types import registry
+from ftmq.types import CE
+from ftmq.util import make_proxy
+
+from ftmq_api.serialize import EntitiesResponse, EntityResponse
+from ftmq_api.warmup import make_scope
+
+LIMIT = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+ROUNDS = 10
+
+
+def make_memberships(n: int) -> tuple[list[CE], list[CE]]:
+    """
+    `n` memberships of `n` persons in `n / 10` organizations
+    """
+    entities, adjacents = [], []
+    for i in range(n // 10 or 1):
+        data = {"id": f"o-{i}", "schema": "Organization", "properties": {"name": [i]}}
+        adjacents.append(make_proxy(data, "bench"))
+    for i in range(n):
+        data = {"id": f"p-{i}", "schema": "Person", "properties": {"name": [i]}}
+        adjacents.append(make_proxy(data, "bench"))
+        data = {
+            "id": f"m-{i}",
+            "schema": "Membership",
+            "properties": {"member": [f"p-{i}"], "organization": [f"o-{i // 10}"]},
+        }
+        entities.append(make_proxy(data, "bench"))
+    return entities, adjacents
+
+
+def per_entity(entity, adjacents) -> EntityResponse:
+    # previous implementation: the nested entities are built for every entity
+    properties = dict(entity.properties)
+    index = {e.id: EntityResponse.from_entity(e) for e in adjacents}
+    for prop in entity.iterprops():
+        if prop.type == registry.entity:
+            properties[prop.name] = [index.get(i, i) for i in entity.get(prop)]
+    return EntityResponse.model_construct(
+        id=entity.id,
+        caption=entity.caption,
+        schema_=entity.schema.name,
+        properties=properties,
+        datasets=list(entity.datasets),
+        referents=list(entity.referents),
+    )
+
+
+def main():
+    entities, adjacents = make_memberships(LIMIT)
+    request = Request(make_scope("/entities?schema=Membership&nested=true"))
+
+    def before() -> list[EntityResponse]:
+        return [per_entity(e, adjacents) for e in entities]
+
+    def after() -> list[EntityResponse]:
+        response = EntitiesResponse.from_view(
+            request=request, entities=entities, adjacents=[adjacents]
+        )
+        return response.entities
+
+    assert [e.model_dump() for e in before()] == [e.model_dump() for e in after()]
+    print(f"{len(entities)} entities, {len(adjacents)} adjacents, {ROUNDS} rounds")
+    for func in (before, after):
+        seconds = min(timeit.repeat(func, number=1, repeat=ROUNDS))
+        print(f"{func.__name__:>8}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
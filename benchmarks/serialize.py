@@ -0,0 +1,79 @@
+"""
+Benchmark entity list serialization: validated response models + FastAPI
+response model serialization vs. unvalidated models rendered via their
+serializer (`ModelResponse`)
+
+    FTMQ_API_CATALOG=./tests/fixtures/catalog.json python -m benchmarks.serialize [limit]
+"""
+
+import asyncio
+import sys
+import timeit
+
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from followthemoney.types import registry
+from starlette.responses import JSONResponse
+
+from ftmq_api.query import Query, RetrieveParams
+from ftmq_api.serialize import EntitiesResponse, EntityResponse, ModelResponse
+from ftmq_api.store import get_view
+
+LIMIT = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+ROUNDS = 10
+
+
+def validated_entity(entity, adjacents=None) -> EntityResponse:
+    # previous implementation
+    properties = dict(entity.properties)
+    if adjacents:
+        adjacents = {e.id: validated_entity(e) for e in adjacents}
+        for prop in entity.iterprops():
+            if prop.type == registry.entity:
+                properties[prop.name] = [adjacents.get(i, i) for i in entity.get(prop)]
+    return EntityResponse(
+        id=entity.id,
+        caption=entity.caption,
+        schema=entity.schema.name,
+        properties=properties,
+        datasets=list(entity.datasets),
+        referents=list(entity.referents),
+    )
+
+
+def main():
+    view = get_view()
+    query = Query()[:LIMIT]
+    entities = list(view.get_entities(query, RetrieveParams(nested=True)))
+    adjacents = view.get_adjacents(entities)
+    field = create_model_field("Response", EntitiesResponse, mode="serialization")
+    base = dict(total=len(entities), items=len(entities), stats=None, url="")
+
+    def before() -> bytes:
+        response = EntitiesResponse(
+            query={},
+            entities=[validated_entity(e, adjacents) for e in entities],
+            **base,
+        )
+        content = asyncio.run(
+            serialize_response(field=field, response_content=response)
+        )
+        return JSONResponse(content).body
+
+    def after() -> bytes:
+        response = EntitiesResponse(
+            query={},
+            entities=[EntityResponse.from_entity(e, adjacents) for e in entities],
+            **base,
+        )
+        return ModelResponse(response).body
+
+    assert before() == after()
+    print(f"{len(entities)} entities, {len(adjacents)} adjacents, {ROUNDS} rounds")
+    for func in (before, after):
+        seconds = min(timeit.repeat(func, number=1, repeat=ROUNDS))
+        print(f"{func.__name__:>8}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
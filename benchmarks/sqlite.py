@@ -0,0 +1,69 @@
+"""
+Benchmark read-heavy traffic on a sqlite store: default connections (as
+`ftmq.store.get_store`) vs. the read-only mode (`mode=ro`, `immutable`,
+`mmap_size`, `cache_size`, `temp_store`, pool sized to the executor).
+Queries are run concurrently in a thread pool of `settings.executor.workers`.
+
+    FTMQ_API_CATALOG=./tests/fixtures/catalog.json python -m benchmarks.sqlite [requests]
+"""
+
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ftmq.store import get_store
+from ftmq.store.sql import SQLStore
+
+from ftmq_api.query import Query, RetrieveParams
+from ftmq_api.settings import Settings
+from ftmq_api.store import View, get_readonly_store
+
+settings = Settings()
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+ROUNDS = 3
+PARAMS = RetrieveParams()
+
+
+def get_queries(view: View) -> list[Query]:
+    """
+    First pages, deep pages, a sorted page and a property filter per dataset
+    (small pages, so that the store and not the entity assembly dominates)
+    """
+    queries = []
+    for dataset in sorted(view.query.dataset_names):
+        q = Query().where(dataset=dataset)
+        queries.extend([q[:20], q[100:120], q.order_by("name")[:20]])
+        queries.append(Query().where(dataset=dataset, name__ilike="a")[:20])
+    return queries
+
+
+def run(view: View, queries: list[Query], pool: ThreadPoolExecutor) -> float:
+    def request(i: int) -> int:
+        query = queries[i % len(queries)]
+        return len([e for e in view.get_entities(query, PARAMS)]) + view.count(query)
+
+    start = time.perf_counter()
+    list(pool.map(request, range(REQUESTS)))
+    return time.perf_counter() - start
+
+
+def main():
+    default = get_store(uri=settings.store_uri)
+    readonly = get_readonly_store(settings.store_uri)
+    assert isinstance(default, SQLStore), "Benchmark requires a sqlite store"
+    views = {"default": View(store=default), "readonly": View(store=readonly)}
+    queries = get_queries(views["default"])
+    workers = settings.executor.workers
+    print(f"{REQUESTS} requests, {len(queries)} queries, {workers} threads")
+    with ThreadPoolExecutor(workers) as pool:
+        for name, view in views.items():
+            run(view, queries, pool)  # warm up connections and page cache
+            seconds = min(run(view, queries, pool) for _ in range(ROUNDS))
+            print(
+                f"{name:>8}: {seconds * 1000:.1f} ms ({REQUESTS / seconds:.0f} req/s)"
+            )
+
+
+if __name__ == "__main__":
+    main()
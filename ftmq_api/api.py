@@ -1,27 +1,47 @@
-import secrets
+import inspect
+from collections.abc import Callable, Iterator
+from typing import Any
 
 from anystore.io import smart_read
-from fastapi import Depends, FastAPI, Query, Request
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import Response, StreamingResponse
 from ftmq.model import Catalog, Dataset
 
-from ftmq_api import __version__, views
+from ftmq_api import __version__, arrow, async_views, views
+from ftmq_api.compression import CompressionMiddleware
+from ftmq_api.executor import dispatch, dispatch_iter
 from ftmq_api.logging import get_logger
-from ftmq_api.query import QueryParams, SearchQueryParams
+from ftmq_api.metrics import METRICS_PATH, MetricsMiddleware, render
+from ftmq_api.profile import ProfileMiddleware
+from ftmq_api.query import (
+    EntitiesQueryParams,
+    Formats,
+    QueryParams,
+    SearchQueryParams,
+    is_authenticated,
+)
 from ftmq_api.serialize import (
     AggregationResponse,
     AutocompleteResponse,
+    CachedResponse,
+    EntitiesBatchResponse,
     EntitiesResponse,
     EntityResponse,
     ErrorResponse,
+    to_response,
 )
 from ftmq_api.settings import DEFAULT_DESCRIPTION, Settings
+from ftmq_api.stats import get_stats
 from ftmq_api.store import Datasets
 
 log = get_logger(__name__)
 settings = Settings()
 
+# `ETag` / `304` handling for the cached json routes (not for streams, the
+# batch endpoint or `/metrics`)
+CONDITIONAL = [Depends(views.get_conditional)]
+
 
 def get_description() -> str:
     if settings.info.description_uri:
@@ -37,45 +57,65 @@ app = FastAPI(
     redoc_url="/",
     version=__version__,
 )
+app.add_middleware(ProfileMiddleware)
+app.add_middleware(CompressionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[*settings.allowed_origin, "http://localhost:3000"],
     allow_methods=["OPTIONS", "GET"],
+    expose_headers=["ETag", "Last-Modified"],
 )
+app.add_middleware(MetricsMiddleware)
 
 log.info("Ftm store: %s" % settings.store_uri)
 
+# load dataset statistics snapshot at boot time (computed by the first worker
+# if missing, better precompute it via `ftmq-api stats`)
+get_stats().init()
+
+
+@app.get(METRICS_PATH, include_in_schema=False)
+async def metrics() -> Response:
+    """
+    Prometheus metrics (if `settings.metrics.enabled`), see
+    [`ftmq_api.metrics`][ftmq_api.metrics]
+    """
+    data, content_type = render()
+    return Response(data, media_type=content_type)
+
 
 @app.get(
     "/catalog",
+    dependencies=CONDITIONAL,
     response_model=Catalog,
     responses={
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
-async def dataset_list(request: Request) -> Catalog:
+async def dataset_list(request: Request) -> Response:
     """
     Show metadata for catalog (as described in
     [nomenklatura.DataCatalog](https://github.com/opensanctions/nomenklatura))
 
     This is basically a list of the available dataset within this api instance.
     """
-    return views.dataset_list(request)
+    return await respond("catalog", request, views.dataset_list)
 
 
 @app.get(
     "/catalog/{dataset}",
+    dependencies=CONDITIONAL,
     response_model=Dataset,
     responses={
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
-async def dataset_detail(request: Request, dataset: Datasets) -> Dataset:
+async def dataset_detail(request: Request, dataset: Datasets) -> Response:
     """
     Show metadata for given dataset (as described in
     [nomenklatura.Dataset](https://github.com/opensanctions/nomenklatura))
     """
-    return views.dataset_detail(request, dataset)
+    return await respond("catalog", request, views.dataset_detail, dataset)
 
 
 def get_authenticated(
@@ -84,24 +124,91 @@ def get_authenticated(
         description="Secret api key to increase limit (useful for e.g. static site builders)",
     )
 ) -> bool:
-    if not api_key:
-        return False
-    return secrets.compare_digest(api_key, settings.build_api_key)
+    return is_authenticated(api_key)
+
+
+async def respond(
+    endpoint: str, request: Request, view: Callable[..., Any], *args, **kwargs
+) -> Response:
+    """
+    Run the view function in the executor (or await it, for the coroutine
+    views of `ftmq_api.async_views`) and render its result directly (the
+    `response_model` of the route is still used for the OpenAPI schema), or
+    serve it from the response cache if `settings.cache_responses`
+    """
+    cache_responses = settings.use_cache and settings.cache_responses
+    if inspect.iscoroutinefunction(view):
+        if cache_responses:
+            data = await async_views.cached_response(request, view, *args, **kwargs)
+        else:
+            result = await view(request, *args, **kwargs)
+    elif cache_responses:
+        data = await dispatch(
+            endpoint, views.cached_response, request, view, *args, **kwargs
+        )
+    else:
+        result = await dispatch(endpoint, view, request, *args, **kwargs)
+    if cache_responses:
+        response = CachedResponse.load(data).to_response(
+            request.headers.get("accept-encoding")
+        )
+    else:
+        response = to_response(result)
+    # returned responses don't get the headers set by dependencies
+    response.headers.update(getattr(request.state, "headers", {}))
+    return response
+
+
+MEDIA_TYPES = {
+    Formats.ndjson: "application/x-ndjson",
+    Formats.arrow: "application/vnd.apache.arrow.stream",
+    Formats.parquet: "application/vnd.apache.parquet",
+}
+STREAM_RESPONSES: dict[str, dict[str, Any]] = {
+    media_type: {} for media_type in MEDIA_TYPES.values()
+}
+
+
+def stream_response(
+    stream: Iterator[bytes], format: Formats | None = Formats.ndjson
+) -> StreamingResponse:
+    format = format or Formats.ndjson
+    if format in (Formats.arrow, Formats.parquet):
+        arrow.ensure_available(format)
+    return StreamingResponse(
+        dispatch_iter("stream", stream), media_type=MEDIA_TYPES[format]
+    )
+
+
+def stream_entities(
+    request: Request,
+    retrieve_params: views.RetrieveParams,
+    authenticated: bool,
+    format: Formats | None = Formats.ndjson,
+) -> StreamingResponse:
+    return stream_response(
+        views.entity_stream(
+            request, retrieve_params, authenticated=authenticated, format=format
+        ),
+        format,
+    )
 
 
 @app.get(
     "/entities",
+    dependencies=CONDITIONAL,
     response_model=EntitiesResponse,
     responses={
+        200: {"content": STREAM_RESPONSES},
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
 async def entities(
     request: Request,
-    params: QueryParams = Depends(QueryParams),
+    params: EntitiesQueryParams = Depends(EntitiesQueryParams),
     retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
     authenticated: bool = Depends(get_authenticated),
-) -> EntitiesResponse:
+) -> Response:
     """
     Retrieve a paginated list of entities for the given dataset based on filter
     criteria.
@@ -149,16 +256,113 @@ async def entities(
     array is used as the sorting value. (The entity property dict remains
     uncasted, aka all properties are multi values as string)
 
+    ## pagination
+
+    `next_url` in the response uses a keyset `cursor` that continues after the
+    last entity of the current page, so deep pages are as fast as the first
+    one. Paginating via `?page={n}` still works (and then `next_url` and
+    `prev_url` use page numbers as well).
+
     ## searching
 
     Use optional `q` parameter for a search term. This does a simple name matching
     search, use the `/search` endpoint for actual fulltext search via `ftmq-search`
+
+    ## streaming
+
+    `?format=ndjson` streams the matching entities as newline delimited json
+    instead, see `/entities/stream`
+
+    ## bulk formats
+
+    `?format=arrow` (Arrow IPC stream) or `?format=parquet` stream the
+    matching entities (same pagination as for ndjson) as a statement table
+    (one row per property value, as `nomenklatura` statements), e.g. to load
+    them straight into a data frame.
+
+    ## explain
+
+    `?explain=1` (only with `api_key`) returns the generated sql, the query
+    plan of the backend and the timings per stage instead of the entities.
+    """
+    if params.explain:
+        if not authenticated:
+            raise HTTPException(403, ["`explain` requires a valid `api_key`"])
+        return to_response(
+            await dispatch("explain", views.entity_explain, request, retrieve_params)
+        )
+    if params.format != Formats.json:
+        return stream_entities(request, retrieve_params, authenticated, params.format)
+    return await respond(
+        "entities",
+        request,
+        async_views.entity_list if settings.async_store else views.entity_list,
+        retrieve_params,
+        authenticated=authenticated,
+    )
+
+
+@app.get(
+    "/entities/stream",
+    response_class=StreamingResponse,
+    responses={
+        200: {
+            "content": {"application/x-ndjson": {}},
+            "description": "One entity per line",
+        },
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def entities_stream(
+    request: Request,
+    params: QueryParams = Depends(QueryParams),
+    retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
+    authenticated: bool = Depends(get_authenticated),
+) -> StreamingResponse:
+    """
+    Stream entities for the given filter criteria (same as the `/entities`
+    endpoint) as newline delimited json, one entity per line.
+
+    Entities are fetched and serialized chunk by chunk, so exports of large
+    result sets run in constant memory. Requests with a valid `api_key` are
+    not paginated (unless `limit` is given), otherwise the public limit
+    applies.
     """
-    return views.entity_list(request, retrieve_params, authenticated=authenticated)
+    return stream_entities(request, retrieve_params, authenticated)
+
+
+@app.get(
+    "/entities/batch",
+    response_model=EntitiesBatchResponse,
+    responses={
+        400: {"model": ErrorResponse, "description": "Too many ids"},
+        500: {"model": ErrorResponse, "description": "Server error"},
+    },
+)
+async def entities_batch(
+    request: Request,
+    id: list[str] = Query(..., description="One or more entity ids"),
+    retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
+) -> Response:
+    """
+    Retrieve multiple entities by their ids at once (up to
+    `settings.batch_limit`):
+
+    `/entities/batch?id=my-id&id=another-id`
+
+    Optionally inline (nest) adjacent entities (same as the entity detail
+    endpoint).
+
+    Instead of redirects, merged entities are returned with their new id and
+    the requested id is mapped to it in `merged`. Unknown ids are listed in
+    `missing`.
+    """
+    return await respond("entity", request, views.entity_batch, id, retrieve_params)
 
 
 @app.get(
     "/entities/{entity_id}",
+    dependencies=CONDITIONAL,
     response_model=EntityResponse,
     responses={
         307: {"description": "The entity was merged into another ID"},
@@ -170,11 +374,15 @@ async def detail_entity(
     request: Request,
     entity_id: str,
     retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
-) -> EntityResponse | RedirectResponse | ErrorResponse:
+) -> Response:
     """
     Retrieve a single entity within the given dataset.
 
-    Optionally inline (nest) adjacent entities.
+    Optionally inline (nest) adjacent entities, including the entities
+    referencing this one (as reverse properties, e.g. `membershipMember`).
+    `?nested=true&depth=2` inlines their adjacent entities as well (e.g.
+    Person → Membership → Organization), each level is fetched with one
+    batched lookup and capped at `settings.nested_limit` entities.
 
     If the requested entity was merged into another entity, a redirect to the
     new api endpoint is returned with additional headers to allow client side
@@ -183,11 +391,13 @@ async def detail_entity(
         `x-entity-id` - the new entity id
         `x-entity-schema` - the new entity schema
     """
-    return views.entity_detail(request, entity_id, retrieve_params)
+    view = async_views.entity_detail if settings.async_store else views.entity_detail
+    return await respond("entity", request, view, entity_id, retrieve_params)
 
 
 @app.get(
     "/aggregate",
+    dependencies=CONDITIONAL,
     response_model=AggregationResponse,
     responses={
         500: {"model": ErrorResponse, "description": "Server error"},
@@ -198,7 +408,7 @@ async def aggregation(
     params: QueryParams = Depends(QueryParams),
     aggregation_params: views.AggregationParams = Depends(views.get_aggregation_params),
     authenticated: bool = Depends(get_authenticated),
-) -> AggregationResponse:
+) -> Response:
     """
     Aggregate property values for given filter criteria (same as entities
     endpoint + search term)
@@ -211,47 +421,64 @@ async def aggregation(
 
         ?aggMax=amount&aggMax=date
     """
-    return views.aggregation(request)
+    view = async_views.aggregation if settings.async_store else views.aggregation
+    return await respond("aggregate", request, view)
 
 
 @app.get(
     "/search",
+    dependencies=CONDITIONAL,
     response_model=EntitiesResponse,
     responses={
+        200: {"content": STREAM_RESPONSES},
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
 async def search(
     request: Request,
     params: SearchQueryParams = Depends(SearchQueryParams),
+    format: Formats = Query(
+        Formats.json,
+        description="Response format: `ndjson`, `arrow` (IPC stream) and `parquet` "
+        "stream the search results",
+    ),
     authenticated: bool = Depends(get_authenticated),
-) -> EntitiesResponse:
+) -> Response:
     """
     Search entities via `ftmq-search` and optionally filter by `dataset`,
     `schema`, `country`
 
     Returned entities are "dehydrated" and only contain properties defined
     during indexing.
+
+    `?format=ndjson|arrow|parquet` streams the results of the current page
+    instead (see the `/entities` endpoint).
     """
-    return views.search(request, authenticated=authenticated)
+    if format != Formats.json:
+        return stream_response(
+            views.search_stream(request, authenticated, format), format
+        )
+    return await respond("search", request, views.search, authenticated=authenticated)
 
 
 @app.get(
     "/autocomplete",
+    dependencies=CONDITIONAL,
     response_model=AutocompleteResponse,
     responses={
         500: {"model": ErrorResponse, "description": "Server error"},
     },
 )
-async def autocomplete(request: Request, q: str) -> AutocompleteResponse:
+async def autocomplete(request: Request, q: str) -> Response:
     """
     Simple autocomplete by names
     """
-    return views.autocomplete(request, q)
+    return await respond("autocomplete", request, views.autocomplete, q)
 
 
 @app.get(
     "/similar",
+    dependencies=CONDITIONAL,
     response_model=EntitiesResponse,
     responses={
         500: {"model": ErrorResponse, "description": "Server error"},
@@ -262,8 +489,10 @@ async def similar(
     id: str,
     retrieve_params: views.RetrieveParams = Depends(views.get_retrieve_params),
     authenticated: bool = Depends(get_authenticated),
-) -> EntitiesResponse:
+) -> Response:
     """
     Get similar entities based on `id`
     """
-    return views.similar(request, id, retrieve_params, authenticated)
+    return await respond(
+        "similar", request, views.similar, id, retrieve_params, authenticated
+    )
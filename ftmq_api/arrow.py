@@ -0,0 +1,130 @@
+"""
+Columnar bulk output (Arrow IPC stream / Parquet)
+
+Entities are written as a statement table (one row per property value, same
+columns as `nomenklatura` statements), so the table schema doesn't depend on
+the entity schemata and the output can be streamed in record batches of
+`settings.record_batch_size` entities. The statement ids and the entity id
+checksum statements are omitted (they are derived when loading the
+statements). Bulk consumers get compressed (`zstd`) columnar data that loads
+without parsing:
+
+```python
+import pandas as pd
+df = pd.read_parquet("https://<api>/entities?dataset=my_dataset&format=parquet")
+```
+
+Install the optional dependencies via `pip install ftmq-api[arrow]`
+"""
+
+from collections.abc import Generator, Iterable
+from typing import Any
+
+from banal import chunked_iter
+from fastapi import HTTPException
+from ftmq.types import CE
+from nomenklatura.statement import Statement
+
+from ftmq_api.settings import Settings
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+settings = Settings()
+
+ARROW = "arrow"
+PARQUET = "parquet"
+COMPRESSION = "zstd"
+COLUMNS = (
+    "entity_id",
+    "canonical_id",
+    "prop",
+    "prop_type",
+    "schema",
+    "value",
+    "dataset",
+    "lang",
+    "original_value",
+    "external",
+    "first_seen",
+    "last_seen",
+)
+
+
+def get_schema() -> "pa.Schema":
+    return pa.schema(
+        [(c, pa.bool_() if c == "external" else pa.string()) for c in COLUMNS]
+    )
+
+
+def make_batch(entities: Iterable[CE], schema: "pa.Schema") -> "pa.RecordBatch":
+    columns: dict[str, list[Any]] = {c: [] for c in COLUMNS}
+    for entity in entities:
+        for stmt in entity.statements:
+            if stmt.prop == Statement.BASE:
+                continue
+            for key in COLUMNS:
+                columns[key].append(getattr(stmt, key))
+    return pa.RecordBatch.from_pydict(columns, schema=schema)
+
+
+class Sink:
+    """
+    Write-only file object that hands out the bytes written so far
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[bytes] = []
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def ensure_available(format: str) -> None:
+    """
+    Raises:
+        HTTPException: pyarrow is not installed
+    """
+    if pa is None:
+        raise HTTPException(501, [f"Format `{format}` not available"])
+
+
+def stream_entities(
+    entities: Iterable[CE], format: str = ARROW
+) -> Generator[bytes, None, None]:
+    """
+    Serialize the entities as Arrow IPC stream or Parquet, one record batch
+    (parquet row group) per `settings.record_batch_size` entities
+    """
+    schema = get_schema()
+    sink = Sink()
+    if format == PARQUET:
+        writer = pq.ParquetWriter(sink, schema, compression=COMPRESSION)
+    else:
+        options = pa.ipc.IpcWriteOptions(compression=COMPRESSION)
+        writer = pa.ipc.new_stream(sink, schema, options=options)
+    with writer:
+        for chunk in chunked_iter(entities, settings.record_batch_size):
+            writer.write_batch(make_batch(chunk, schema))
+            data = sink.drain()
+            if data:
+                yield data
+    data = sink.drain()  # footer
+    if data:
+        yield data
@@ -0,0 +1,278 @@
+"""
+Native asyncio variant of [`View`][ftmq_api.store.View]
+
+It compiles the same `ftmq` queries against the statement table but executes
+them via an async sql driver (`aiosqlite` or `asyncpg`), so store I/O can be
+awaited instead of holding a thread for the whole request.
+
+Install the optional dependencies via `pip install ftmq-api[async]`
+"""
+
+from collections.abc import AsyncGenerator, Iterable
+from functools import cache
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlparse
+
+from fastapi import HTTPException
+from ftmq.aggregations import AggregatorResult
+from ftmq.model import DatasetStats
+from ftmq.model.coverage import Collector
+from ftmq.query import Q, Query
+from ftmq.store.sql import SQLStore
+from ftmq.types import CE
+from nomenklatura.judgement import Judgement
+from nomenklatura.resolver import Resolver
+from nomenklatura.statement import Statement
+from sqlalchemy import desc, or_, select
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql.selectable import Select
+
+from ftmq_api.executor import dispatch
+from ftmq_api.metrics import timed
+from ftmq_api.resolver import MemoryResolver, get_resolver_table
+from ftmq_api.store import (
+    Nesting,
+    View,
+    get_view,
+    retrieve_entity,
+    select_entities,
+    select_inverted,
+)
+
+if TYPE_CHECKING:
+    from ftmq_api.views import RetrieveParams
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+}
+
+
+def get_async_uri(uri: str) -> str:
+    """
+    Translate a (sync) sqlalchemy uri into one using an async driver
+    """
+    scheme = urlparse(uri).scheme
+    dialect = scheme.split("+")[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise NotImplementedError(f"No async driver for `{scheme}`")
+    return ASYNC_DRIVERS[dialect] + uri[len(scheme) :]
+
+
+@cache
+def get_async_engine(uri: str) -> AsyncEngine:
+    return create_async_engine(get_async_uri(uri))
+
+
+class AsyncView:
+    """
+    Same interface as [`View`][ftmq_api.store.View], but all store access is
+    awaitable. Scoping, the linker and entity assembly are shared with the
+    synchronous view for the same dataset.
+    """
+
+    def __init__(self, dataset: str | None = None, view: View | None = None) -> None:
+        view = view or get_view(dataset)
+        if not isinstance(view.store, SQLStore):
+            raise NotImplementedError(
+                f"Async view not supported for `{view.store.__class__.__name__}`"
+            )
+        self.dataset = view.dataset
+        self.store = view.store
+        self.query = view.query
+        self.table = self.store.table
+        url = self.store.engine.url.render_as_string(hide_password=False)
+        self.engine = get_async_engine(url)
+        self._view = view
+        self._cache: dict[str, Any] = {}
+
+    async def _execute(self, q: Select) -> list[Any]:
+        async with self.engine.connect() as conn:
+            res = await conn.execute(q)
+            return list(res.fetchall())
+
+    async def _stream(self, q: Select) -> AsyncGenerator[Any, None]:
+        async with self.engine.connect() as conn:
+            res = await conn.stream(q)
+            async for row in res:
+                yield row
+
+    async def _iterate(self, q: Select) -> AsyncGenerator[CE, None]:
+        # group by canonical id (the store groups by the original entity id)
+        current_id = None
+        statements: list[Statement] = []
+        async for row in self._stream(q):
+            stmt = Statement.from_db_row(row)
+            if current_id is not None and current_id != stmt.canonical_id:
+                proxy = self.store.assemble(statements)
+                if proxy is not None:
+                    yield proxy
+                statements = []
+            current_id = stmt.canonical_id
+            statements.append(stmt)
+        if not statements:
+            return
+        proxy = self.store.assemble(statements)
+        if proxy is not None:
+            yield proxy
+
+    async def get_entities_by_id(self, ids: Iterable[str]) -> list[CE]:
+        """
+        Get the entities for the given (canonical) ids within one query
+        """
+        ids = set(ids)
+        if not ids:
+            return []
+        q = select_entities(self.table, ids, self.query.dataset_names)
+        return [e async for e in self._iterate(q)]
+
+    async def get_inverted(
+        self, ids: Iterable[str], limit: int, exclude: Iterable[str] | None = None
+    ) -> list[CE]:
+        """
+        Get (max `limit`) entities referencing any of the given ids within one
+        query, excluding the given ids in `exclude`
+        """
+        ids = set(ids)
+        if not ids:
+            return []
+        q = select_inverted(
+            self.table, ids, self.query.dataset_names, limit, set(exclude or [])
+        )
+        return [e async for e in self._iterate(q)]
+
+    @timed("entities")
+    async def get_entity(self, entity_id: str, params: "RetrieveParams") -> CE:
+        linker = self.store.linker
+        if isinstance(linker, MemoryResolver):  # in-memory lookup
+            canonical = linker.get_canonical(entity_id)
+        else:  # might query the resolver table
+            canonical = await dispatch("entity", linker.get_canonical, entity_id)
+        ids = {canonical, entity_id}
+        entities = {e.id: e for e in await self.get_entities_by_id(ids)}
+        proxy = entities.get(canonical) or entities.get(entity_id)
+        if proxy is None:
+            raise HTTPException(404, detail=[f"Entity `{entity_id}` not found."])
+        return retrieve_entity(proxy, params)
+
+    @timed("entities")
+    async def get_entities(
+        self, query: Q, params: "RetrieveParams"
+    ) -> AsyncGenerator[CE, None]:
+        query = self.query.ensure_scoped_query(query)
+        async for proxy in self._iterate(query.sql.statements):
+            yield retrieve_entity(proxy, params)
+
+    @timed("adjacents")
+    async def get_nested(
+        self,
+        entities: Iterable[CE],
+        depth: int | None = 1,
+        inverted: bool | None = False,
+        limit: int | None = None,
+    ) -> list[list[CE]]:
+        """
+        Same as [`View.get_nested`][ftmq_api.store.View.get_nested]
+        """
+        nesting = Nesting(entities, depth, limit)
+        for _ in range(nesting.depth):
+            level = await self.get_entities_by_id(nesting.referenced)
+            if inverted:
+                level.extend(
+                    await self.get_inverted(
+                        nesting.referencing, nesting.limit, exclude=nesting.visited
+                    )
+                )
+            if not nesting.add(level):
+                break
+        return nesting.levels
+
+    @timed("count")
+    async def count(self, query: Q | None = None) -> int:
+        if query is None:
+            return 0
+        for (count,) in await self._execute(query.sql.count):
+            return count
+        return 0
+
+    @timed("stats")
+    async def stats(self, query: Q | None = None) -> DatasetStats:
+        query = self.query.ensure_scoped_query(query or Query())
+        key = f"stats-{hash(query)}"
+        if key in self._cache:
+            return self._cache[key]
+
+        c = Collector()
+        for schema, count in await self._execute(query.sql.things):
+            c.things[schema] = count
+        for schema, count in await self._execute(query.sql.intervals):
+            c.intervals[schema] = count
+        for country, count in await self._execute(query.sql.things_countries):
+            if country is not None:
+                c.things_countries[country] = count
+        for country, count in await self._execute(query.sql.intervals_countries):
+            if country is not None:
+                c.intervals_countries[country] = count
+
+        stats = c.export()
+        for start, end in await self._execute(query.sql.date_range):
+            if start:
+                stats.coverage.start = start
+            if end:
+                stats.coverage.end = end
+            break
+
+        stats.entity_count = await self.count(query)
+        self._cache[key] = stats
+        return stats
+
+    async def aggregations(self, query: Q) -> AggregatorResult | None:
+        """
+        Aggregations via `ftmq` (one query per group value), executed in the
+        thread pool (with the `aggregate` endpoint limit)
+        """
+        return await dispatch("aggregate", self._view.aggregations, query)
+
+    async def similar(
+        self, entity_id: str, params: "RetrieveParams", limit: int | None = None
+    ) -> AsyncGenerator[tuple[CE, float], None]:
+        """
+        Same as `ftmq.similar.get_similar`, but the resolver table (of the
+        store linker) is queried asynchronously and the candidates are fetched
+        within one query.
+
+        Raises:
+            NotImplementedError: The store linker is not a (sql) resolver
+        """
+        if not isinstance(self.store.linker, Resolver):
+            raise NotImplementedError(
+                "Similar entities require a resolver, not "
+                f"`{self.store.linker.__class__.__name__}`"
+            )
+        engine, t = get_resolver_table(self.store.linker)
+        url = engine.url.render_as_string(hide_password=False)
+        q = select(t.c.target, t.c.source, t.c.score)
+        q = q.where(or_(t.c.source == entity_id, t.c.target == entity_id))
+        q = q.where(t.c.judgement == Judgement.NO_JUDGEMENT.value)
+        q = q.order_by(desc(t.c.score))
+        if limit:
+            q = q.limit(limit)
+        candidates: dict[str, float] = {}
+        async with get_async_engine(url).connect() as conn:
+            rows = (await conn.execute(q)).fetchall()
+        for target, source, score in rows:
+            candidate = target if target != entity_id else source
+            candidates.setdefault(candidate, score)
+        if not candidates:
+            return
+        entities = {e.id: e for e in await self.get_entities_by_id(candidates)}
+        for candidate, score in candidates.items():
+            proxy = entities.get(candidate)
+            if proxy is not None:
+                yield retrieve_entity(proxy, params), score
+
+
+@cache
+def get_async_view(dataset: str | None = None) -> AsyncView:
+    return AsyncView(dataset)
@@ -0,0 +1,130 @@
+"""
+Coroutine variants of the store bound views
+
+With `settings.async_store`, the entity list, entity detail and aggregation
+endpoints await the [`AsyncView`][ftmq_api.async_store.AsyncView] on the
+event loop instead of occupying an executor thread for the whole request.
+They use the same cache keys as (and share their cache entries with) the
+synchronous views in [`ftmq_api.views`][ftmq_api.views].
+"""
+
+import asyncio
+from collections.abc import Callable
+from typing import Any
+
+from fastapi import Request
+from ftmq.types import CE
+
+from ftmq_api.async_store import AsyncView, get_async_view
+from ftmq_api.cache import async_cache
+from ftmq_api.query import (
+    Cursor,
+    Query,
+    RetrieveParams,
+    ViewQueryParams,
+    select_sort_value,
+)
+from ftmq_api.serialize import (
+    AggregationResponse,
+    CachedResponse,
+    EntitiesResponse,
+    EntityResponse,
+    Redirect,
+    to_response,
+)
+from ftmq_api.views import (
+    get_cache_key,
+    get_count_cache_key,
+    get_redirect,
+    get_response_cache_key,
+)
+
+
+async def get_next_cursor(
+    view: AsyncView, entities: list[CE], query: Query
+) -> Cursor | None:
+    """
+    Same as [`views.get_next_cursor`][ftmq_api.views.get_next_cursor]
+    """
+    if not entities or len(entities) < query.limit:
+        return None
+    entity_id = entities[-1].id
+    if query.sort is None:
+        return Cursor(id=entity_id)
+    q = select_sort_value(view.table, entity_id, query.sort)
+    async with view.engine.connect() as conn:
+        return Cursor.from_value(entity_id, await conn.scalar(q))
+
+
+@async_cache(key_func=get_response_cache_key, serialization_mode="raw")
+async def cached_response(
+    request: Request, view: Callable[..., Any], *args, **kwargs
+) -> bytes:
+    response = to_response(await view(request, *args, **kwargs))
+    return CachedResponse.from_response(response).dump()
+
+
+@async_cache(key_func=get_count_cache_key)
+async def get_count(view: AsyncView, query: Query) -> int:
+    return await view.count(query)
+
+
+@async_cache(key_func=get_cache_key, model=EntitiesResponse)
+async def entity_list(
+    request: Request,
+    retrieve_params: RetrieveParams,
+    authenticated: bool | None = False,
+) -> EntitiesResponse:
+    view = get_async_view()
+    params = ViewQueryParams.from_request(request, authenticated)
+    query = Query.from_params(params)
+    adjacents = []
+    entities = [e async for e in view.get_entities(query, retrieve_params)]
+    if retrieve_params.nested:
+        adjacents = await view.get_nested(entities, retrieve_params.depth)
+    stats = await view.stats(query) if retrieve_params.stats else None
+    return EntitiesResponse.from_view(
+        request=request,
+        entities=entities,
+        adjacents=adjacents,
+        stats=stats,
+        authenticated=authenticated,
+        count=stats.entity_count if stats else await get_count(view, query),
+        cursor=await get_next_cursor(view, entities, query),
+    )
+
+
+@async_cache(key_func=get_cache_key, serialization_mode="pickle")
+async def entity_detail(
+    request: Request,
+    entity_id: str,
+    retrieve_params: RetrieveParams,
+) -> EntityResponse | Redirect:
+    view = get_async_view()
+    entity = await view.get_entity(entity_id, retrieve_params)
+    if entity.id != entity_id:  # we have a redirect to a merged entity
+        return get_redirect(request, entity)
+    adjacents: list[list[CE]] = []
+    if retrieve_params.nested:
+        adjacents = await view.get_nested(
+            [entity], retrieve_params.depth, inverted=True
+        )
+    return EntityResponse.from_levels(
+        [entity],
+        adjacents,
+        inverted=True,
+        dehydrate=retrieve_params.dehydrate_nested,
+    )[0]
+
+
+@async_cache(key_func=get_cache_key, model=AggregationResponse)
+async def aggregation(request: Request) -> AggregationResponse:
+    view = get_async_view()
+    params = ViewQueryParams.from_request(request)
+    query = Query.from_params(params)
+    aggregations, stats = await asyncio.gather(
+        view.aggregations(query), view.stats(query)
+    )
+    return AggregationResponse.from_view(
+        request=request, aggregations=aggregations, stats=stats
+    )
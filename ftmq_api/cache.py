@@ -0,0 +1,504 @@
+"""
+In-process (L1) cache in front of the shared anystore cache
+
+Hot keys (e.g. `/catalog` or popular entity pages) are kept as deserialized
+objects in worker memory, bounded by entry count and (approximate) bytes with
+LRU eviction and per-view ttls. Misses fall through to the `anycache`
+decorated view function (and therefore to the shared cache, e.g. redis).
+
+Concurrent misses of the shared cache for the same key are coalesced
+("single-flight"): only one request computes the view while the others wait
+for its result. Across workers, this is coordinated via a redis lock on the
+shared cache, which is checked again after acquiring the lock.
+
+Hits and misses of both caches are counted per view (see
+[`ftmq_api.metrics`][ftmq_api.metrics]).
+
+Coroutine view functions (see [`ftmq_api.async_views`][ftmq_api.async_views])
+use the same caches (and keys) via `async_cache`.
+"""
+
+import asyncio
+import functools
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from functools import cache
+from typing import Any
+from weakref import WeakKeyDictionary
+
+from anystore.exceptions import DoesNotExist
+from anystore.store import BaseStore, get_store
+from anystore.store.redis import RedisStore, get_redis
+from pydantic import BaseModel
+from redis.lock import Lock as RedisLock
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response
+
+from ftmq_api.logging import get_logger
+from ftmq_api.metrics import count_cache
+from ftmq_api.settings import Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+
+@cache
+def get_cache() -> BaseStore:
+    return get_store(**settings.cache.model_dump())
+
+
+def get_size(value: Any) -> int:
+    """
+    Approximate memory footprint of a cached value (its serialized size)
+    """
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, BaseModel):
+        return len(value.__pydantic_serializer__.to_json(value))
+    try:
+        return len(pickle.dumps(value))
+    except Exception:
+        return 0
+
+
+class LRUCache:
+    def __init__(self, items: int, size: int) -> None:
+        self.items = items
+        self.size = size
+        self.current_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict[str, tuple[float, int, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def _pop(self, key: str) -> None:
+        _, size, _ = self._data.pop(key)
+        self.current_size -= size
+
+    def get(self, key: str) -> Any:
+        """
+        Raises:
+            KeyError: Key not found or expired
+        """
+        with self._lock:
+            try:
+                expires, _, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                raise
+            if expires < time.monotonic():
+                self._pop(key)
+                self.misses += 1
+                raise KeyError(key)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any, ttl: int) -> None:
+        size = get_size(value)
+        if size > self.size:
+            return
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (time.monotonic() + ttl, size, value)
+            self.current_size += size
+            while len(self._data) > self.items or self.current_size > self.size:
+                self._pop(next(iter(self._data)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.current_size = 0
+
+
+@cache
+def get_local_cache() -> LRUCache:
+    return LRUCache(settings.local_cache.items, settings.local_cache.size)
+
+
+class SharedCache:
+    """
+    The shared (anystore) cache of a view, with the serialization options of
+    the `anycache` decorator (`model`, `serialization_mode`, ...)
+    """
+
+    GET_OPTIONS = ("serialization_mode", "deserialization_func", "model")
+    PUT_OPTIONS = ("serialization_mode", "serialization_func", "model", "ttl")
+
+    def __init__(self, store: BaseStore | None = None, **options: Any) -> None:
+        self.store = store or get_cache()
+        self.options = options
+
+    def get(self, key: str) -> Any:
+        """
+        Raises:
+            DoesNotExist: Key not found
+        """
+        options = {k: v for k, v in self.options.items() if k in self.GET_OPTIONS}
+        return self.store.get(key, raise_on_nonexist=True, **options)
+
+    def put(self, key: str, value: Any) -> None:
+        options = {k: v for k, v in self.options.items() if k in self.PUT_OPTIONS}
+        self.store.put(key, value, **options)
+
+
+def anycache(
+    key_func: Callable[..., str | None], store: BaseStore | None = None, **kwargs: Any
+) -> Callable[..., Any]:
+    """
+    Cache the view function in the shared cache (same options as
+    `anystore.decorators.anycache`, via the public store api), count its hits
+    and misses (the view function is computed) per view and coalesce
+    concurrent misses for the same key (see `SingleFlight`)
+    """
+
+    def _decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        name = func.__name__
+        shared = SharedCache(store, **kwargs)
+
+        def _get(key: str) -> Any:
+            """
+            Raises:
+                DoesNotExist: Key not found
+            """
+            res = shared.get(key)
+            count_cache(name, "shared", hit=True)
+            return res
+
+        def _compute(key: str, *args, **kwargs) -> Any:
+            count_cache(name, "shared", hit=False)
+            res = func(*args, **kwargs)
+            shared.put(key, res)
+            return res
+
+        def _compute_locked(key: str, *args, **kwargs) -> Any:
+            # another worker might have computed it while we waited for the lock
+            try:
+                return _get(key)
+            except DoesNotExist:
+                return _compute(key, *args, **kwargs)
+
+        @functools.wraps(func)
+        def _inner(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            try:
+                return _get(key)
+            except DoesNotExist:
+                pass
+            if not settings.coalesce:
+                return _compute(key, *args, **kwargs)
+            return get_single_flight().run(key, _compute_locked, key, *args, **kwargs)
+
+        return _inner
+
+    return _decorator
+
+
+def local_cache(key_func: Callable[..., str | None]) -> Callable[..., Any]:
+    """
+    Decorate an `anycache` decorated view function with the in-process cache,
+    using the same `key_func`. The ttl is looked up by the function name in
+    `settings.local_cache.ttls`.
+    """
+
+    def _decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        ttl = settings.local_cache.ttls.get(func.__name__, settings.local_cache.ttl)
+
+        @functools.wraps(func)
+        def _inner(*args, **kwargs):
+            key = key_func(*args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            if not settings.local_cache.enabled or not ttl:
+                log.debug("Cache", view=func.__name__, key=key)
+                return func(*args, **kwargs)
+            lru = get_local_cache()
+            try:
+                res = lru.get(key)
+                log.debug("Cache", view=func.__name__, key=key, local_hit=True)
+                count_cache(func.__name__, "local", hit=True)
+                return res
+            except KeyError:
+                log.debug("Cache", view=func.__name__, key=key, local_hit=False)
+                count_cache(func.__name__, "local", hit=False)
+                res = func(*args, **kwargs)
+                # responses are mutated per request, only cache plain data
+                if not isinstance(res, Response):
+                    lru.put(key, res, ttl)
+                return res
+
+        return _inner
+
+    return _decorator
+
+
+class LocalLock:
+    """
+    Process-local stand-in for the redis lock (for non-redis cache stores).
+    The locks are shared by name and removed when no caller holds or waits
+    for them anymore.
+    """
+
+    _locks: dict[str, tuple[threading.Lock, int]] = {}
+    _guard = threading.Lock()
+
+    def __init__(self, name: str, blocking_timeout: float) -> None:
+        self.name = name
+        self.blocking_timeout = blocking_timeout
+
+    def _ref(self, delta: int) -> threading.Lock:
+        with self._guard:
+            lock, count = self._locks.get(self.name, (None, 0))
+            lock = lock or threading.Lock()
+            if count + delta > 0:
+                self._locks[self.name] = lock, count + delta
+            else:
+                self._locks.pop(self.name, None)
+            return lock
+
+    def acquire(self) -> bool:
+        if self._ref(1).acquire(timeout=self.blocking_timeout):
+            return True
+        self._ref(-1)
+        return False
+
+    def release(self) -> None:
+        self._ref(-1).release()
+
+
+def get_lock(store: BaseStore, key: str, timeout: float) -> LocalLock | RedisLock:
+    """
+    Get a (cross-worker) lock for the given cache key: an expiring redis lock
+    (released only by its owner, via compare-and-delete) for redis cache
+    stores
+    """
+    name = f"ftmq-api/lock/{key}"
+    if isinstance(store, RedisStore):
+        return RedisLock(
+            get_redis(store.uri),
+            name,
+            timeout=timeout,
+            sleep=0.05,
+            blocking_timeout=timeout,
+        )
+    return LocalLock(name, blocking_timeout=timeout)
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key: The first caller (within this
+    worker) acquires the shared lock and computes the result, all other
+    callers wait for it. Callers in other workers wait for the shared lock, so
+    the computing function should check the shared cache again.
+    """
+
+    def __init__(self, store: BaseStore, timeout: int) -> None:
+        self.store = store
+        self.timeout = timeout
+        self.coalesced = 0
+        self._calls: dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                log.warning(f"Timeout waiting for in-flight request `{key}`")
+                return func(*args, **kwargs)
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run_locked(key, func, *args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _run_locked(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        lock = get_lock(self.store, key, self.timeout)
+        try:
+            acquired = lock.acquire()
+        except Exception as e:  # shared lock unavailable, don't fail the request
+            log.warning(f"Could not acquire lock for `{key}`: {e}")
+            acquired = False
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except Exception as e:  # e.g. lock expired meanwhile
+                    log.warning(f"Could not release lock for `{key}`: {e}")
+
+
+@cache
+def get_single_flight() -> SingleFlight:
+    return SingleFlight(get_cache(), settings.coalesce_timeout)
+
+
+class AsyncSingleFlight:
+    """
+    [`SingleFlight`][ftmq_api.cache.SingleFlight] for coroutines: callers
+    within this worker wait for the leader's future, the shared lock is
+    acquired in the thread pool.
+    """
+
+    def __init__(self, store: BaseStore, timeout: int) -> None:
+        self.store = store
+        self.timeout = timeout
+        self.coalesced = 0
+        # futures are bound to the event loop they are created in
+        self._calls: WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str, asyncio.Future]
+        ] = WeakKeyDictionary()
+
+    async def run(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+        calls = self._calls.setdefault(asyncio.get_running_loop(), {})
+        call = calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.wait_for(asyncio.shield(call), self.timeout)
+            except asyncio.TimeoutError:
+                log.warning(f"Timeout waiting for in-flight request `{key}`")
+                return await func(*args, **kwargs)
+        call = calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await self._run_locked(key, func, *args, **kwargs)
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            call.exception()  # don't warn if there are no other callers
+            raise
+        finally:
+            calls.pop(key, None)
+
+    async def _run_locked(
+        self, key: str, func: Callable[..., Any], *args, **kwargs
+    ) -> Any:
+        lock = get_lock(self.store, key, self.timeout)
+        try:
+            acquired = await run_in_threadpool(lock.acquire)
+        except Exception as e:  # shared lock unavailable, don't fail the request
+            log.warning(f"Could not acquire lock for `{key}`: {e}")
+            acquired = False
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if acquired:
+                try:
+                    await run_in_threadpool(lock.release)
+                except Exception as e:  # e.g. lock expired meanwhile
+                    log.warning(f"Could not release lock for `{key}`: {e}")
+
+
+@cache
+def get_async_single_flight() -> AsyncSingleFlight:
+    return AsyncSingleFlight(get_cache(), settings.coalesce_timeout)
+
+
+def async_cache(
+    key_func: Callable[..., str | None], store: BaseStore | None = None, **kwargs: Any
+) -> Callable[..., Any]:
+    """
+    The `local_cache` and `anycache` decorators in one for coroutine view
+    functions (`kwargs` are the shared cache options, same as for
+    `anycache`). The key function and the shared cache are called in the
+    thread pool, so that the event loop is not blocked.
+    """
+
+    def _decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        name = func.__name__
+        ttl = settings.local_cache.ttls.get(name, settings.local_cache.ttl)
+        shared = SharedCache(store, **kwargs)
+
+        async def _get(key: str) -> Any:
+            """
+            Raises:
+                DoesNotExist: Key not found
+            """
+            res = await run_in_threadpool(shared.get, key)
+            count_cache(name, "shared", hit=True)
+            return res
+
+        async def _compute(key: str, *args, **kwargs) -> Any:
+            count_cache(name, "shared", hit=False)
+            res = await func(*args, **kwargs)
+            await run_in_threadpool(shared.put, key, res)
+            return res
+
+        async def _compute_locked(key: str, *args, **kwargs) -> Any:
+            # another worker might have computed it while we waited for the lock
+            try:
+                return await _get(key)
+            except DoesNotExist:
+                return await _compute(key, *args, **kwargs)
+
+        async def _shared(key: str, *args, **kwargs) -> Any:
+            try:
+                return await _get(key)
+            except DoesNotExist:
+                pass
+            if not settings.coalesce:
+                return await _compute(key, *args, **kwargs)
+            return await get_async_single_flight().run(
+                key, _compute_locked, key, *args, **kwargs
+            )
+
+        @functools.wraps(func)
+        async def _inner(*args, **kwargs):
+            key = await run_in_threadpool(key_func, *args, **kwargs)
+            if key is None:
+                return await func(*args, **kwargs)
+            if not settings.local_cache.enabled or not ttl:
+                log.debug("Cache", view=name, key=key)
+                return await _shared(key, *args, **kwargs)
+            lru = get_local_cache()
+            try:
+                res = lru.get(key)
+                log.debug("Cache", view=name, key=key, local_hit=True)
+                count_cache(name, "local", hit=True)
+                return res
+            except KeyError:
+                log.debug("Cache", view=name, key=key, local_hit=False)
+                count_cache(name, "local", hit=False)
+            res = await _shared(key, *args, **kwargs)
+            # responses are mutated per request, only cache plain data
+            if not isinstance(res, Response):
+                lru.put(key, res, ttl)
+            return res
+
+        return _inner
+
+    return _decorator
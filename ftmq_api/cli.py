@@ -0,0 +1,137 @@
+from typing import Annotated, Optional
+
+import typer
+from anystore.cli import ErrorHandler
+from anystore.logging import configure_logging
+from rich import print
+
+from ftmq_api import __version__
+from ftmq_api.logging import get_logger
+from ftmq_api.settings import Settings
+
+settings = Settings()
+cli = typer.Typer(no_args_is_help=True, pretty_exceptions_enable=settings.debug)
+log = get_logger(__name__)
+
+
+@cli.callback(invoke_without_command=True)
+def cli_ftmq_api(
+    version: Annotated[Optional[bool], typer.Option(..., help="Show version")] = False,
+):
+    if version:
+        print(__version__)
+        raise typer.Exit()
+    configure_logging()
+
+
+@cli.command("stats")
+def cli_stats(
+    out_uri: Annotated[
+        Optional[str],
+        typer.Option(
+            "-o", help="Output uri (default: configured `stats_uri` or temp file)"
+        ),
+    ] = None,
+):
+    """
+    Compute the dataset statistics snapshot used by the `/catalog` endpoints
+    (run this before starting the api workers)
+    """
+    from ftmq_api.stats import Stats, get_stats_uri
+
+    with ErrorHandler(log):
+        Stats(out_uri or get_stats_uri()).load(force=True)
+
+
+@cli.command("warmup")
+def cli_warmup(
+    recorded: Annotated[
+        Optional[str],
+        typer.Option(
+            "-r", help="Recorded requests (json lines with `url` and optional `count`)"
+        ),
+    ] = None,
+    top: Annotated[
+        int, typer.Option("-n", help="Replay top n recorded requests")
+    ] = 100,
+    base_url: Annotated[
+        str,
+        typer.Option(
+            help="Public base url of the api (the host is part of cache keys)"
+        ),
+    ] = "http://localhost",
+    concurrency: Annotated[
+        int, typer.Option("-c", help="Number of concurrent requests")
+    ] = 4,
+):
+    """
+    Pre-populate the api cache: catalog, datasets, first entities pages per
+    dataset and schema and the top recorded requests
+    """
+    import asyncio
+
+    from ftmq_api.warmup import get_catalog_urls, get_recorded_urls, warmup
+
+    with ErrorHandler(log):
+        if not settings.use_cache:
+            log.warning("Cache is not activated (`FTMQ_API_USE_CACHE`)")
+        urls = get_catalog_urls()
+        if recorded is not None:
+            urls.extend(get_recorded_urls(recorded, top))
+        statuses = asyncio.run(warmup(urls, base_url, concurrency))
+        log.info("Warm-up complete", **{str(k): v for k, v in statuses.items()})
+
+
+@cli.command("indexes")
+def cli_indexes(
+    recorded: Annotated[
+        Optional[str],
+        typer.Option(
+            "-r",
+            help="Recorded requests (json lines with `url` and optional `count`), "
+            "default: create the configured indexes (`indexes` settings)",
+        ),
+    ] = None,
+    threshold: Annotated[
+        int, typer.Option("-t", help="Min number of requests per query shape")
+    ] = 1,
+    create: Annotated[
+        bool, typer.Option(help="Create the missing indexes in the store")
+    ] = False,
+):
+    """
+    Recommend (or create) indexes for the query shapes of recorded requests,
+    without `-r`: create the configured ones (run this before starting the api
+    workers)
+    """
+    from ftmq_api.indexes import (
+        create_indexes,
+        ensure_indexes,
+        get_existing,
+        get_indexes,
+        get_shapes,
+        get_sql_store,
+        to_sql,
+    )
+    from ftmq_api.warmup import get_recorded_counts
+
+    with ErrorHandler(log):
+        if recorded is None:
+            created = ensure_indexes()
+            log.info("Indexes created", count=len(created))
+            return
+        store = get_sql_store()
+        if store is None:
+            raise typer.Exit(1)
+        shapes = get_shapes(get_recorded_counts(recorded), threshold).most_common()
+        indexes = get_indexes(store, [shape for shape, _ in shapes])
+        existing = get_existing(store)
+        for (shape, count), index in zip(shapes, indexes):
+            label = " ".join(p for p in shape if p)
+            status = "exists" if index.name in existing else "missing"
+            # plain output (sql without wrapping)
+            typer.echo(f"-- {label}: {count} requests ({status})")
+            typer.echo(f"{to_sql(index, store)};")
+        if create:
+            created = create_indexes(store, indexes)
+            log.info("Indexes created", count=len(created))
@@ -0,0 +1,223 @@
+"""
+Response compression
+
+Responses are compressed with the preferred encoding (`zstd`, `br`, `gzip`,
+see `settings.compression`) the client accepts (`Accept-Encoding`): buffered
+responses if they are larger than `settings.compression.size`, streaming
+responses chunk by chunk (flushed after each chunk, so clients can process
+the stream as it arrives).
+
+Cached responses (`settings.cache_responses`) are stored compressed and are
+served as they are to clients accepting their encoding, so cache hits skip
+the compression.
+
+Install the optional dependencies for `br` and `zstd` via
+`pip install ftmq-api[compression]`
+"""
+
+import zlib
+from typing import Any
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ftmq_api.settings import Settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+settings = Settings()
+
+GZIP = "gzip"
+BROTLI = "br"
+ZSTD = "zstd"
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/")
+
+
+def get_encodings() -> list[str]:
+    """
+    The available encodings in order of preference
+    """
+    available = {GZIP: True, BROTLI: brotli is not None, ZSTD: zstandard is not None}
+    return [e for e in settings.compression.encodings if available.get(e)]
+
+
+def negotiate(
+    accept_encoding: str | None, encodings: list[str] | None = None
+) -> str | None:
+    """
+    The first of the given (default: all available) encodings that is
+    accepted by the client
+    """
+    if not accept_encoding:
+        return None
+    accepted: dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        accepted[name.lower()] = quality
+    for encoding in get_encodings() if encodings is None else encodings:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def is_compressible(content_type: str | None) -> bool:
+    return content_type is not None and content_type.startswith(COMPRESSIBLE)
+
+
+def get_level(encoding: str) -> int | None:
+    return settings.compression.levels.get(encoding)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    level = get_level(encoding)
+    if encoding == BROTLI:
+        return brotli.compress(data, quality=11 if level is None else level)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor(level=level or 3).compress(data)
+    return zlib.compress(data, -1 if level is None else level, wbits=31)
+
+
+def decompress(data: bytes, encoding: str) -> bytes:
+    if encoding == BROTLI:
+        return brotli.decompress(data)
+    if encoding == ZSTD:
+        # streamed frames have no content size
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return zlib.decompress(data, wbits=31)
+
+
+class Compressor:
+    """
+    Streaming compressor: `compress` returns the compressed (and flushed) data
+    of each chunk, `finish` ends the stream
+    """
+
+    def __init__(self, encoding: str) -> None:
+        self.encoding = encoding
+        level = get_level(encoding)
+        if encoding == BROTLI:
+            self._compressor: Any = brotli.Compressor(
+                quality=11 if level is None else level
+            )
+        elif encoding == ZSTD:
+            self._compressor = zstandard.ZstdCompressor(level=level or 3).compressobj()
+        else:
+            self._compressor = zlib.compressobj(
+                -1 if level is None else level, zlib.DEFLATED, 31
+            )
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == BROTLI:
+            return self._compressor.process(data) + self._compressor.flush()
+        if self.encoding == ZSTD:
+            return self._compressor.compress(data) + self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+        return self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+
+    def finish(self) -> bytes:
+        if self.encoding == BROTLI:
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def weaken_etag(headers: MutableHeaders) -> None:
+    # the encoded body differs from the identity one, so the etag is weak
+    # for clients accepting an encoding (`If-None-Match` ignores the `W/`)
+    etag = headers.get("etag")
+    if etag and not etag.startswith("W/"):
+        headers["ETag"] = f"W/{etag}"
+
+
+class CompressionMiddleware:
+    """
+    Compress (json, ndjson and text) responses with the negotiated encoding,
+    responses that already have a `Content-Encoding` are passed through
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not settings.compression.enabled:
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, CompressionResponder(send, encoding).send)
+
+
+class CompressionResponder:
+    def __init__(self, send: Send, encoding: str) -> None:
+        self._send = send
+        self.encoding = encoding
+        self.start: Message | None = None
+        self.compressor: Compressor | None = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            # wait for the first body message to decide
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(raw=start["headers"])
+            if start["status"] == 304:
+                # the size of the 200 response is unknown here, a weak etag
+                # is valid for both its identity and its encoded body
+                self.passthrough = True
+                weaken_etag(headers)
+            elif not is_compressible(headers.get("content-type")):
+                self.passthrough = True
+            else:
+                headers.add_vary_header("Accept-Encoding")
+                if "content-encoding" in headers:  # encoded (cached) response
+                    self.passthrough = True
+                    weaken_etag(headers)
+                elif not more_body and len(body) < settings.compression.size:
+                    self.passthrough = True
+            if self.passthrough:
+                await self._send(start)
+                await self._send(message)
+                return
+            headers["Content-Encoding"] = self.encoding
+            weaken_etag(headers)
+            if not more_body:
+                body = compress(body, self.encoding)
+                headers["Content-Length"] = str(len(body))
+                await self._send(start)
+                await self._send({**message, "body": body})
+                return
+            del headers["Content-Length"]
+            self.compressor = Compressor(self.encoding)
+            await self._send(start)
+        assert self.compressor is not None
+        body = self.compressor.compress(body)
+        if not more_body:
+            body += self.compressor.finish()
+        await self._send({**message, "body": body})
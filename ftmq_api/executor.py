@@ -0,0 +1,193 @@
+"""
+Dispatch blocking store work off the event loop
+
+All `views.*` functions are synchronous (they talk to the sql store and the
+cache backend). They are executed within a dedicated thread pool with a
+configurable size and optional per-endpoint concurrency limits, so that a few
+heavy requests (e.g. `/aggregate`) can't occupy all the workers and stall cheap
+lookups like `/entities/{entity_id}`.
+"""
+
+import asyncio
+import contextvars
+import threading
+import time
+from collections.abc import AsyncGenerator, Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
+from typing import Any, TypeVar
+from weakref import WeakKeyDictionary
+
+from pydantic import BaseModel
+
+from ftmq_api.logging import get_logger
+from ftmq_api.metrics import observe_wait, set_queue_depth
+from ftmq_api.profile import get_profiler
+from ftmq_api.settings import Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+T = TypeVar("T")
+
+
+class EndpointStats(BaseModel):
+    limit: int | None = None
+    queued: int = 0
+    """Requests waiting for a free slot (endpoint limit or thread pool)"""
+    running: int = 0
+    dispatched: int = 0
+    wait_total: float = 0
+    """Accumulated seconds requests waited before execution"""
+    wait_max: float = 0
+    wait_last: float = 0
+
+    @property
+    def wait_avg(self) -> float:
+        if not self.dispatched:
+            return 0
+        return self.wait_total / self.dispatched
+
+
+class Dispatcher:
+    def __init__(self, workers: int, limits: dict[str, int] | None = None) -> None:
+        self.workers = workers
+        self.limits = limits or {}
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="ftmq-api")
+        self._lock = threading.Lock()
+        self._stats: dict[str, EndpointStats] = {}
+        # asyncio primitives are bound to the event loop they are used in
+        self._semaphores: WeakKeyDictionary[
+            asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]
+        ] = WeakKeyDictionary()
+
+    def _get_semaphore(self, endpoint: str) -> asyncio.Semaphore | None:
+        limit = self.limits.get(endpoint)
+        if not limit:
+            return None
+        loop = asyncio.get_running_loop()
+        semaphores = self._semaphores.setdefault(loop, {})
+        if endpoint not in semaphores:
+            semaphores[endpoint] = asyncio.Semaphore(limit)
+        return semaphores[endpoint]
+
+    def _get_stats(self, endpoint: str) -> EndpointStats:
+        if endpoint not in self._stats:
+            self._stats[endpoint] = EndpointStats(limit=self.limits.get(endpoint))
+        return self._stats[endpoint]
+
+    def _started(self, endpoint: str, queued_at: float, state: dict) -> float:
+        wait = time.perf_counter() - queued_at
+        with self._lock:
+            stats = self._get_stats(endpoint)
+            if not state["dequeued"]:
+                stats.queued -= 1
+                state["dequeued"] = True
+                set_queue_depth(endpoint, stats.queued)
+            stats.running += 1
+            stats.dispatched += 1
+            stats.wait_total += wait
+            stats.wait_last = wait
+            stats.wait_max = max(stats.wait_max, wait)
+        observe_wait(endpoint, wait)
+        return wait
+
+    def _finished(self, endpoint: str) -> None:
+        with self._lock:
+            self._get_stats(endpoint).running -= 1
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(s.queued for s in self._stats.values())
+
+    def stats(self) -> dict[str, EndpointStats]:
+        with self._lock:
+            return {k: v.model_copy() for k, v in self._stats.items()}
+
+    async def run(
+        self, endpoint: str, func: Callable[..., T], *args: Any, **kwargs: Any
+    ) -> T:
+        """
+        Execute `func` within the thread pool, respecting the concurrency limit
+        for the given endpoint.
+        """
+        queued_at = time.perf_counter()
+        state = {"dequeued": False}
+        with self._lock:
+            stats = self._get_stats(endpoint)
+            stats.queued += 1
+            set_queue_depth(endpoint, stats.queued)
+
+        def _run() -> T:
+            wait = self._started(endpoint, queued_at, state)
+            log.debug("Dispatch", endpoint=endpoint, wait=round(wait, 4))
+            profiler = get_profiler()
+            try:
+                if profiler is None:
+                    return func(*args, **kwargs)
+                with profiler.profile(endpoint):
+                    return func(*args, **kwargs)
+            finally:
+                self._finished(endpoint)
+
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()
+        semaphore = self._get_semaphore(endpoint)
+        try:
+            if semaphore is None:
+                return await loop.run_in_executor(self.pool, partial(ctx.run, _run))
+            async with semaphore:
+                return await loop.run_in_executor(self.pool, partial(ctx.run, _run))
+        finally:
+            with self._lock:  # cancelled while waiting
+                if not state["dequeued"]:
+                    stats = self._get_stats(endpoint)
+                    stats.queued -= 1
+                    state["dequeued"] = True
+                    set_queue_depth(endpoint, stats.queued)
+
+    async def iterate(
+        self, endpoint: str, iterable: Iterable[T]
+    ) -> AsyncGenerator[T, None]:
+        """
+        Consume a blocking iterator within the thread pool. The next item is
+        only fetched after the previous one was consumed (backpressure).
+        """
+        iterator = iter(iterable)
+        done = object()
+        try:
+            while True:
+                item = await self.run(endpoint, next, iterator, done)
+                if item is done:
+                    return
+                yield item
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:  # release store connections
+                self.pool.submit(close)
+
+
+@cache
+def get_dispatcher() -> Dispatcher:
+    return Dispatcher(settings.executor.workers, settings.executor.limits)
+
+
+async def dispatch(
+    endpoint: str, func: Callable[..., T], *args: Any, **kwargs: Any
+) -> T:
+    """
+    Run a blocking (store bound) view function off the event loop
+
+    Args:
+        endpoint: Name of the endpoint to apply concurrency limits for
+        func: The (synchronous) view function
+    """
+    return await get_dispatcher().run(endpoint, func, *args, **kwargs)
+
+
+def dispatch_iter(endpoint: str, iterable: Iterable[T]) -> AsyncGenerator[T, None]:
+    """
+    Iterate a blocking (store bound) generator off the event loop
+    """
+    return get_dispatcher().iterate(endpoint, iterable)
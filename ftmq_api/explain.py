@@ -0,0 +1,89 @@
+"""
+Query explain mode
+
+`/entities?explain=1` (only with the `build_api_key`) returns how the api
+runs the query instead of its result: the generated sql (for the entities
+page and the total count), the query plan of the backend (sqlite:
+`EXPLAIN QUERY PLAN`, postgres: `EXPLAIN ANALYZE`, which executes the query)
+and the wall times (ms) of each stage:
+
+- `params`: parse the request parameters
+- `compile`: build the query and compile its sql
+- `entities`: fetch the entities of the page
+- `count`: total count (not cached)
+- `adjacents`: fetch the adjacent entities (with `nested`)
+- `serialize`: render the response
+"""
+
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+
+from ftmq.store.sql import SQLStore
+from sqlalchemy import Select
+
+from ftmq_api.query import Query
+from ftmq_api.store import View
+
+
+class Timings:
+    """
+    Collect wall times (ms) per stage
+    """
+
+    def __init__(self) -> None:
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stages[name] = round(self.stages.get(name, 0) + elapsed, 3)
+
+    @property
+    def total(self) -> float:
+        return round(sum(self.stages.values()), 3)
+
+
+def get_statements(view: View, query: Query) -> dict[str, Select]:
+    """
+    The sql statements of the entities page and the total count (none for
+    non-sql stores)
+    """
+    if not isinstance(view.store, SQLStore):
+        return {}
+    query = view.query.ensure_scoped_query(query)
+    return {"entities": query.sql.statements, "count": query.sql.count}
+
+
+def compile_sql(store: SQLStore, q: Select) -> str:
+    """
+    The sql for the store backend with the parameters inlined
+    """
+    compiled = q.compile(store.engine, compile_kwargs={"literal_binds": True})
+    return str(compiled)
+
+
+def get_plan(store: SQLStore, sql: str) -> list[str]:
+    """
+    The query plan of the backend for the (compiled) sql, one line per step
+    """
+    dialect = store.engine.dialect.name
+    with store.engine.connect() as conn:
+        if dialect == "sqlite":
+            rows = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            # (id, parent, notused, detail): indent by tree depth
+            depths: dict[int, int] = {0: -1}
+            lines: list[str] = []
+            for id_, parent, _, detail in rows:
+                depths[id_] = depths.get(parent, -1) + 1
+                lines.append("  " * depths[id_] + detail)
+            return lines
+        if dialect == "postgresql":
+            rows = conn.exec_driver_sql(f"EXPLAIN ANALYZE {sql}").fetchall()
+        else:
+            rows = conn.exec_driver_sql(f"EXPLAIN {sql}").fetchall()
+        return [" ".join(str(v) for v in row) for row in rows]
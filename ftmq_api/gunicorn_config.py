@@ -0,0 +1,24 @@
+"""
+Gunicorn config for the metrics multiprocess mode (see
+[`ftmq_api.metrics`][ftmq_api.metrics])
+
+    gunicorn ftmq_api.api:app --config python:ftmq_api.gunicorn_config ...
+"""
+
+import os
+import shutil
+
+
+def on_starting(server) -> None:
+    # metrics of previous runs would be aggregated as well
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker) -> None:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,194 @@
+"""
+Index advisor
+
+Property filters (e.g. `?country=de`, `?name__ilike=foo`) and sorting
+(`?order_by=-date`) run against the statement table, where the generic
+indexes (on `prop`, `dataset`, `canonical_id`, ...) still leave the backend
+reading all statements of a property (and casting every value of numeric
+properties for sorting).
+
+The advisor reads recorded requests (same json lines format as for the
+[cache warm-up][ftmq_api.warmup]), parses the entities queries into query
+shapes and recommends indexes for them:
+
+- base (any entities query): `(dataset, canonical_id)`, so the dataset scope
+  of a page is read from the index only
+- filter per property and schema: partial index `(dataset, value,
+  canonical_id)` where `prop = <prop>` (and `schema = <schema>`), so equality
+  and range filters are index seeks and `like` filters only scan the
+  property values of the dataset
+- sort per property: partial index `(canonical_id, <sort key>)` where `prop =
+  <prop>`, with the sort key precomputed as the expression of the sort query
+  (`CAST(value AS NUMERIC)` for numeric properties, the iso value for dates),
+  so the min / max sort value per entity is read from the index. (The sort
+  keys are not precomputed into a separate table, so the matching entities
+  are still sorted by these values per query)
+
+Show (or create) the recommendations via `ftmq-api indexes -r <recorded>`,
+or create the ones for `settings.indexes` once in the deploy step via
+`ftmq-api indexes` (before starting the api workers).
+"""
+
+from collections import Counter
+from collections.abc import Iterable
+from typing import Literal, NamedTuple, cast
+from urllib.parse import urlsplit
+
+from fastapi import HTTPException, Request
+from ftmq.exceptions import ValidationError
+from ftmq.store import Store
+from ftmq.store.sql import SQLStore
+from nomenklatura.statement.db import make_statement_table
+from sqlalchemy import ColumnElement, Index, MetaData, Table, and_, inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from ftmq_api.logging import get_logger
+from ftmq_api.query import Query, ViewQueryParams, get_sort_value
+from ftmq_api.settings import Settings
+from ftmq_api.store import get_store, is_readonly_sqlite
+from ftmq_api.warmup import get_recorded_counts, make_scope
+
+log = get_logger(__name__)
+settings = Settings()
+
+ENTITIES_PATHS = ("/entities", "/entities/stream", "/aggregate")
+PREFIX = "ix_ftmq_api"
+
+
+class Shape(NamedTuple):
+    """
+    A query shape: the dataset scope (`base`), a property filter (per schema)
+    or a sort property
+    """
+
+    kind: Literal["base", "filter", "sort"]
+    prop: str | None = None
+    schema: str | None = None
+
+
+def get_query_shapes(url: str) -> set[Shape]:
+    """
+    The shapes of an entities request url (none for other routes or invalid
+    queries)
+    """
+    if urlsplit(url).path.rstrip("/") not in ENTITIES_PATHS:
+        return set()
+    request = Request(make_scope(url))
+    try:
+        params = ViewQueryParams.from_request(request, authenticated=True)
+        query = Query.from_params(params)
+    except (ValueError, ValidationError, HTTPException) as e:
+        log.warning(f"Invalid recorded query `{url}`: {e}")
+        return set()
+    schema = None
+    if len(query.schemata) == 1:
+        lookup = next(iter(query.schemata))
+        if lookup.comparator == "eq":
+            schema = lookup.value
+    shapes = {Shape("base")}
+    shapes.update(Shape("filter", f.key, schema) for f in query.properties)
+    if query.sort is not None:
+        shapes.update(Shape("sort", prop) for prop in query.sort.values)
+    return shapes
+
+
+def get_shapes(counts: Counter[str], threshold: int = 1) -> Counter[Shape]:
+    """
+    Sum up the request counts per query shape, omit shapes with less than
+    `threshold` requests
+    """
+    shapes: Counter[Shape] = Counter()
+    for url, count in counts.items():
+        for shape in get_query_shapes(url):
+            shapes[shape] += count
+    return Counter({s: c for s, c in shapes.items() if c >= threshold})
+
+
+def get_index(shape: Shape, table: Table) -> Index:
+    c = table.c
+    if shape.kind == "base":
+        return Index(f"{PREFIX}_base", c.dataset, c.canonical_id)
+    assert shape.prop is not None  # filter and sort shapes
+    parts = [PREFIX, shape.kind, shape.prop, shape.schema]
+    name = "_".join(p for p in parts if p).lower()
+    where = c.prop == shape.prop
+    columns: list[ColumnElement]
+    if shape.kind == "filter":
+        if shape.schema is not None:
+            where = and_(where, c.schema == shape.schema)
+        columns = [c.dataset, c.value, c.canonical_id]
+    else:
+        # same expression as the sort query, to read the min / max sort value
+        # per entity from the index
+        columns = [c.canonical_id, get_sort_value(c.value, shape.prop)]
+    return Index(name, *columns, sqlite_where=where, postgresql_where=where)
+
+
+def get_indexes(store: SQLStore, shapes: Iterable[Shape]) -> list[Index]:
+    table = make_statement_table(MetaData(), store.table.name)
+    return [get_index(shape, table) for shape in shapes]
+
+
+def get_existing(store: SQLStore) -> set[str]:
+    """
+    Names of the existing indexes on the statement table
+    """
+    table = store.table.name
+    if store.engine.dialect.name == "sqlite":
+        # reflection skips expression based indexes
+        q = text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+        )
+        with store.engine.connect() as conn:
+            return set(conn.scalars(q, {"table": table}))
+    return {i["name"] for i in inspect(store.engine).get_indexes(table)}
+
+
+def to_sql(index: Index, store: SQLStore) -> str:
+    return str(CreateIndex(index, if_not_exists=True).compile(store.engine)).strip()
+
+
+def create_indexes(store: SQLStore, indexes: Iterable[Index]) -> list[str]:
+    """
+    Create the missing indexes (and update the planner statistics), return
+    the names of the created ones
+    """
+    existing = get_existing(store)
+    missing = [i for i in indexes if i.name not in existing]
+    if not missing:
+        return []
+    with store.engine.begin() as conn:
+        for index in missing:
+            log.info("Creating index", name=index.name, sql=to_sql(index, store))
+            conn.execute(CreateIndex(index, if_not_exists=True))
+        conn.exec_driver_sql(f"ANALYZE {store.table.name}")
+    # indexes from `get_index` are always named
+    return [cast(str, i.name) for i in missing]
+
+
+def get_sql_store(store: Store | None = None) -> SQLStore | None:
+    store = store or get_store()
+    if not isinstance(store, SQLStore):
+        log.warning("Indexes are only supported for sql stores")
+        return None
+    return store
+
+
+def ensure_indexes() -> list[str]:
+    """
+    Create the recommended indexes for the configured recorded requests (if
+    `settings.indexes.create`), return the names of the created ones. Run it
+    once per deploy (`ftmq-api indexes`), not in each api worker.
+    """
+    if not settings.indexes.create or not settings.indexes.recorded:
+        log.warning("No indexes configured (`indexes.create`, `indexes.recorded`)")
+        return []
+    if is_readonly_sqlite():
+        log.warning("Can't create indexes in read-only mode (`sqlite.readonly`)")
+        return []
+    store = get_sql_store()
+    if store is None:
+        return []
+    counts = get_recorded_counts(settings.indexes.recorded)
+    shapes = get_shapes(counts, settings.indexes.threshold)
+    return create_indexes(store, get_indexes(store, shapes))
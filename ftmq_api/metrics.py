@@ -0,0 +1,306 @@
+"""
+Prometheus metrics
+
+With `settings.metrics.enabled`, `/metrics` exposes (Prometheus text format):
+
+- `ftmq_api_request_duration_seconds`: request latency histogram per route
+  (route template, method and status; streaming responses until their last
+  chunk)
+- `ftmq_api_response_size_bytes`: response body size histogram per route (as
+  sent, so after compression)
+- `ftmq_api_cache_requests_total`: cache lookups per view and cache (`local`:
+  the in-process cache, `shared`: the anystore cache) by result (`hit`,
+  `miss`)
+- `ftmq_api_store_duration_seconds`: store query durations histogram per
+  operation (`entities`, `count`, `stats`, `aggregations`, `adjacents`,
+  `similar`)
+- `ftmq_api_executor_queue_depth`: requests waiting for an executor slot per
+  endpoint
+- `ftmq_api_executor_wait_seconds`: histogram of the time requests waited for
+  an executor slot per endpoint
+
+Multiple (gunicorn) workers write their metrics to the shared directory
+`PROMETHEUS_MULTIPROC_DIR`, each scrape aggregates them across the workers.
+The directory has to exist and be emptied before the workers start, use the
+bundled gunicorn config for that (it also removes the gauges of exited
+workers):
+
+    PROMETHEUS_MULTIPROC_DIR=/tmp/ftmq-api-metrics gunicorn ftmq_api.api:app \\
+        --config python:ftmq_api.gunicorn_config ...
+
+Install the optional dependencies via `pip install ftmq-api[metrics]`
+"""
+
+import functools
+import inspect
+import os
+import time
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Generator, Iterator
+from typing import Any, TypeVar
+
+from fastapi import HTTPException
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ftmq_api.settings import Settings
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = multiprocess = None
+
+settings = Settings()
+
+T = TypeVar("T")
+
+METRICS_PATH = "/metrics"
+UNMATCHED = "unmatched"
+SIZE_BUCKETS = tuple(4**i for i in range(4, 14))  # 256 bytes - 64 MiB
+
+if prometheus_client is not None:
+    REQUEST_DURATION = prometheus_client.Histogram(
+        "ftmq_api_request_duration_seconds",
+        "Request latency",
+        ["route", "method", "status"],
+        buckets=settings.metrics.buckets,
+    )
+    RESPONSE_SIZE = prometheus_client.Histogram(
+        "ftmq_api_response_size_bytes",
+        "Response body size",
+        ["route"],
+        buckets=SIZE_BUCKETS,
+    )
+    CACHE_REQUESTS = prometheus_client.Counter(
+        "ftmq_api_cache_requests",
+        "Cache lookups",
+        ["view", "cache", "result"],
+    )
+    STORE_DURATION = prometheus_client.Histogram(
+        "ftmq_api_store_duration_seconds",
+        "Store query duration",
+        ["operation"],
+        buckets=settings.metrics.buckets,
+    )
+    QUEUE_DEPTH = prometheus_client.Gauge(
+        "ftmq_api_executor_queue_depth",
+        "Requests waiting for an executor slot",
+        ["endpoint"],
+        multiprocess_mode="livesum",
+    )
+    EXECUTOR_WAIT = prometheus_client.Histogram(
+        "ftmq_api_executor_wait_seconds",
+        "Time waited for an executor slot",
+        ["endpoint"],
+        buckets=settings.metrics.buckets,
+    )
+
+
+def is_enabled() -> bool:
+    return settings.metrics.enabled and prometheus_client is not None
+
+
+def is_multiprocess() -> bool:
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def observe_request(
+    route: str, method: str, status: int, duration: float, size: int
+) -> None:
+    if is_enabled():
+        REQUEST_DURATION.labels(route, method, str(status)).observe(duration)
+        RESPONSE_SIZE.labels(route).observe(size)
+
+
+def count_cache(view: str, cache: str, hit: bool) -> None:
+    if is_enabled():
+        CACHE_REQUESTS.labels(view, cache, "hit" if hit else "miss").inc()
+
+
+def observe_store(operation: str, duration: float) -> None:
+    if is_enabled():
+        STORE_DURATION.labels(operation).observe(duration)
+
+
+def set_queue_depth(endpoint: str, depth: int) -> None:
+    if is_enabled():
+        QUEUE_DEPTH.labels(endpoint).set(depth)
+
+
+def observe_wait(endpoint: str, wait: float) -> None:
+    if is_enabled():
+        EXECUTOR_WAIT.labels(endpoint).observe(wait)
+
+
+def _timed_iter(operation: str, iterator: Iterator[T]) -> Generator[T, None, None]:
+    # only the time spent in the store, not in the consumer
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            close()
+        observe_store(operation, elapsed)
+
+
+async def _timed_aiter(
+    operation: str, iterator: AsyncIterator[T]
+) -> AsyncGenerator[T, None]:
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        observe_store(operation, elapsed)
+
+
+def timed(operation: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Observe the duration of a store function (for generator functions: the
+    accumulated time of fetching their items) as the given operation. Works
+    for coroutine functions and async generators as well.
+    """
+
+    def _decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            async def _aiterate(*args, **kwargs):
+                if not is_enabled():
+                    async for item in func(*args, **kwargs):
+                        yield item
+                    return
+                async for item in _timed_aiter(operation, func(*args, **kwargs)):
+                    yield item
+
+            return _aiterate
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def _ainner(*args, **kwargs):
+                if not is_enabled():
+                    return await func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe_store(operation, time.perf_counter() - start)
+
+            return _ainner
+
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def _iterate(*args, **kwargs):
+                if not is_enabled():
+                    yield from func(*args, **kwargs)
+                    return
+                yield from _timed_iter(operation, func(*args, **kwargs))
+
+            return _iterate
+
+        @functools.wraps(func)
+        def _inner(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_store(operation, time.perf_counter() - start)
+
+        return _inner
+
+    return _decorator
+
+
+def get_route(scope: Scope) -> str:
+    """
+    The path template of the matching route (e.g. `/entities/{entity_id}`),
+    to keep the label cardinality bounded
+    """
+    app = scope.get("app")
+    for route in getattr(app, "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return UNMATCHED
+
+
+class MetricsMiddleware:
+    """
+    Observe the latency and the (sent) response size per route
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not is_enabled():
+            await self.app(scope, receive, send)
+            return
+        route = get_route(scope)
+        if route == METRICS_PATH:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def _send(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            duration = time.perf_counter() - start
+            observe_request(route, scope["method"], status, duration, size)
+
+
+def render() -> tuple[bytes, str]:
+    """
+    The metrics in the Prometheus text format (aggregated across the workers
+    in multiprocess mode) and their content type
+
+    Raises:
+        HTTPException: Metrics are disabled or `prometheus_client` is not
+            installed
+    """
+    if not settings.metrics.enabled:
+        raise HTTPException(404, ["Metrics are disabled"])
+    if prometheus_client is None:
+        raise HTTPException(501, ["Metrics not available"])
+    if is_multiprocess():
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
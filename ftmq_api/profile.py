@@ -0,0 +1,287 @@
+"""
+On-demand request profiling
+
+Any route can be run under a profiler with `?profile=1` (only with the
+`build_api_key`): the blocking work in the executor (view functions, store
+queries, serialization of the view results) is profiled, caches are bypassed
+(so the profile shows the actual work), and the profile is returned instead of
+the response, or stored at `settings.profile.uri` (and its link is logged and
+returned in the `X-Profile` header).
+
+Formats (`?profile=1` uses `settings.profile.format`):
+
+- `?profile=speedscope`: speedscope json (evented, via `sys.setprofile`),
+  open it at [speedscope.app](https://www.speedscope.app)
+- `?profile=pstats`: `cProfile` stats, e.g. `snakeviz <file>` or
+  `pstats.Stats(<file>)`. (On python >= 3.12, `cProfile` records all threads,
+  so concurrent requests are included)
+
+Only one request per worker is profiled at a time.
+"""
+
+import cProfile
+import json
+import marshal
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from types import FrameType
+from typing import Any
+from urllib.parse import parse_qsl, quote, urlencode
+
+from anystore.store import get_store
+from fastapi.responses import JSONResponse, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from ftmq_api import __version__
+from ftmq_api.logging import get_logger
+from ftmq_api.query import is_authenticated
+from ftmq_api.settings import Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+PARAM = "profile"
+PSTATS = "pstats"
+SPEEDSCOPE = "speedscope"
+EXTENSIONS = {PSTATS: "prof", SPEEDSCOPE: "speedscope.json"}
+MEDIA_TYPES = {PSTATS: "application/octet-stream", SPEEDSCOPE: "application/json"}
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+_profiler: ContextVar["Profiler | None"] = ContextVar("profiler", default=None)
+_lock = threading.Lock()
+
+
+def get_profiler() -> "Profiler | None":
+    """
+    The profiler of the current request, if it is profiled
+    """
+    return _profiler.get()
+
+
+def is_profiling() -> bool:
+    return get_profiler() is not None
+
+
+def get_format(value: str) -> str | None:
+    """
+    The profile format for the `profile` query parameter (None to not profile)
+
+    Raises:
+        ValueError: Unknown format
+    """
+    value = value.lower()
+    if value in ("", "0", "false"):
+        return None
+    if value in ("1", "true"):
+        return settings.profile.format
+    if value in EXTENSIONS:
+        return value
+    raise ValueError(f"Invalid profile format: `{value}`")
+
+
+class Profiler:
+    """
+    Profile the (sequential) executor work of one request, possibly on
+    different executor threads
+    """
+
+    def __init__(self, name: str, format: str) -> None:
+        self.name = name
+        self.format = format
+        self.start = time.perf_counter()
+        self._profile = cProfile.Profile() if format == PSTATS else None
+        self._frames: dict[tuple[str, str, int], int] = {}
+        self._events: list[dict[str, Any]] = []
+        self._stack: list[int] = []
+        self._floor = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}.{EXTENSIONS[self.format]}"
+
+    @contextmanager
+    def profile(self, name: str) -> Generator[None, None, None]:
+        """
+        Profile the work within this context in the current thread, as `name`
+        (speedscope: a frame for each executor call, e.g. each chunk of a
+        stream)
+        """
+        if self._profile is not None:
+            self._profile.enable()
+            try:
+                yield
+            finally:
+                self._profile.disable()
+            return
+        self._open((name, "<executor>", 0))
+        self._floor = len(self._stack)
+        sys.setprofile(self._trace)
+        try:
+            yield
+        finally:
+            sys.setprofile(None)
+            self._floor = 0
+            while self._stack:
+                self._close()
+
+    def _open(self, frame: tuple[str, str, int]) -> None:
+        index = self._frames.setdefault(frame, len(self._frames))
+        self._stack.append(index)
+        self._events.append({"type": "O", "frame": index, "at": self._now()})
+
+    def _close(self) -> None:
+        # ignore frames that were entered before profiling
+        if len(self._stack) > self._floor:
+            index = self._stack.pop()
+            self._events.append({"type": "C", "frame": index, "at": self._now()})
+
+    def _now(self) -> float:
+        return time.perf_counter() - self.start
+
+    def _trace(self, frame: FrameType, event: str, arg: Any) -> None:
+        if event == "call":
+            code = frame.f_code
+            self._open((code.co_qualname, code.co_filename, code.co_firstlineno))
+        elif event == "c_call":
+            self._open((getattr(arg, "__qualname__", repr(arg)), "<builtin>", 0))
+        elif event in ("return", "c_return", "c_exception"):
+            self._close()
+
+    def dump(self) -> bytes:
+        if self._profile is not None:
+            self._profile.create_stats()
+            return marshal.dumps(self._profile.stats)  # as `dump_stats`
+        frames = [{"name": n, "file": f, "line": i} for n, f, i in self._frames]
+        end = self._events[-1]["at"] if self._events else 0
+        data = {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.name,
+            "exporter": f"ftmq-api@{__version__}",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "evented",
+                    "name": self.name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": end,
+                    "events": self._events,
+                }
+            ],
+        }
+        return json.dumps(data).encode()
+
+
+def get_link(key: str) -> str:
+    if settings.profile.url:
+        return f"{settings.profile.url.rstrip('/')}/{key}"
+    return get_store(uri=settings.profile.uri).get_key(key)
+
+
+def store_profile(profiler: Profiler) -> None:
+    store = get_store(uri=settings.profile.uri)
+    store.put(profiler.key, profiler.dump(), serialization_mode="raw")
+
+
+class ProfileMiddleware:
+    """
+    Run requests with `?profile=<format>` (and a valid `api_key`) under a
+    profiler (the parameter is removed from the request)
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or PARAM.encode() not in scope["query_string"]:
+            await self.app(scope, receive, send)
+            return
+        params = parse_qsl(scope["query_string"].decode(), keep_blank_values=True)
+        values = [v for k, v in params if k == PARAM]
+        if not values:
+            await self.app(scope, receive, send)
+            return
+        scope = {
+            **scope,
+            "query_string": urlencode([p for p in params if p[0] != PARAM]).encode(),
+        }
+        try:
+            format = get_format(values[0])
+        except ValueError as e:
+            await JSONResponse({"detail": [str(e)]}, 400)(scope, receive, send)
+            return
+        if format is None:
+            await self.app(scope, receive, send)
+            return
+        if not is_authenticated(dict(params).get("api_key")):
+            detail = ["`profile` requires a valid `api_key`"]
+            await JSONResponse({"detail": detail}, 403)(scope, receive, send)
+            return
+        if not _lock.acquire(blocking=False):
+            detail = ["Another request is being profiled, try again later"]
+            await JSONResponse({"detail": detail}, 429)(scope, receive, send)
+            return
+        try:
+            await self.profile(scope, receive, send, format)
+        finally:
+            _lock.release()
+
+    async def profile(
+        self, scope: Scope, receive: Receive, send: Send, format: str
+    ) -> None:
+        now = datetime.now(timezone.utc)
+        name = f"{now:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        profiler = Profiler(name, format)
+        link = get_link(profiler.key) if settings.profile.uri else None
+        status = 500
+
+        async def _send(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if link is not None:
+                    MutableHeaders(scope=message)["X-Profile"] = link
+            if link is not None:  # return the response, store the profile
+                await send(message)
+
+        token = _profiler.set(profiler)
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _profiler.reset(token)
+        duration = round(time.perf_counter() - profiler.start, 4)
+        if link is None:
+            log.info("Profile", path=scope["path"], status=status, duration=duration)
+            response = Response(
+                profiler.dump(),
+                media_type=MEDIA_TYPES[format],
+                headers={
+                    "Content-Disposition": f'attachment; filename="{profiler.key}"'
+                },
+            )
+            await response(scope, receive, send)
+            return
+        await run_in_threadpool(store_profile, profiler)
+        log.info(
+            "Profile",
+            path=scope["path"],
+            status=status,
+            duration=duration,
+            link=link,
+            **get_viewer_link(profiler, link),
+        )
+
+
+def get_viewer_link(profiler: Profiler, link: str) -> dict[str, str]:
+    if profiler.format == SPEEDSCOPE and link.startswith(("http://", "https://")):
+        viewer = f"https://www.speedscope.app/#profileURL={quote(link, safe='')}"
+        return {"viewer": viewer}
+    return {}
@@ -1,12 +1,36 @@
+import base64
+import json
+import secrets
+from decimal import Decimal
+from enum import StrEnum
+from functools import cached_property
 from typing import Annotated, Any, Self
 
+from anystore.util import make_data_checksum
 from banal import clean_dict
+from fastapi import HTTPException
 from fastapi import Query as FastQuery
 from fastapi import Request
+from followthemoney.types import registry
 from ftmq.aggregations import Aggregator
+from ftmq.enums import PropertyTypesMap
 from ftmq.query import Query as _Query
-from ftmq.types import Schemata
-from pydantic import BaseModel, ConfigDict, Field
+from ftmq.query import Sort
+from ftmq.sql import Sql as _Sql
+from ftmq.types import CE, Schemata
+from ftmq.util import to_numeric
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from sqlalchemy import (
+    NUMERIC,
+    ColumnElement,
+    Select,
+    Table,
+    and_,
+    desc,
+    func,
+    or_,
+    select,
+)
 
 from ftmq_api.settings import Settings
 from ftmq_api.store import Datasets
@@ -15,11 +39,12 @@ settings = Settings()
 
 
 class RetrieveParams(BaseModel):
-    nested: bool
-    featured: bool
-    dehydrate: bool
-    dehydrate_nested: bool
-    stats: bool
+    nested: bool = False
+    featured: bool = False
+    dehydrate: bool = False
+    dehydrate_nested: bool = True
+    depth: int = 1
+    stats: bool = False
 
 
 class AggregationParams(BaseModel):
@@ -65,18 +90,111 @@ class QueryParams(BaseQueryParams):
     reverse: str | None = Field(None, examples=["eu-id-1234"])
 
 
+class Cursor(BaseModel):
+    """
+    Keyset pagination position: the last entity id of the previous page and
+    (for sorted queries) its sort value
+    """
+
+    id: str
+    value: str | int | float | None = None
+
+    def encode(self) -> str:
+        data = self.model_dump_json(exclude_none=True).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str) -> Self:
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            return cls.model_validate_json(data)
+        except (ValueError, ValidationError):
+            raise ValueError(f"Invalid cursor: `{cursor}`")
+
+    @classmethod
+    def from_value(cls, entity_id: str, value: Any) -> Self:
+        """
+        Cursor for the sort value as returned by `select_sort_value`
+        """
+        if isinstance(value, Decimal):  # numeric cast
+            value = int(value) if value == value.to_integral_value() else float(value)
+        return cls(id=entity_id, value=value)
+
+    @classmethod
+    def from_proxy(cls, proxy: CE, sort: Sort | None = None) -> Self:
+        """
+        Cursor for non-sql stores, the sort value is computed from the proxy
+        """
+        if sort is None:
+            return cls(id=proxy.id)
+        # same as the sql sort value: min (asc) or max (desc) of the values
+        prop = sort.values[0]
+        values = proxy.get(prop, quiet=True)
+        if PropertyTypesMap[prop].value == registry.number:
+            values = [to_numeric(v) or 0 for v in values]
+        if not values:
+            return cls(id=proxy.id)
+        value = min(values) if sort.ascending else max(values)
+        return cls(id=proxy.id, value=value)
+
+
+class Formats(StrEnum):
+    json = "json"
+    ndjson = "ndjson"
+    arrow = "arrow"
+    parquet = "parquet"
+
+
+class EntitiesQueryParams(QueryParams):
+    format: Annotated[
+        Formats,
+        FastQuery(
+            description="Response format: `ndjson` streams all matching entities, "
+            "one per line (same as `/entities/stream`), `arrow` (IPC stream) and "
+            "`parquet` stream them as a statement table"
+        ),
+    ] = Formats.json
+    cursor: Annotated[
+        str | None,
+        FastQuery(
+            description="Keyset pagination cursor as returned in `next_url` "
+            "(used instead of `page`)"
+        ),
+    ] = None
+    explain: Annotated[
+        bool,
+        FastQuery(
+            description="Return the sql, query plan and timings instead of the "
+            "entities (requires `api_key`)"
+        ),
+    ] = False
+
+
 META_FIELDS = (
     set(AggregationParams.model_fields)
     | set(RetrieveParams.model_fields)  # noqa: W503
-    | set(QueryParams.model_fields)  # noqa: W503
+    | set(EntitiesQueryParams.model_fields)  # noqa: W503
 )
 
 LISTISH_PARAMS = ["dataset", *AggregationParams.model_fields.keys()]
+SEARCH_LISTISH_PARAMS = ["dataset", "country"]
+BATCH_ORDERED_PARAMS = ["id"]  # the response follows the requested order
+SECRET_PARAMS = {"api_key"}
+PARAM_DEFAULTS = {"format": Formats.json.value}
+
+
+def is_authenticated(api_key: str | None = None) -> bool:
+    if not api_key:
+        return False
+    return secrets.compare_digest(api_key, settings.build_api_key)
 
 
 class ViewQueryParams(QueryParams):
     model_config = ConfigDict(populate_by_name=True, extra="allow")
 
+    cursor: str | None = Field(None, exclude=True)
+    format: str | None = Field(None, exclude=True)
+
     def __init__(self, **data):
         data.pop("api_key", None)
         super().__init__(**data)
@@ -104,10 +222,142 @@ class ViewQueryParams(QueryParams):
         return Aggregator.from_dict(data)
 
 
+def get_sort_value(value: ColumnElement, prop: str) -> ColumnElement:
+    """
+    The sort key of a property value, same as in the `ftmq` sort query:
+    numeric values are cast, dates (iso strings) and any other values sort as
+    they are
+    """
+    if PropertyTypesMap[prop].value == registry.number:
+        return func.cast(value, NUMERIC)
+    return value
+
+
+def get_entity_sort_value(table: Table, sort: Sort) -> ColumnElement:
+    """
+    The sort value of an entity (grouped by canonical id): min (asc) or max
+    (desc) of its values of the first sort property
+    """
+    group_func = func.min if sort.ascending else func.max
+    return group_func(get_sort_value(table.c.value, sort.values[0]))
+
+
+def select_sort_value(table: Table, entity_id: str, sort: Sort) -> Select:
+    """
+    The sort value of the given (canonical) entity id, to create the cursor
+    for the next page from the same sql expression as the keyset comparison
+    """
+    return (
+        select(get_entity_sort_value(table, sort))
+        .where(table.c.canonical_id == entity_id)
+        .where(table.c.prop == sort.values[0])
+    )
+
+
+class Sql(_Sql):
+    """
+    Add keyset pagination to the `ftmq` sql compiler: instead of an OFFSET,
+    the page starts after the (sort value, canonical id) of the cursor.
+    """
+
+    @cached_property
+    def canonical_ids(self) -> Select:
+        if self.q.sort is not None or self.q.limit is None:
+            return super().canonical_ids
+        # order by id to get stable pages (and to allow index seeks)
+        q = select(self.table.c.canonical_id.distinct()).where(self.clause)
+        if self.q.cursor is not None:
+            q = q.where(self.table.c.canonical_id > self.q.cursor.id)
+        return (
+            q.order_by(self.table.c.canonical_id)
+            .limit(self.q.limit)
+            .offset(self.q.offset)
+        )
+
+    @cached_property
+    def all_canonical_ids(self) -> Select:
+        return select(self.table.c.canonical_id.distinct()).where(self.clause)
+
+    @cached_property
+    def _sorted_statements(self) -> Select:
+        if self.q.cursor is None or len(self.q.sort.values) > 1:
+            return super()._sorted_statements
+        after = self.q.cursor
+        if after.value is None:
+            raise HTTPException(400, ["Cursor without sort value for sorted query"])
+        prop = self.q.sort.values[0]
+        sortable_value = get_entity_sort_value(self.table, self.q.sort)
+        if self.q.sort.ascending:
+            keyset = sortable_value > after.value
+        else:
+            keyset = sortable_value < after.value
+        keyset = or_(
+            keyset,
+            and_(sortable_value == after.value, self.table.c.canonical_id > after.id),
+        )
+        order_by: list[Any] = [
+            "sortable_value" if self.q.sort.ascending else desc("sortable_value"),
+            self.table.c.canonical_id,
+        ]
+        inner = (
+            select(self.table.c.canonical_id, sortable_value.label("sortable_value"))
+            .where(
+                and_(
+                    self.table.c.prop == prop,
+                    self.table.c.canonical_id.in_(self.canonical_ids),
+                )
+            )
+            .group_by(self.table.c.canonical_id)
+            .having(keyset)
+            .order_by(*order_by)
+            .limit(self.q.limit)
+        )
+        return select(
+            self.table.join(inner, self.table.c.canonical_id == inner.c.canonical_id)
+        ).order_by(*order_by)
+
+
 class Query(_Query):
+    def __init__(self, *args, cursor: Cursor | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cursor = cursor
+
+    @property
+    def sql(self) -> Sql:
+        return Sql(self)
+
+    def to_dict(self) -> dict[str, Any]:
+        data = super().to_dict()
+        if self.cursor is not None:
+            data["cursor"] = self.cursor.encode()
+        return data
+
+    @property
+    def filter_key(self) -> str:
+        """
+        Checksum of the filter criteria only (without slicing, sorting and
+        cursor), e.g. to share the total count across all pages of a query
+        """
+        data = json.dumps(self.lookups, sort_keys=True, default=sorted)
+        return make_data_checksum(data)
+
+    def after(self, cursor: Cursor) -> Self:
+        """
+        Start the page after the given cursor (keyset pagination)
+        """
+        return self._chain(cursor=cursor)
+
     @classmethod
     def from_params(cls, params: ViewQueryParams) -> Self:
-        q = cls()[(params.page - 1) * params.limit : params.page * params.limit]
+        if params.cursor:
+            # keyset pagination: `page` is ignored
+            try:
+                cursor = Cursor.decode(params.cursor)
+            except ValueError as e:
+                raise HTTPException(400, [str(e)])
+            q = cls(cursor=cursor)[0 : params.limit]
+        else:
+            q = cls()[(params.page - 1) * params.limit : params.page * params.limit]
         if params.dataset:
             q = q.where(dataset__in=params.dataset)
         if params.schema_:
@@ -154,7 +404,7 @@ class SearchQueryParams(BaseQueryParams):
     def from_request(cls, request: Request, authenticated: bool | None = False) -> Self:
         params = dict(request.query_params)
         # listish params
-        for p in ("dataset", "country"):
+        for p in SEARCH_LISTISH_PARAMS:
             listish = request.query_params.getlist(p)
             if listish:
                 params[p] = listish
@@ -181,3 +431,51 @@ class SearchQuery(_Query):
         if params.q:
             q = q.search(params.q)
         return q
+
+
+def get_query_fingerprint(request: Request, authenticated: bool | None = False) -> str:
+    """
+    Canonical checksum of the request query: Parameters are parsed (via
+    `ViewQueryParams` or `SearchQueryParams` and `RetrieveParams`), defaults
+    and secrets are removed and list parameters are sorted, so that
+    equivalent query strings share the same fingerprint. Batch ids are only
+    de-duplicated, as their order is the order of the response.
+
+    Raises:
+        ValidationError: Invalid query parameters
+    """
+    params = request.query_params
+    ordered: list[str] = []
+    model: type[ViewQueryParams] | type[SearchQueryParams]
+    if request.url.path.rstrip("/").endswith("/search"):
+        model, listish = SearchQueryParams, SEARCH_LISTISH_PARAMS
+    elif request.url.path.rstrip("/").endswith("/entities/batch"):
+        model, listish = ViewQueryParams, LISTISH_PARAMS
+        ordered = BATCH_ORDERED_PARAMS
+    else:
+        model, listish = ViewQueryParams, LISTISH_PARAMS
+    query = model.from_request(request, authenticated)
+    fields = {k for k, f in model.model_fields.items() if not f.exclude}
+    data: dict[str, Any] = query.model_dump(
+        include=fields, exclude_defaults=True, mode="json"
+    )
+    retrieve = RetrieveParams.model_validate(
+        {k: params[k] for k in RetrieveParams.model_fields if k in params}
+    )
+    data.update(retrieve.model_dump(exclude_defaults=True))
+    known = fields | {f.alias for f in model.model_fields.values() if f.alias}
+    for key in params:
+        if key in known or key in RetrieveParams.model_fields or key in SECRET_PARAMS:
+            continue
+        if key in ordered:
+            data[key] = list(dict.fromkeys(params.getlist(key)))
+        elif key in listish:
+            data[key] = sorted(set(params.getlist(key)))
+        elif params[key] != PARAM_DEFAULTS.get(key):
+            data[key] = params[key]  # same as `dict(params)`: last value wins
+    for key in listish:
+        if isinstance(data.get(key), list):
+            data[key] = sorted(set(data[key]))
+    if authenticated:
+        data["authenticated"] = True
+    return make_data_checksum(json.dumps(data, sort_keys=True))
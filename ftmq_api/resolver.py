@@ -0,0 +1,163 @@
+"""
+In-memory canonical id resolver
+
+`nomenklatura` resolves canonical ids (and referents) by traversing the
+judgement graph, which requires the full resolver (all edges) in memory and
+a sql round trip on each (re)load. The api only needs the positive
+judgements: At boot, they are flattened into a compact index (entity id ->
+canonical id and canonical id -> referents, interned strings), so a lookup is
+one dict access and ids that were never merged (the vast majority) return
+immediately.
+
+The index is reloaded when the resolver version (see
+[`versions`][ftmq_api.versions]) changes, which is only checked with
+`settings.data_version_refresh > 0`. With the default (0), the index stays as
+of boot until the process restarts.
+
+In the read-only sqlite mode (`settings.sqlite.readonly`), the resolver table
+is not created and has to exist.
+"""
+
+import sys
+import threading
+import time
+from functools import cache, lru_cache
+
+from nomenklatura.db import get_engine
+from nomenklatura.resolver import Resolver
+from nomenklatura.resolver.identifier import Identifier, StrIdent
+from sqlalchemy import Engine, MetaData, column, table
+from sqlalchemy.sql.expression import TableClause
+
+from ftmq_api.logging import get_logger
+from ftmq_api.settings import Settings
+
+log = get_logger(__name__)
+settings = Settings()
+
+Index = tuple[dict[str, str], dict[str, tuple[str, ...]]]
+
+RESOLVER_TABLE = "resolver"  # nomenklatura default
+
+
+def make_resolver_table(name: str = RESOLVER_TABLE) -> TableClause:
+    """
+    The columns of a resolver table used by the api (versions, similar
+    entities)
+    """
+    return table(
+        name,
+        column("id"),
+        column("target"),
+        column("source"),
+        column("judgement"),
+        column("score"),
+        column("created_at"),
+        column("deleted_at"),
+    )
+
+
+def get_id(ident: StrIdent) -> str:
+    if isinstance(ident, Identifier):
+        return ident.id
+    return ident
+
+
+class MemoryResolver(Resolver):
+    """
+    Same as `nomenklatura.resolver.Resolver` (e.g. for similar entities via
+    the judgements table), but canonical ids and referents are looked up in
+    the in-memory index of positive judgements.
+    """
+
+    def __init__(
+        self,
+        engine: Engine,
+        metadata: MetaData,
+        create: bool = False,
+        table_name: str = RESOLVER_TABLE,
+    ) -> None:
+        super().__init__(engine, metadata, create=create, table_name=table_name)
+        self.engine = engine
+        self.table = make_resolver_table(table_name)
+        self._index: Index = {}, {}
+        self._lock = threading.Lock()
+        self.loaded_at: float | None = None
+
+    def load_index(self) -> None:
+        """
+        (Re)build the index from the positive judgements within one query
+        """
+        with self._lock:
+            canonicals: dict[str, str] = {}
+            referents: dict[str, tuple[str, ...]] = {}
+            linker = self.get_linker()
+            for canonical in linker.canonicals():
+                canonical_id = sys.intern(canonical.id)
+                ids = sorted(sys.intern(i) for i in linker.get_referents(canonical))
+                referents[canonical_id] = tuple(ids)
+                for i in ids:
+                    canonicals[i] = canonical_id
+            self._index = canonicals, referents  # swap at once
+            self.connected.cache_clear()
+            self.get_canonical.cache_clear()
+            self.loaded_at = time.monotonic()
+            log.info(
+                "Resolver index", canonicals=len(referents), referents=len(canonicals)
+            )
+
+    def _invalidate(self) -> None:
+        # lookups don't use the edges loaded within a transaction
+        pass
+
+    # same as the base resolver (which is a process-wide instance)
+    @lru_cache(maxsize=200000)  # noqa: B019
+    def connected(self, node: Identifier) -> set[Identifier]:
+        canonicals, referents = self._index
+        canonical_id = canonicals.get(node.id, node.id)
+        if canonical_id not in referents:
+            return {node}
+        ids = (canonical_id, *referents[canonical_id])
+        return {Identifier.get(i) for i in ids}
+
+    @lru_cache(maxsize=200000)  # noqa: B019
+    def get_canonical(self, entity_id: StrIdent) -> str:
+        entity_id = get_id(entity_id)
+        return self._index[0].get(entity_id, entity_id)
+
+    def get_referents(
+        self, canonical_id: StrIdent, canonicals: bool = True
+    ) -> set[str]:
+        index, clusters = self._index
+        entity_id = get_id(canonical_id)
+        cluster_id = index.get(entity_id, entity_id)
+        if cluster_id not in clusters:
+            return set()
+        ids = {cluster_id, *clusters[cluster_id]} - {entity_id}
+        if canonicals:
+            return ids
+        return {i for i in ids if not Identifier.get(i).canonical}
+
+
+@cache
+def get_resolver() -> MemoryResolver:
+    engine = get_engine()
+    readonly = settings.sqlite.readonly and engine.dialect.name == "sqlite"
+    resolver = MemoryResolver(engine, MetaData(), create=not readonly)
+    resolver.load_index()
+    return resolver
+
+
+@cache
+def get_default_engine() -> Engine:
+    return get_engine()
+
+
+def get_resolver_table(linker: Resolver) -> tuple[Engine, TableClause]:
+    """
+    The engine and table of a resolver: the ones of the in-memory resolver, or
+    nomenklatura's defaults (as used by the `ftmq` stores)
+    """
+    if isinstance(linker, MemoryResolver):
+        return linker.engine, linker.table
+    return get_default_engine(), make_resolver_table()
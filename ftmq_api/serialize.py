@@ -4,25 +4,138 @@ https://github.com/opensanctions/yente/
 """
 
 from collections import defaultdict
-from collections.abc import Iterable
+from collections.abc import Iterable, Mapping, Sequence
 from typing import Any, Self, Union
 
 from banal import clean_dict
-from fastapi import Request
+from fastapi import Request, Response
+from fastapi.responses import RedirectResponse
 from followthemoney.types import registry
 from ftmq.aggregations import AggregatorResult
 from ftmq.model import DatasetStats
 from ftmq.types import CE, CEGenerator
+from ftmq.util import get_dehydrated_proxy
 from ftmq_search.model import AutocompleteResult
 from furl import furl
 from pydantic import BaseModel, ConfigDict, Field
+from starlette.datastructures import MutableHeaders
 
-from ftmq_api.query import ViewQueryParams
+from ftmq_api.compression import (
+    compress,
+    decompress,
+    get_encodings,
+    is_compressible,
+    negotiate,
+)
+from ftmq_api.query import Cursor, ViewQueryParams
+from ftmq_api.settings import Settings
+
+settings = Settings()
 
 EntityProperties = dict[str, list[Union[str, "EntityResponse"]]]
+AdjacencyIndex = Mapping[str, "EntityResponse"]
 Aggregations = dict[str, dict[str, Any]]
 
 
+class ModelResponse(Response):
+    """
+    Render a response model straight to json bytes via its (pydantic-core)
+    serializer, without the re-validation FastAPI applies to `response_model`
+    return values. The output is the same as the default `JSONResponse`.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content: BaseModel) -> bytes:
+        return content.__pydantic_serializer__.to_json(content, by_alias=True)
+
+
+class Redirect(BaseModel):
+    """
+    A redirect (e.g. to a merged entity) as plain data, so that cached
+    redirects are rendered to a new response for each request
+    """
+
+    url: str
+    status_code: int = 307
+    headers: dict[str, str] = {}
+
+    def to_response(self) -> RedirectResponse:
+        return RedirectResponse(
+            self.url, status_code=self.status_code, headers=self.headers
+        )
+
+
+def to_response(result: BaseModel | Response) -> Response:
+    if isinstance(result, Response):
+        return result
+    if isinstance(result, Redirect):
+        return result.to_response()
+    return ModelResponse(result)
+
+
+class CachedResponse(BaseModel):
+    """
+    A rendered response for the response cache: status, headers and the body
+    (compressed with the preferred encoding if larger than
+    `settings.compression.size`)
+    """
+
+    status_code: int
+    headers: dict[str, str] = {}
+    encoding: str | None = None
+    body: bytes = Field(b"", exclude=True)
+
+    @classmethod
+    def from_response(cls, response: Response) -> Self:
+        body = bytes(response.body)
+        encoding = None
+        encodings = get_encodings()
+        if (
+            encodings
+            and is_compressible(response.headers.get("content-type"))  # noqa: W503
+            and len(body) >= settings.compression.size  # noqa: W503
+        ):
+            encoding = encodings[0]
+            body = compress(body, encoding)
+        # conditional request headers are set per request
+        headers = {
+            k: v
+            for k, v in response.headers.items()
+            if k not in ("content-length", "etag", "last-modified", "cache-control")
+        }
+        return cls(
+            status_code=response.status_code,
+            headers=headers,
+            encoding=encoding,
+            body=body,
+        )
+
+    def to_response(self, accept_encoding: str | None = None) -> Response:
+        """
+        Serve the compressed body as it is if the client accepts its encoding
+        """
+        headers = MutableHeaders(headers=self.headers)
+        body = self.body
+        if self.encoding is not None:
+            headers.add_vary_header("Accept-Encoding")
+            if settings.compression.enabled and negotiate(
+                accept_encoding, [self.encoding]
+            ):
+                headers["Content-Encoding"] = self.encoding
+            else:
+                body = decompress(body, self.encoding)
+        return Response(body, status_code=self.status_code, headers=dict(headers))
+
+    def dump(self) -> bytes:
+        return self.model_dump_json().encode() + b"\n" + self.body
+
+    @classmethod
+    def load(cls, data: bytes) -> Self:
+        header, body = data.split(b"\n", 1)
+        return cls.model_validate_json(header).model_copy(update={"body": body})
+
+
 class ErrorResponse(BaseModel):
     detail: str = Field(..., example="Detailed error message")
 
@@ -38,28 +151,130 @@ class EntityResponse(BaseModel):
     referents: list[str] = Field([], example=["ofac-1234"])
 
     @classmethod
-    def from_entity(cls, entity: CE, adjacents: Iterable[CE] | None = None) -> Self:
+    def from_entity(
+        cls,
+        entity: CE,
+        adjacents: Iterable[CE] | AdjacencyIndex | None = None,
+        inverted: Iterable[tuple[str, "EntityResponse"]] | None = None,
+    ) -> Self:
+        """
+        Optionally inline the given adjacent entities. For multiple entities,
+        pass an index (see `make_index`) to build the nested entities only once.
+        Entities referencing this entity (`inverted`) are inlined as the
+        reverse property, e.g. `Person:membershipMember`.
+        """
         properties = dict(entity.properties)
         if adjacents:
-            adjacents = {e.id: EntityResponse.from_entity(e) for e in adjacents}
+            if not isinstance(adjacents, Mapping):
+                adjacents = cls.make_index(adjacents)
             for prop in entity.iterprops():
                 if prop.type == registry.entity:
                     properties[prop.name] = [
                         adjacents.get(i, i) for i in entity.get(prop)
                     ]
-        return cls(
+        for prop, adjacent in inverted or []:
+            properties[prop] = [*properties.get(prop, []), adjacent]
+        # proxies are already clean, skip validation
+        return cls.model_construct(
             id=entity.id,
             caption=entity.caption,
-            schema=entity.schema.name,
+            schema_=entity.schema.name,
             properties=properties,
             datasets=list(entity.datasets),
             referents=list(entity.referents),
         )
 
+    @classmethod
+    def make_index(cls, adjacents: Iterable[CE] | None = None) -> AdjacencyIndex:
+        """
+        Response-scoped index of nested entities by id, shared by all entities
+        of a response
+        """
+        return {e.id: cls.from_entity(e) for e in adjacents or []}
+
+    @classmethod
+    def from_levels(
+        cls,
+        entities: Iterable[CE],
+        levels: Sequence[Iterable[CE]] | None = None,
+        inverted: bool | None = False,
+        dehydrate: bool | None = False,
+    ) -> list[Self]:
+        """
+        Build the entities with their adjacent entities nested per level (see
+        [`View.get_nested`][ftmq_api.store.View.get_nested]), starting at the
+        deepest level so that each nested entity is built only once.
+        Optionally inline entities of the next level that reference an entity
+        as its reverse property, and dehydrate the entities of the deepest
+        level (inner levels keep their properties to reference the next one).
+        """
+        levels = [list(entities), *[list(level) for level in levels or []]]
+        index: AdjacencyIndex = {}
+        children: list[CE] = []
+        for depth, parents in reversed(list(enumerate(levels))):
+            reverse: dict[str, list[tuple[str, EntityResponse]]] = defaultdict(list)
+            if inverted:
+                ids = {i: e.id for e in parents for i in (e.id, *e.referents)}
+                for child in children:
+                    for prop, value in child.itervalues():
+                        if (
+                            prop.type == registry.entity
+                            and prop.reverse is not None  # noqa: W503
+                            and value in ids  # noqa: W503
+                        ):
+                            reverse[ids[value]].append(
+                                (prop.reverse.name, index[child.id])
+                            )
+            proxies = parents
+            if dehydrate and depth and depth == len(levels) - 1:
+                proxies = [get_dehydrated_proxy(e) for e in parents]
+            index = {
+                e.id: cls.from_entity(e, index, reverse.get(e.id)) for e in proxies
+            }
+            children = parents
+        return [index[e.id] for e in levels[0]]
+
 
 EntityResponse.model_rebuild()
 
 
+class EntitiesBatchResponse(BaseModel):
+    entities: dict[str, EntityResponse] = Field(
+        ..., description="Entities by id (the canonical id for merged entities)"
+    )
+    merged: dict[str, str] = Field(
+        {},
+        description="Requested ids that were merged into another entity, "
+        "mapped to the new entity id",
+    )
+    missing: list[str] = Field([], description="Requested ids that were not found")
+
+    @classmethod
+    def from_view(
+        cls,
+        entity_ids: Iterable[str],
+        entities: Mapping[str, CE],
+        adjacents: Sequence[Iterable[CE]] | None = None,
+        inverted: bool | None = False,
+        dehydrate: bool | None = False,
+    ) -> Self:
+        proxies = {e.id: e for e in entities.values()}
+        responses = EntityResponse.from_levels(
+            proxies.values(), adjacents, inverted=inverted, dehydrate=dehydrate
+        )
+        merged: dict[str, str] = {}
+        missing: list[str] = []
+        for entity_id in entity_ids:
+            proxy = entities.get(entity_id)
+            if proxy is None:
+                missing.append(entity_id)
+            elif proxy.id != entity_id:
+                merged[entity_id] = proxy.id
+        return cls.model_construct(
+            entities={r.id: r for r in responses}, merged=merged, missing=missing
+        )
+
+
 class EntitiesResponse(BaseModel):
     total: int
     items: int
@@ -76,16 +291,19 @@ class EntitiesResponse(BaseModel):
         request: Request,
         entities: CEGenerator,
         stats: DatasetStats | None = None,
-        adjacents: Iterable[CE] | None = None,
+        adjacents: Sequence[Iterable[CE]] | None = None,
         authenticated: bool | None = False,
         count: int = 0,
+        cursor: Cursor | None = None,
     ) -> Self:
         query = ViewQueryParams.from_request(request, authenticated)
         url = furl(str(request.url))
+        if not authenticated:  # don't echo (invalid) keys in cached responses
+            url.args.pop("api_key", None)
         query_data = clean_dict(query.model_dump())
         query_data.pop("schema_", None)
         url.args.update(query_data)
-        entities = [EntityResponse.from_entity(e, adjacents) for e in entities]
+        entities = EntityResponse.from_levels(entities, adjacents)
         count = stats.entity_count if stats else count
         response = cls(
             total=count,
@@ -95,6 +313,14 @@ class EntitiesResponse(BaseModel):
             stats=stats,
             url=str(url),
         )
+        if "page" not in request.query_params and (cursor or query.cursor):
+            # keyset pagination, unless the client explicitly pages by number
+            if cursor is not None:
+                url.args.pop("page", None)
+                url.args["cursor"] = cursor.encode()
+                response.next_url = str(url)
+            return response
+        url.args.pop("cursor", None)
         if query.page > 1:
             url.args["page"] = query.page - 1
             response.prev_url = str(url)
@@ -121,6 +347,8 @@ class AggregationResponse(BaseModel):
     ) -> Self:
         query = ViewQueryParams.from_request(request, authenticated)
         url = furl(str(request.url))
+        if not authenticated:  # don't echo (invalid) keys in cached responses
+            url.args.pop("api_key", None)
         query_data = clean_dict(query.model_dump())
         query_data.pop("schema_", None)
         url.args.update(query_data)
@@ -140,5 +368,20 @@ class AggregationResponse(BaseModel):
         )
 
 
+class ExplainQuery(BaseModel):
+    sql: str = Field(..., description="Compiled sql (parameters inlined)")
+    plan: list[str] = Field([], description="Query plan of the backend")
+
+
+class ExplainResponse(BaseModel):
+    query: dict[str, Any] = Field(..., description="The parsed `ftmq` query")
+    queries: dict[str, ExplainQuery] = Field(
+        {}, description="Sql and query plan for the entities page and the count"
+    )
+    timings: dict[str, float] = Field(..., description="Wall time (ms) per stage")
+    total: int
+    items: int
+
+
 class AutocompleteResponse(BaseModel):
     candidates: list[AutocompleteResult]
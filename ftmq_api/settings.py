@@ -45,6 +45,132 @@ class ApiInfo(BaseModel):
     description_uri: str | None = None
 
 
+class ExecutorSettings(BaseModel):
+    workers: int = 8
+    """Size of the thread pool that runs blocking store work"""
+
+    limits: dict[str, int] = {
+        "catalog": 2,
+        "entities": 4,
+        "aggregate": 2,
+        "search": 4,
+        "autocomplete": 4,
+        "similar": 2,
+    }
+    """Max concurrent requests per endpoint (endpoints not listed are only
+    limited by the pool size)"""
+
+
+class LocalCacheSettings(BaseModel):
+    enabled: bool = True
+    """Activate the in-process cache (only if `use_cache` is active)"""
+
+    items: int = 1000
+    """Max number of entries per worker"""
+
+    size: int = 64 * 1024 * 1024
+    """Max (approximate) total size in bytes per worker"""
+
+    ttl: int = 60
+    """Default ttl (seconds), 0 to disable"""
+
+    ttls: dict[str, int] = {
+        "get_count": 300,
+        "dataset_list": 300,
+        "dataset_detail": 300,
+        "entity_list": 60,
+        "entity_detail": 60,
+        "entity_batch": 60,
+        "aggregation": 300,
+        "search": 60,
+        "autocomplete": 300,
+        "similar": 60,
+        "cached_response": 60,
+    }
+    """Ttl (seconds) per view function, 0 to disable"""
+
+
+class CompressionSettings(BaseModel):
+    enabled: bool = True
+    """Compress responses for clients that accept it (`Accept-Encoding`)"""
+
+    encodings: list[str] = ["zstd", "br", "gzip"]
+    """Encodings in order of preference (`zstd` and `br` only if the
+    `compression` extra is installed)"""
+
+    size: int = 1024
+    """Min body size (bytes) to compress (streaming responses are always
+    compressed)"""
+
+    levels: dict[str, int] = {"zstd": 3, "br": 4, "gzip": 6}
+    """Compression level per encoding"""
+
+
+class SqliteSettings(BaseModel):
+    readonly: bool = False
+    """Serve a sqlite store read-only (`mode=ro`) with tuned connections
+    (below), pooled per executor thread"""
+
+    immutable: bool = False
+    """Open the database file as `immutable` (no locking and change
+    detection at all, only if the file never changes while the api runs)"""
+
+    mmap: int = 256 * 1024 * 1024
+    """`mmap_size` (bytes) per connection, 0 to disable memory mapping"""
+
+    cache: int = 64 * 1024
+    """`cache_size` (KiB) per connection"""
+
+    temp: str = "memory"
+    """`temp_store` for temporary b-trees (sorting, distinct, ...)"""
+
+
+class IndexSettings(BaseModel):
+    recorded: str | None = None
+    """Recorded requests (json lines, see `ftmq-api warmup`) to derive the
+    recommended indexes from"""
+
+    create: bool = False
+    """Create the recommended indexes via `ftmq-api indexes` (without `-r`, run
+    it once before starting the api workers)"""
+
+    threshold: int = 1
+    """Min number of recorded requests per query shape"""
+
+
+class MetricsSettings(BaseModel):
+    enabled: bool = False
+    """Expose prometheus metrics at `/metrics` (requires the `metrics` extra,
+    set `PROMETHEUS_MULTIPROC_DIR` for multiple workers)"""
+
+    buckets: list[float] = [
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+    ]
+    """Histogram buckets (seconds) for request and store query durations"""
+
+
+class ProfileSettings(BaseModel):
+    format: str = "speedscope"
+    """Default format for `?profile=1`: `speedscope` or `pstats`"""
+
+    uri: str | None = None
+    """Store profiles here (anystore uri) instead of returning them"""
+
+    url: str | None = None
+    """Public base url of the stored profiles for the logged links"""
+
+
 class Settings(BaseSettings):
     """
     `anystore` settings management using
@@ -69,6 +195,29 @@ class Settings(BaseSettings):
     store_uri: str = DB_URL
     """ftmq store uri"""
 
+    stats_uri: str | None = None
+    """Uri for the precomputed dataset statistics (json, see `ftmq-api stats`),
+    default: in the system temp directory"""
+
+    stats_refresh: int = 0
+    """Interval (seconds) to refresh dataset statistics in the background, 0 to
+    disable"""
+
+    async_store: bool = False
+    """Run the entity list, entity detail and aggregation views on the native
+    asyncio store view (sql stores only, requires the `async` extra)"""
+
+    memory_resolver: bool = True
+    """Resolve canonical ids via an in-memory index of the resolver table
+    (built at boot and reloaded when the resolver data version changes, which
+    requires `data_version_refresh > 0`: otherwise merges made after boot are
+    only picked up by restarting the process)"""
+
+    data_version_refresh: int = 0
+    """Interval (seconds) to re-compute the data version tokens used in cache
+    keys (and to reload the in-memory resolver on changes) in a background
+    thread, 0 to only compute them at boot"""
+
     build_api_key: str = "secret-key-for-build"
     """Backend api key to use for build process (higher limit)"""
 
@@ -83,11 +232,66 @@ class Settings(BaseSettings):
     )
     """Api cache (via anystore)"""
 
+    coalesce: bool = True
+    """Coalesce concurrent cache misses for the same request (only if
+    `use_cache` is active)"""
+
+    coalesce_timeout: int = 30
+    """Max seconds to wait for an in-flight request"""
+
+    http_cache: bool = True
+    """Set `ETag`, `Last-Modified` and `Cache-Control` headers and handle
+    conditional requests (`If-None-Match`)"""
+
+    cache_control: str = "public, max-age=60"
+    """`Cache-Control` header for public responses"""
+
+    cache_responses: bool = False
+    """Cache the rendered responses (body, status and headers, stored
+    compressed) instead of the response models (only if `use_cache` is
+    active)"""
+
+    local_cache: LocalCacheSettings = LocalCacheSettings()
+    """In-process cache in front of the api cache"""
+
+    compression: CompressionSettings = CompressionSettings()
+    """Response compression"""
+
     allowed_origin: list[str] = ["http://localhost:3000"]
     """Allowed origins"""
 
     default_limit: int = 100
     """Default public pagination limit"""
 
+    stream_chunk_size: int = 100
+    """Number of entities per chunk for streaming (ndjson) responses"""
+
+    record_batch_size: int = 1000
+    """Number of entities per record batch for arrow and parquet responses"""
+
+    batch_limit: int = 100
+    """Max number of ids per batch lookup (`/entities/batch`)"""
+
+    nested_max_depth: int = 3
+    """Max levels of adjacent entities to inline (`?nested=true&depth=n`)"""
+
+    nested_limit: int = 100
+    """Max number of inlined adjacent entities per level"""
+
+    sqlite: SqliteSettings = SqliteSettings()
+    """Read-only serving mode for sqlite stores"""
+
+    indexes: IndexSettings = IndexSettings()
+    """Recommended indexes for recorded query shapes (sql stores only)"""
+
+    metrics: MetricsSettings = MetricsSettings()
+    """Prometheus metrics"""
+
+    profile: ProfileSettings = ProfileSettings()
+    """On-demand request profiling (`?profile=1` with `build_api_key`)"""
+
     info: ApiInfo = ApiInfo()
     """Rendered information on redoc page"""
+
+    executor: ExecutorSettings = ExecutorSettings()
+    """Thread pool for blocking store work"""
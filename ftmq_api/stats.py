@@ -0,0 +1,193 @@
+"""
+Precomputed dataset statistics
+
+Computing `DatasetStats` requires full scans of the store, so they are
+materialized once into a json snapshot (`settings.stats_uri`, default: in the
+system temp directory) and served from memory afterwards. Precompute the
+snapshot via `ftmq-api stats` before starting the api workers, otherwise the
+first worker that needs it computes it while holding a file lock and the
+other workers wait for it and read the result. Optionally, the snapshot is
+refreshed in a background thread. A persisted snapshot is re-computed if the
+data versions (see [`ftmq_api.versions`][ftmq_api.versions]) have changed.
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import cache
+from urllib.parse import urlparse
+
+from anystore.io import smart_read, smart_write
+from anystore.util import make_data_checksum
+from ftmq.model import DatasetStats
+from pydantic import BaseModel, ValidationError
+
+from ftmq_api.logging import get_logger
+from ftmq_api.settings import Settings
+from ftmq_api.store import get_catalog, get_store
+from ftmq_api.versions import get_versions
+
+log = get_logger(__name__)
+settings = Settings()
+
+
+class StatsSnapshot(BaseModel):
+    created_at: datetime
+    datasets: dict[str, DatasetStats] = {}
+    versions: dict[str, str] = {}
+    """Data version tokens at the time of computing"""
+
+
+def get_stats_uri() -> str:
+    """
+    The configured snapshot uri or a json file in the system temp directory
+    (per store)
+    """
+    if settings.stats_uri:
+        return settings.stats_uri
+    name = f"{make_data_checksum(settings.store_uri)}.stats.json"
+    return os.path.join(tempfile.gettempdir(), "ftmq-api", name)
+
+
+@contextmanager
+def snapshot_lock(uri: str | None) -> Generator[None, None, None]:
+    """
+    Exclusive lock across workers for computing the snapshot at a local `uri`
+    (remote snapshots are not locked)
+    """
+    parsed = urlparse(uri or "")
+    if uri is None or parsed.scheme not in ("", "file"):
+        yield
+        return
+    path = parsed.path if parsed.scheme else uri
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def compute_snapshot() -> StatsSnapshot:
+    datasets: dict[str, DatasetStats] = {}
+    for dataset in get_catalog().datasets:
+        log.info(f"Computing statistics for `{dataset.name}` ...")
+        # use a fresh query view, as views cache their stats forever
+        datasets[dataset.name] = get_store(dataset.name).query().stats()
+    return StatsSnapshot(
+        created_at=datetime.now(),
+        datasets=datasets,
+        versions=get_versions().get_datasets(),
+    )
+
+
+def read_snapshot(uri: str) -> StatsSnapshot | None:
+    try:
+        return StatsSnapshot.model_validate_json(smart_read(uri))
+    except FileNotFoundError:
+        return None
+    except ValidationError as e:  # e.g. currently written by another worker
+        log.warning(f"Invalid statistics snapshot `{uri}`: {e}")
+        return None
+
+
+def write_snapshot(snapshot: StatsSnapshot, uri: str) -> None:
+    log.info(f"Writing statistics snapshot to `{uri}` ...")
+    try:
+        smart_write(uri, snapshot.model_dump_json().encode())
+    except OSError as e:  # e.g. read-only data volume
+        log.warning(f"Could not write statistics snapshot `{uri}`: {e}")
+
+
+class Stats:
+    def __init__(self, uri: str | None = None, refresh: int | None = 0) -> None:
+        self.uri = uri
+        self.refresh = refresh or 0
+        self.snapshot: StatsSnapshot | None = None
+        # computed on demand for datasets that are not in the snapshot
+        self.fallbacks: dict[str, DatasetStats] = {}
+        self._lock = threading.RLock()
+        self._thread: threading.Thread | None = None
+
+    def is_stale(self, snapshot: StatsSnapshot) -> bool:
+        if snapshot.versions != get_versions().get_datasets():  # data has changed
+            return True
+        if not self.refresh:
+            return False
+        return snapshot.created_at < datetime.now() - timedelta(seconds=self.refresh)
+
+    def load(self, force: bool | None = False) -> StatsSnapshot:
+        """
+        Load the persisted snapshot, (re-)compute it if it is missing, stale or
+        if `force`
+        """
+        with self._lock:
+            snapshot = None
+            if self.uri is not None and not force:
+                snapshot = read_snapshot(self.uri)
+            if force or snapshot is None or self.is_stale(snapshot):
+                with snapshot_lock(self.uri):
+                    # another worker might have computed it meanwhile
+                    if self.uri is not None and not force:
+                        snapshot = read_snapshot(self.uri)
+                    if force or snapshot is None or self.is_stale(snapshot):
+                        snapshot = compute_snapshot()
+                        if self.uri is not None:
+                            write_snapshot(snapshot, self.uri)
+            if snapshot is not self.snapshot:
+                self.fallbacks = {}
+            self.snapshot = snapshot
+            return snapshot
+
+    def init(self) -> StatsSnapshot:
+        with self._lock:
+            snapshot = self.snapshot
+            if snapshot is None:
+                snapshot = self.load()
+                self.start()
+            return snapshot
+
+    def get(self, dataset: str) -> DatasetStats:
+        snapshot = self.init()
+        with self._lock:
+            if dataset in snapshot.datasets:
+                return snapshot.datasets[dataset]
+            # dataset not in catalog at snapshot time
+            if dataset not in self.fallbacks:
+                self.fallbacks[dataset] = get_store(dataset).query().stats()
+            return self.fallbacks[dataset]
+
+    def start(self) -> None:
+        """
+        Start the background refresh (if configured). Another worker might have
+        refreshed the persisted snapshot already, so it is only re-computed if
+        it is stale.
+        """
+        if not self.refresh or self._thread is not None:
+            return
+
+        def _refresh() -> None:
+            while True:
+                time.sleep(self.refresh)
+                try:
+                    self.load()
+                except Exception as e:
+                    log.error(f"Statistics refresh failed: {e}")
+
+        self._thread = threading.Thread(target=_refresh, daemon=True)
+        self._thread.start()
+
+
+@cache
+def get_stats() -> Stats:
+    return Stats(get_stats_uri(), settings.stats_refresh)
+
+
+def get_dataset_stats(dataset: str) -> DatasetStats:
+    return get_stats().get(dataset)
@@ -1,15 +1,27 @@
+import os
+import sqlite3
+from collections.abc import Iterable
 from functools import cache
-from typing import TYPE_CHECKING, Literal, TypeAlias
+from typing import TYPE_CHECKING, Any, Literal, TypeAlias
+from urllib.parse import quote, urlencode
 
 from fastapi import HTTPException
+from followthemoney.types import registry
 from ftmq.model import Catalog, Dataset
 from ftmq.query import Q
 from ftmq.store import Store
 from ftmq.store import get_store as _get_store
+from ftmq.store.sql import SQLStore
 from ftmq.types import CE, CEGenerator
 from ftmq.util import get_dehydrated_proxy, get_featured_proxy
+from nomenklatura.db import get_metadata
+from nomenklatura.statement import Statement
+from sqlalchemy import Table, make_url, select
+from sqlalchemy.sql.selectable import Select
 
 from ftmq_api.logging import get_logger
+from ftmq_api.metrics import timed
+from ftmq_api.resolver import get_resolver
 from ftmq_api.settings import Settings
 
 if TYPE_CHECKING:
@@ -35,61 +47,317 @@ def get_dataset(name: str) -> Dataset:
     return dataset
 
 
+def is_readonly_sqlite(uri: str | None = None) -> bool:
+    uri = uri or settings.store_uri
+    return settings.sqlite.readonly and make_url(uri).get_backend_name() == "sqlite"
+
+
+def get_sqlite_engine_kwargs(uri: str | None = None) -> dict[str, Any]:
+    """
+    Engine arguments for the read-only sqlite mode: connections open the
+    database file with `mode=ro` (and `immutable=1`) and the configured
+    `mmap_size`, `cache_size` and `temp_store`. The pool keeps one connection
+    per executor thread (plus overflow for long running streams) that can be
+    used from any thread (a stream is resumed on different executor threads).
+    """
+    uri = uri or settings.store_uri
+    path = make_url(uri).database
+    if not path or path == ":memory:":
+        raise ValueError(f"Read-only sqlite mode requires a database file: `{uri}`")
+    params = {"mode": "ro"}
+    if settings.sqlite.immutable:
+        params["immutable"] = "1"
+    file_uri = f"file:{quote(os.path.abspath(path))}?{urlencode(params)}"
+    pragmas = {
+        "mmap_size": settings.sqlite.mmap,
+        "cache_size": -settings.sqlite.cache,
+        "temp_store": settings.sqlite.temp,
+        "query_only": "ON",
+    }
+
+    def connect() -> sqlite3.Connection:
+        conn = sqlite3.connect(file_uri, uri=True, check_same_thread=False)
+        for key, value in pragmas.items():
+            conn.execute(f"PRAGMA {key} = {value}")
+        return conn
+
+    return {
+        "creator": connect,
+        "pool_size": settings.executor.workers,
+        "max_overflow": settings.executor.workers,
+        "pool_reset_on_return": None,  # nothing to roll back
+    }
+
+
+def get_readonly_store(uri: str | None = None, **kwargs: Any) -> SQLStore:
+    """
+    A sql store on read-only, tuned sqlite connections (see
+    `get_sqlite_engine_kwargs`)
+    """
+    uri = uri or settings.store_uri
+    get_metadata.cache_clear()  # same as `ftmq.store.get_store`
+    return SQLStore(uri=uri, **kwargs, **get_sqlite_engine_kwargs(uri))
+
+
 @cache
 def get_store(dataset: str | None = None) -> Store:
     catalog = get_catalog()
+    linker = get_resolver() if settings.memory_resolver else None
+    kwargs: dict[str, Any] = {"catalog": catalog, "linker": linker}
     if dataset is not None:
-        dataset = get_dataset(dataset)
-        store = _get_store(catalog=catalog, dataset=dataset, uri=settings.store_uri)
-    else:
-        store = _get_store(catalog=catalog, uri=settings.store_uri)
-    return store
+        kwargs["dataset"] = get_dataset(dataset)
+    if is_readonly_sqlite():
+        return get_readonly_store(**kwargs)
+    return _get_store(uri=settings.store_uri, **kwargs)
+
+
+def retrieve_entity(proxy: CE, params: "RetrieveParams") -> CE:
+    if params.dehydrate:
+        return get_dehydrated_proxy(proxy)
+    if params.featured:
+        return get_featured_proxy(proxy)
+    return proxy
 
 
 def retrieve_entities(entities: CEGenerator, params: "RetrieveParams") -> CEGenerator:
     for proxy in entities:
-        if params.dehydrate:
-            proxy = get_dehydrated_proxy(proxy)
-        elif params.featured:
-            proxy = get_featured_proxy(proxy)
-        yield proxy
+        yield retrieve_entity(proxy, params)
+
+
+def select_entities(
+    table: Table, ids: Iterable[str] | Select, datasets: Iterable[str]
+) -> Select:
+    """
+    Statements of the entities with the given canonical ids (or subquery),
+    grouped by canonical id
+    """
+    return (
+        select(table)
+        .where(table.c.canonical_id.in_(ids))
+        .where(table.c.dataset.in_(datasets))
+        .order_by(table.c.canonical_id)
+    )
+
+
+def select_inverted(
+    table: Table,
+    ids: Iterable[str],
+    datasets: Iterable[str],
+    limit: int,
+    exclude: Iterable[str],
+) -> Select:
+    """
+    Statements of (max `limit`) entities referencing any of the given ids
+    """
+    referencing = (
+        select(table.c.canonical_id)
+        .where(table.c.prop_type == registry.entity.name)
+        .where(table.c.value.in_(ids))
+        .where(table.c.dataset.in_(datasets))
+        .where(table.c.canonical_id.not_in(exclude))
+        .distinct()
+        .order_by(table.c.canonical_id)
+        .limit(limit)
+    )
+    return select_entities(table, referencing, datasets)
+
+
+class Nesting:
+    """
+    Level by level expansion of adjacent entities (see `View.get_nested`), the
+    lookups for each level are done by the view
+    """
+
+    def __init__(
+        self, entities: Iterable[CE], depth: int | None = 1, limit: int | None = None
+    ) -> None:
+        self.depth = min(depth or 1, settings.nested_max_depth)
+        self.limit = limit or settings.nested_limit
+        self.parents = list(entities)
+        self.visited = {i for e in self.parents for i in (e.id, *e.referents)}
+        self.levels: list[list[CE]] = []
+
+    @property
+    def referenced(self) -> list[str]:
+        """Not yet visited ids referenced by the previous level"""
+        ids = [
+            value
+            for e in self.parents
+            for prop, value in e.itervalues()
+            if prop.type == registry.entity and value not in self.visited
+        ]
+        return list(dict.fromkeys(ids))[: self.limit]
+
+    @property
+    def referencing(self) -> list[str]:
+        """Ids to look up referencing entities for (inverted)"""
+        return [i for e in self.parents for i in (e.id, *e.referents)]
+
+    def add(self, level: Iterable[CE]) -> bool:
+        """
+        Add the entities of the next level (deduplicated and capped), returns
+        False if there are no new entities
+        """
+        seen = set()
+        parents = []
+        for proxy in level:
+            if proxy.id not in self.visited and proxy.id not in seen:
+                seen.add(proxy.id)
+                parents.append(proxy)
+        self.parents = parents[: self.limit]
+        if not self.parents:
+            return False
+        self.visited.update(i for e in self.parents for i in (e.id, *e.referents))
+        self.levels.append(self.parents)
+        return True
 
 
 class View:
     def __init__(
         self,
         dataset: str | None = None,
+        store: Store | None = None,
     ) -> None:
-        self.store = get_store(dataset)
+        self.store = store or get_store(dataset)
         self.dataset = dataset
         self.query = self.store.query()
         self.view = self.store.default_view()
 
-        self.stats = self.query.stats
-        self.count = self.query.count
-        self.aggregations = self.query.aggregations
-        self.get_adjacents = self.query.get_adjacents
+        self.stats = timed("stats")(self.query.stats)
+        self.count = timed("count")(self.query.count)
+        self.aggregations = timed("aggregations")(self.query.aggregations)
+        self.get_adjacents = timed("adjacents")(self.query.get_adjacents)
 
+    @timed("entities")
     def get_entity(self, entity_id: str, params: "RetrieveParams") -> CE:
         canonical = self.store.linker.get_canonical(entity_id)
         proxy = self.view.get_entity(canonical)
-        if proxy is None:
+        if proxy is None and canonical != entity_id:
             # try to get original one FIXME
             proxy = self.view.get_entity(entity_id)
-            if proxy is None:
-                raise HTTPException(404, detail=[f"Entity `{entity_id}` not found."])
-        if params.dehydrate:
-            return get_dehydrated_proxy(proxy)
-        if params.featured:
-            return get_featured_proxy(proxy)
-        return proxy
+        if proxy is None:
+            raise HTTPException(404, detail=[f"Entity `{entity_id}` not found."])
+        return retrieve_entity(proxy, params)
 
+    @timed("entities")
+    def get_entities_batch(
+        self, entity_ids: Iterable[str], params: "RetrieveParams"
+    ) -> dict[str, CE]:
+        """
+        Resolve the given entity ids in one linker pass and fetch them within
+        one query. The entities are keyed by the requested id (merged entities
+        are returned with their canonical id), unknown ids are omitted.
+        """
+        linker = self.store.linker
+        canonicals = {i: linker.get_canonical(i) for i in entity_ids}
+        entities = {
+            e.id: e
+            for e in self.get_entities_by_id({*canonicals, *canonicals.values()})
+        }
+        result: dict[str, CE] = {}
+        for entity_id, canonical in canonicals.items():
+            # as `get_entity`: fall back to the entity stored under the
+            # requested id if its canonical one doesn't exist (yet)
+            proxy = entities.get(canonical) or entities.get(entity_id)
+            if proxy is not None:
+                result[entity_id] = retrieve_entity(proxy, params)
+        return result
+
+    @timed("entities")
     def get_entities(self, query: Q, params: "RetrieveParams") -> CEGenerator:
         yield from retrieve_entities(self.query.entities(query), params)
 
+    @timed("similar")
     def similar(self, entity_id: str, params: "RetrieveParams") -> CEGenerator:
         yield from retrieve_entities(self.query.similar(entity_id), params)
 
+    def _iterate(self, q: Select) -> CEGenerator:
+        # group by canonical id (the store groups by the original entity id)
+        current_id = None
+        statements: list[Statement] = []
+        with self.store.engine.connect() as conn:
+            rows = conn.execute(q).fetchall()
+        for row in rows:
+            stmt = Statement.from_db_row(row)
+            if current_id is not None and current_id != stmt.canonical_id:
+                proxy = self.store.assemble(statements)
+                if proxy is not None:
+                    yield proxy
+                statements = []
+            current_id = stmt.canonical_id
+            statements.append(stmt)
+        if statements:
+            proxy = self.store.assemble(statements)
+            if proxy is not None:
+                yield proxy
+
+    def get_entities_by_id(self, ids: Iterable[str]) -> list[CE]:
+        """
+        Get the entities for the given (canonical) ids within one query
+        """
+        ids = set(ids)
+        if not ids:
+            return []
+        if not isinstance(self.store, SQLStore):
+            return [e for e in map(self.view.get_entity, ids) if e is not None]
+        q = select_entities(self.store.table, ids, self.query.dataset_names)
+        return list(self._iterate(q))
+
+    def get_inverted(
+        self, ids: Iterable[str], limit: int, exclude: Iterable[str] | None = None
+    ) -> list[CE]:
+        """
+        Get (max `limit`) entities referencing any of the given ids within one
+        query, excluding the given ids in `exclude`
+        """
+        ids = set(ids)
+        exclude = set(exclude or [])
+        if not ids:
+            return []
+        if not isinstance(self.store, SQLStore):
+            entities = {
+                e.id: e
+                for i in ids
+                for _, e in self.view.get_inverted(i)
+                if e.id not in exclude
+            }
+            return list(entities.values())[:limit]
+        q = select_inverted(
+            self.store.table, ids, self.query.dataset_names, limit, exclude
+        )
+        return list(self._iterate(q))
+
+    @timed("adjacents")
+    def get_nested(
+        self,
+        entities: Iterable[CE],
+        depth: int | None = 1,
+        inverted: bool | None = False,
+        limit: int | None = None,
+    ) -> list[list[CE]]:
+        """
+        Expand the adjacent entities of the given entities up to `depth` levels
+        deep with one batched lookup per level (plus one for the entities
+        referencing the previous level if `inverted`). Each entity is only
+        included at the first level it is seen at, and each level is capped at
+        `limit` (default: `settings.nested_limit`) entities.
+
+        Returns:
+            The adjacent entities per level
+        """
+        nesting = Nesting(entities, depth, limit)
+        for _ in range(nesting.depth):
+            level = self.get_entities_by_id(nesting.referenced)
+            if inverted:
+                level.extend(
+                    self.get_inverted(
+                        nesting.referencing, nesting.limit, exclude=nesting.visited
+                    )
+                )
+            if not nesting.add(level):
+                break
+        return nesting.levels
+
 
 @cache
 def get_view(dataset: str | None = None) -> View:
@@ -0,0 +1,151 @@
+"""
+Data generation tokens
+
+Each dataset gets a version token derived from its statements (count and
+latest `first_seen` / `last_seen`), and the resolver (merged entities) gets
+one from its judgements. These tokens are part of the cache keys, so
+re-ingesting data invalidates exactly the affected datasets' cache entries
+(and any change of the resolver invalidates all of them and reloads the
+in-memory resolver index), which allows long cache ttls.
+
+Tokens are computed at boot and optionally re-computed every
+`settings.data_version_refresh` seconds in a background thread (computing them
+scans the statement table, so requests never wait for a refresh). For non-sql
+stores, tokens are static (the cache needs to be flushed after updating the
+data).
+"""
+
+import threading
+import time
+from collections.abc import Iterable
+from functools import cache
+
+from anystore.util import make_data_checksum
+from ftmq.store.sql import SQLStore
+from nomenklatura.resolver import Resolver
+from sqlalchemy import func, select
+
+from ftmq_api.logging import get_logger
+from ftmq_api.resolver import MemoryResolver, get_resolver_table
+from ftmq_api.settings import Settings
+from ftmq_api.store import get_store
+
+log = get_logger(__name__)
+settings = Settings()
+
+STATIC = "static"
+
+
+def compute_versions() -> tuple[dict[str, str], str]:
+    """
+    Get the version tokens per dataset and for the resolver
+    """
+    store = get_store()
+    if not isinstance(store, SQLStore):
+        return {}, STATIC
+    datasets: dict[str, str] = {}
+    t = store.table
+    q = select(
+        t.c.dataset,
+        func.count(t.c.id),
+        func.max(t.c.first_seen),
+        func.max(t.c.last_seen),
+    ).group_by(t.c.dataset)
+    with store.engine.connect() as conn:
+        for dataset, *data in conn.execute(q):
+            datasets[dataset] = make_data_checksum([str(v) for v in data])
+    resolver = STATIC
+    linker = store.linker
+    if isinstance(linker, Resolver):
+        engine, t = get_resolver_table(linker)
+        q = select(
+            func.count(t.c.id), func.max(t.c.created_at), func.max(t.c.deleted_at)
+        )
+        with engine.connect() as conn:
+            data = conn.execute(q).one()
+        resolver = make_data_checksum([str(v) for v in data])
+    return datasets, resolver
+
+
+class DataVersions:
+    def __init__(self, refresh: int | None = 0) -> None:
+        self.refresh = refresh or 0
+        self.datasets: dict[str, str] = {}
+        self.resolver = STATIC
+        self.loaded_at: float | None = None
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def load(self) -> None:
+        with self._lock:
+            self._load()
+
+    def _load(self) -> None:
+        datasets, resolver = compute_versions()
+        if self.loaded_at is not None and resolver != self.resolver:
+            # reload before the new tokens are used in cache keys (only one
+            # reload at a time, as this runs within the lock)
+            linker = get_store().linker
+            if isinstance(linker, MemoryResolver):
+                linker.load_index()
+        self.datasets, self.resolver = datasets, resolver
+        self.loaded_at = time.monotonic()
+        log.info("Data versions", resolver=self.resolver, **self.datasets)
+
+    def ensure(self) -> None:
+        """
+        Load the tokens (once, the first request waits for it) and start the
+        background refresh
+        """
+        if self.loaded_at is None:
+            with self._lock:
+                # another request might have loaded them meanwhile
+                if self.loaded_at is None:
+                    self._load()
+            self.start()
+
+    def get_datasets(self) -> dict[str, str]:
+        """
+        The version tokens per dataset (loaded if needed)
+        """
+        self.ensure()
+        return self.datasets
+
+    def get(self, datasets: Iterable[str] | None = None) -> str:
+        """
+        Combined version token for the given datasets (default: all datasets)
+        """
+        self.ensure()
+        if datasets is None:
+            versions = self.datasets
+        else:
+            versions = {d: self.datasets.get(d, STATIC) for d in datasets}
+        return make_data_checksum([self.resolver, *sorted(versions.items())])
+
+    def start(self) -> None:
+        """
+        Start the background refresh (if configured)
+        """
+        with self._lock:
+            if not self.refresh or self._thread is not None:
+                return
+
+            def _refresh() -> None:
+                while True:
+                    time.sleep(self.refresh)
+                    try:
+                        self.load()
+                    except Exception as e:
+                        log.error(f"Data versions refresh failed: {e}")
+
+            self._thread = threading.Thread(target=_refresh, daemon=True)
+            self._thread.start()
+
+
+@cache
+def get_versions() -> DataVersions:
+    return DataVersions(settings.data_version_refresh)
+
+
+def get_data_version(datasets: Iterable[str] | None = None) -> str:
+    return get_versions().get(datasets)
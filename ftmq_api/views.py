@@ -1,49 +1,154 @@
-from collections.abc import Iterable
-from functools import cache
+from collections.abc import Callable, Generator
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any
 
-from anystore.decorators import anycache
-from anystore.store import BaseStore, get_store
 from anystore.util import make_data_checksum
+from banal import chunked_iter
 from fastapi import HTTPException
 from fastapi import Query as QueryField
-from fastapi import Request
-from fastapi.responses import RedirectResponse
+from fastapi import Request, Response
 from ftmq.model import Catalog, Dataset
-from ftmq.types import CE
-from ftmq.util import get_dehydrated_proxy
+from ftmq.store.sql import SQLStore
+from ftmq.types import CE, CEGenerator
 from ftmq_search.store import get_store as get_search_store
 from furl import furl
+from pydantic import ValidationError
 
+from ftmq_api import arrow
+from ftmq_api.cache import anycache, get_cache, local_cache
+from ftmq_api.explain import Timings, compile_sql, get_plan, get_statements
+from ftmq_api.profile import is_profiling
 from ftmq_api.query import (
     AggregationParams,
+    Cursor,
+    Formats,
     Query,
     RetrieveParams,
     SearchQuery,
     SearchQueryParams,
     ViewQueryParams,
+    get_query_fingerprint,
+    is_authenticated,
+    select_sort_value,
 )
 from ftmq_api.serialize import (
     AggregationResponse,
     AutocompleteResponse,
+    CachedResponse,
+    EntitiesBatchResponse,
     EntitiesResponse,
     EntityResponse,
+    ExplainQuery,
+    ExplainResponse,
+    Redirect,
+    to_response,
 )
 from ftmq_api.settings import Settings
-from ftmq_api.store import get_catalog, get_dataset, get_view
+from ftmq_api.stats import get_dataset_stats
+from ftmq_api.store import View, get_catalog, get_dataset, get_view
+from ftmq_api.versions import get_data_version
 
 settings = Settings()
 
 
-def get_cache_key(request: Request, *args, **kwargs) -> str | None:
-    if not settings.use_cache:
+def get_request_datasets(request: Request) -> list[str]:
+    if "dataset" in request.path_params:
+        return [request.path_params["dataset"]]
+    return request.query_params.getlist("dataset")
+
+
+def get_request_key(request: Request) -> str | None:
+    """
+    Canonical identifier of the response for this request: host, path, data
+    version and query fingerprint (None for invalid query parameters)
+    """
+    authenticated = is_authenticated(request.query_params.get("api_key"))
+    try:
+        fingerprint = get_query_fingerprint(request, authenticated)
+    except ValidationError:  # let the view raise the error
         return None
+    version = get_data_version(get_request_datasets(request) or None)
     f = furl(str(request.url))
-    return f"{f.host}{f.path}/{make_data_checksum(f.querystr)}"
+    return f"{f.host}{f.path}/{version}/{fingerprint}"
+
+
+def get_cache_key(request: Request, *args, **kwargs) -> str | None:
+    if not settings.use_cache or settings.cache_responses or is_profiling():
+        return None
+    return get_request_key(request)
+
+
+def get_response_cache_key(request: Request, *args, **kwargs) -> str | None:
+    if not settings.use_cache or not settings.cache_responses or is_profiling():
+        return None
+    key = get_request_key(request)
+    if key is None:
+        return None
+    return f"response/{key}"
+
+
+def get_last_modified(request: Request) -> datetime | None:
+    catalog = get_catalog()
+    datasets = get_request_datasets(request)
+    if not datasets:
+        return catalog.updated_at
+    dates = [d.updated_at for d in catalog.datasets if d.name in datasets]
+    if None in dates or not dates:
+        return None
+    return max(dates)
+
+
+def is_conditional(request: Request) -> bool:
+    """
+    Only the json responses carry the `ETag`, not the streamed formats or the
+    `explain` output of the same route
+    """
+    params = request.query_params
+    if params.get("format", Formats.json) != Formats.json:
+        return False
+    return params.get("explain", "").lower() in ("", "0", "false")
+
 
+def get_conditional(request: Request, response: Response) -> None:
+    """
+    Set validation and caching headers (`ETag`, `Last-Modified`,
+    `Cache-Control`) and respond with `304 Not Modified` for a matching
+    `If-None-Match` before any store query is executed.
 
-@cache
-def get_cache() -> BaseStore:
-    return get_store(**settings.cache.model_dump())
+    Only used as a dependency of the cached json routes.
+    """
+    if not settings.http_cache or not is_conditional(request):
+        return
+    key = get_request_key(request)
+    if key is None:
+        return
+    etag = f'"{make_data_checksum(key)}"'
+    headers = {"ETag": etag}
+    if is_authenticated(request.query_params.get("api_key")):
+        headers["Cache-Control"] = "private"
+    else:
+        headers["Cache-Control"] = settings.cache_control
+    last_modified = get_last_modified(request)
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(
+            last_modified.replace(tzinfo=last_modified.tzinfo or timezone.utc),
+            usegmt=True,
+        )
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            raise HTTPException(304, headers=headers)
+    response.headers.update(headers)
+    request.state.headers = headers
+
+
+def get_count_cache_key(view: View, query: Query) -> str | None:
+    if not settings.use_cache or is_profiling():
+        return None
+    version = get_data_version(query.dataset_names or None)
+    return f"count/{view.dataset or 'default'}/{version}/{query.filter_key}"
 
 
 def get_retrieve_params(
@@ -57,6 +162,12 @@ def get_retrieve_params(
         False, description="Only include id, schema and caption"
     ),
     dehydrate_nested: bool = QueryField(True, description="Dehydrate nested entities"),
+    depth: int = QueryField(
+        1,
+        ge=1,
+        le=settings.nested_max_depth,
+        description="Levels of adjacent entities to inline (with `nested`)",
+    ),
     stats: bool = QueryField(False, description="Include statistics in response"),
 ) -> RetrieveParams:
     return RetrieveParams(
@@ -64,6 +175,7 @@ def get_retrieve_params(
         featured=featured,
         dehydrate=dehydrate,
         dehydrate_nested=dehydrate_nested,
+        depth=depth,
         stats=stats,
     )
 
@@ -77,26 +189,70 @@ def get_aggregation_params(
     return AggregationParams(aggSum=aggSum, aggMin=aggMin, aggMax=aggMax, aggAvg=aggAvg)
 
 
+def get_next_cursor(view: View, entities: list[CE], query: Query) -> Cursor | None:
+    """
+    Get the keyset pagination cursor to continue after the current page
+    """
+    if not entities or len(entities) < query.limit:
+        return None
+    proxy = entities[-1]
+    if query.sort is not None and isinstance(view.store, SQLStore):
+        # the same sort value as in the keyset query
+        q = select_sort_value(view.store.table, proxy.id, query.sort)
+        with view.store.engine.connect() as conn:
+            return Cursor.from_value(proxy.id, conn.scalar(q))
+    if query.sort is not None and not proxy.get(query.sort.values[0], quiet=True):
+        # the sort property might have been removed (dehydrated proxy)
+        proxy = view.view.get_entity(proxy.id) or proxy
+    return Cursor.from_proxy(proxy, query.sort)
+
+
+@local_cache(key_func=get_response_cache_key)
+@anycache(store=get_cache(), key_func=get_response_cache_key, serialization_mode="raw")
+def cached_response(
+    request: Request, view: Callable[..., Any], *args, **kwargs
+) -> bytes:
+    """
+    Render the result of the given view function and return it as (cached)
+    [`CachedResponse`][ftmq_api.serialize.CachedResponse] data
+    """
+    response = to_response(view(request, *args, **kwargs))
+    return CachedResponse.from_response(response).dump()
+
+
+@local_cache(key_func=get_count_cache_key)
+@anycache(store=get_cache(), key_func=get_count_cache_key)
+def get_count(view: View, query: Query) -> int:
+    """
+    Total count for the query filter, shared across pages (the cache key
+    doesn't depend on page, limit, sorting or cursor)
+    """
+    return view.count(query)
+
+
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=Catalog)
 def dataset_list(request: Request) -> Catalog:
-    catalog = get_catalog()
+    # don't mutate the cached catalog
+    catalog = get_catalog().model_copy()
     datasets: list[Dataset] = []
     for dataset in catalog.datasets:
-        view = get_view(dataset.name)
-        dataset.apply_stats(view.stats())
+        dataset = dataset.model_copy()
+        dataset.apply_stats(get_dataset_stats(dataset.name))
         datasets.append(dataset)
     catalog.datasets = datasets
     return catalog
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=Dataset)
 def dataset_detail(request: Request, name: str) -> Dataset:
-    view = get_view(name)
-    dataset = get_dataset(name)
-    dataset.apply_stats(view.stats())
+    dataset = get_dataset(name).model_copy()
+    dataset.apply_stats(get_dataset_stats(name))
     return dataset
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=EntitiesResponse)
 def entity_list(
     request: Request,
@@ -109,40 +265,160 @@ def entity_list(
     adjacents = []
     entities = [e for e in view.get_entities(query, retrieve_params)]
     if retrieve_params.nested:
-        adjacents = view.get_adjacents(entities)
+        adjacents = view.get_nested(entities, retrieve_params.depth)
+    stats = view.stats(query) if retrieve_params.stats else None
     return EntitiesResponse.from_view(
         request=request,
         entities=entities,
         adjacents=adjacents,
-        stats=view.stats(query) if retrieve_params.stats else None,
+        stats=stats,
         authenticated=authenticated,
-        count=view.count(query) if not retrieve_params.stats else None,
+        count=stats.entity_count if stats else get_count(view, query),
+        cursor=get_next_cursor(view, entities, query),
+    )
+
+
+def entity_explain(
+    request: Request, retrieve_params: RetrieveParams
+) -> ExplainResponse:
+    """
+    Run the entities query stage by stage (not cached) and return the sql,
+    the query plans and the timings, see [`explain`][ftmq_api.explain]
+    """
+    timings = Timings()
+    view = get_view()
+    with timings.stage("params"):
+        params = ViewQueryParams.from_request(request, authenticated=True)
+    with timings.stage("compile"):
+        query = Query.from_params(params)
+        statements = get_statements(view, query)
+        sql = {k: compile_sql(view.store, q) for k, q in statements.items()}
+    with timings.stage("entities"):
+        entities = [e for e in view.get_entities(query, retrieve_params)]
+    with timings.stage("count"):
+        count = view.count(query)
+    adjacents = []
+    with timings.stage("adjacents"):
+        if retrieve_params.nested:
+            adjacents = view.get_nested(entities, retrieve_params.depth)
+    with timings.stage("serialize"):
+        to_response(
+            EntitiesResponse.from_view(
+                request=request,
+                entities=entities,
+                adjacents=adjacents,
+                authenticated=True,
+                count=count,
+                cursor=get_next_cursor(view, entities, query),
+            )
+        )
+    timings.stages["total"] = timings.total
+    return ExplainResponse(
+        query=query.to_dict(),
+        queries={
+            k: ExplainQuery(sql=s, plan=get_plan(view.store, s)) for k, s in sql.items()
+        },
+        timings=timings.stages,
+        total=count,
+        items=len(entities),
     )
 
 
+def entity_stream(
+    request: Request,
+    retrieve_params: RetrieveParams,
+    authenticated: bool | None = False,
+    format: Formats | None = Formats.ndjson,
+) -> Generator[bytes, None, None]:
+    """
+    Lazily serialize all entities matching the query as ndjson (or arrow /
+    parquet), chunk by chunk. Authenticated requests are not paginated unless
+    `limit` is given.
+    """
+    view = get_view()
+    params = ViewQueryParams.from_request(request, authenticated)
+    query = Query.from_params(params)
+    if authenticated and "limit" not in request.query_params:
+        query = query[:]
+    entities = view.get_entities(query, retrieve_params)
+    if format in (Formats.arrow, Formats.parquet):
+        yield from arrow.stream_entities(entities, format)
+        return
+    for chunk in chunked_iter(entities, settings.stream_chunk_size):
+        adjacents = []
+        if retrieve_params.nested:
+            adjacents = view.get_nested(chunk, retrieve_params.depth)
+        yield b"".join(
+            e.model_dump_json(by_alias=True).encode() + b"\n"
+            for e in EntityResponse.from_levels(chunk, adjacents)
+        )
+
+
+def get_redirect(request: Request, entity: CE) -> Redirect:
+    """
+    Redirect to the entity a requested entity was merged into
+    """
+    url = furl(request.url)
+    url.path.segments[-1] = entity.id
+    if not is_authenticated(request.query_params.get("api_key")):
+        url.args.pop("api_key", None)
+    return Redirect(
+        url=str(url),
+        headers={"X-Entity-ID": entity.id, "X-Entity-Schema": entity.schema.name},
+    )
+
+
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, serialization_mode="pickle")
 def entity_detail(
     request: Request,
     entity_id: str,
     retrieve_params: RetrieveParams,
-) -> EntityResponse | RedirectResponse:
+) -> EntityResponse | Redirect:
     view = get_view()
     entity = view.get_entity(entity_id, retrieve_params)
-    adjacents: Iterable[CE] = []
-    if retrieve_params.nested:
-        adjacents = [e[1] for e in view.view.get_adjacent(entity)]
-        if retrieve_params.dehydrate_nested:
-            adjacents = [get_dehydrated_proxy(e) for e in adjacents]
     if entity.id != entity_id:  # we have a redirect to a merged entity
-        url = furl(request.url)
-        url.path.segments[-1] = entity.id
-        response = RedirectResponse(url)
-        response.headers["X-Entity-ID"] = entity.id
-        response.headers["X-Entity-Schema"] = entity.schema.name
-        return response
-    return EntityResponse.from_entity(entity, adjacents)
+        return get_redirect(request, entity)
+    adjacents: list[list[CE]] = []
+    if retrieve_params.nested:
+        adjacents = view.get_nested([entity], retrieve_params.depth, inverted=True)
+    return EntityResponse.from_levels(
+        [entity],
+        adjacents,
+        inverted=True,
+        dehydrate=retrieve_params.dehydrate_nested,
+    )[0]
+
+
+@local_cache(key_func=get_cache_key)
+@anycache(store=get_cache(), key_func=get_cache_key, model=EntitiesBatchResponse)
+def entity_batch(
+    request: Request,
+    entity_ids: list[str],
+    retrieve_params: RetrieveParams,
+) -> EntitiesBatchResponse:
+    entity_ids = list(dict.fromkeys(entity_ids))
+    if len(entity_ids) > settings.batch_limit:
+        raise HTTPException(
+            400, [f"Too many ids: {len(entity_ids)} (max {settings.batch_limit})"]
+        )
+    view = get_view()
+    entities = view.get_entities_batch(entity_ids, retrieve_params)
+    adjacents: list[list[CE]] = []
+    if retrieve_params.nested:
+        adjacents = view.get_nested(
+            entities.values(), retrieve_params.depth, inverted=True
+        )
+    return EntitiesBatchResponse.from_view(
+        entity_ids,
+        entities,
+        adjacents,
+        inverted=True,
+        dehydrate=retrieve_params.dehydrate_nested,
+    )
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=AggregationResponse)
 def aggregation(request: Request) -> AggregationResponse:
     view = get_view()
@@ -155,23 +431,54 @@ def aggregation(request: Request) -> AggregationResponse:
     )
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=EntitiesResponse)
 def search(request: Request, authenticated: bool | None = False) -> EntitiesResponse:
+    q, query = get_search_query(request, authenticated)
+    return EntitiesResponse.from_view(
+        request=request,
+        entities=get_search_entities(q, query),
+        authenticated=authenticated,
+    )
+
+
+def get_search_query(
+    request: Request, authenticated: bool | None = False
+) -> tuple[str, SearchQuery]:
     params = SearchQueryParams.from_request(request, authenticated)
     q = params.q
     if q is None or len(q) < settings.min_search_length:
         raise HTTPException(400, [f"Invalid search query: `{q}`"])
     params.q = None
-    query = SearchQuery.from_params(params)
+    return q, SearchQuery.from_params(params)
+
+
+def get_search_entities(q: str, query: SearchQuery) -> CEGenerator:
     store = get_search_store()
-    entities = (e.to_proxy() for e in store.search(q, query))
-    return EntitiesResponse.from_view(
-        request=request,
-        entities=entities,
-        authenticated=authenticated,
+    for result in store.search(q, query):
+        yield result.to_proxy()
+
+
+def search_stream(
+    request: Request,
+    authenticated: bool | None = False,
+    format: Formats | None = Formats.ndjson,
+) -> Generator[bytes, None, None]:
+    """
+    Validate the search query and lazily serialize the results as ndjson (or
+    arrow / parquet)
+    """
+    q, query = get_search_query(request, authenticated)
+    entities = get_search_entities(q, query)
+    if format in (Formats.arrow, Formats.parquet):
+        return arrow.stream_entities(entities, format)
+    return (
+        EntityResponse.from_entity(e).model_dump_json(by_alias=True).encode() + b"\n"
+        for e in entities
     )
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=AutocompleteResponse)
 def autocomplete(request, q: str) -> AutocompleteResponse:
     if q is None or len(q) < 4:
@@ -180,6 +487,7 @@ def autocomplete(request, q: str) -> AutocompleteResponse:
     return AutocompleteResponse(candidates=store.autocomplete(q))
 
 
+@local_cache(key_func=get_cache_key)
 @anycache(store=get_cache(), key_func=get_cache_key, model=EntitiesResponse)
 def similar(
     request: Request,
@@ -0,0 +1,150 @@
+"""
+Cache warm-up
+
+Pre-populate the api cache after a deploy or data reload by requesting the
+catalog, each dataset, the first entities pages per dataset and schema, and
+optionally the top recorded requests. Requests are sent in-process through
+the asgi app (same routes, view functions and cache key normalization as in
+production) with bounded concurrency.
+
+Recorded requests are read from a json lines file, one request per line:
+
+```json
+{"url": "/entities?dataset=my_dataset&schema=Company", "count": 12}
+```
+
+`url` (or `path` and optional `query`) is required, `count` (default 1) is
+summed up per url to find the top requests.
+"""
+
+import asyncio
+import json
+from collections import Counter
+from collections.abc import Iterable
+from typing import Any
+from urllib.parse import urlencode, urlsplit
+
+from anystore.io import smart_stream
+
+from ftmq_api.logging import get_logger
+from ftmq_api.stats import get_dataset_stats
+from ftmq_api.store import get_catalog
+
+log = get_logger(__name__)
+
+
+def get_catalog_urls() -> list[str]:
+    """
+    Catalog, dataset metadata and first entities pages per dataset and schema
+    """
+    urls = ["/catalog"]
+    for dataset in get_catalog().datasets:
+        urls.append(f"/catalog/{dataset.name}")
+        urls.append("/entities?" + urlencode({"dataset": dataset.name}))
+        stats = get_dataset_stats(dataset.name)
+        for schema in [*stats.things.schemata, *stats.intervals.schemata]:
+            query = urlencode({"dataset": dataset.name, "schema": schema.name})
+            urls.append(f"/entities?{query}")
+    return urls
+
+
+def get_recorded_counts(uri: str) -> Counter[str]:
+    """
+    The number of requests per url (path and query) from a recorded requests
+    json lines file
+    """
+    counter: Counter[str] = Counter()
+    for line in smart_stream(uri):
+        if not line.strip():
+            continue
+        data = json.loads(line)
+        url = data.get("url")
+        if url is None and data.get("path"):
+            url = data["path"]
+            if data.get("query"):
+                url = f"{url}?{data['query']}"
+        if not url:
+            log.warning(f"Invalid recorded request: `{line.strip()}`")
+            continue
+        parts = urlsplit(url)
+        url = f"{parts.path}?{parts.query}" if parts.query else parts.path
+        counter[url] += int(data.get("count", 1))
+    return counter
+
+
+def get_recorded_urls(uri: str, limit: int | None = 100) -> list[str]:
+    """
+    The top `limit` requests from a recorded requests json lines file
+    """
+    counter = get_recorded_counts(uri)
+    return [url for url, _ in counter.most_common(limit)]
+
+
+def make_scope(url: str, base_url: str = "http://localhost") -> dict[str, Any]:
+    """
+    Asgi http scope for a GET request
+    """
+    base = urlsplit(base_url)
+    parts = urlsplit(url)
+    port = base.port or (443 if base.scheme == "https" else 80)
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": base.scheme,
+        "path": parts.path,
+        "raw_path": parts.path.encode(),
+        "query_string": parts.query.encode(),
+        "root_path": "",
+        "headers": [(b"host", base.netloc.encode())],
+        "client": ("127.0.0.1", 0),
+        "server": (base.hostname, port),
+    }
+
+
+async def request(app: Any, url: str, base_url: str = "http://localhost") -> int:
+    """
+    Send a GET request to the asgi app and return the response status
+    """
+    status = 0
+
+    async def receive() -> dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict[str, Any]) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(make_scope(url, base_url), receive, send)
+    return status
+
+
+async def warmup(
+    urls: Iterable[str],
+    base_url: str = "http://localhost",
+    concurrency: int = 4,
+    app: Any = None,
+) -> Counter[int]:
+    """
+    Request all urls with bounded concurrency, return the counts per status
+    """
+    if app is None:
+        from ftmq_api.api import app
+
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: Counter[int] = Counter()
+
+    async def _request(url: str) -> None:
+        async with semaphore:
+            try:
+                status = await request(app, url, base_url)
+            except Exception as e:
+                log.error(f"Warm-up failed for `{url}`: {e}")
+                status = 500
+            statuses[status] += 1
+            log.info("Warm-up", url=url, status=status)
+
+    await asyncio.gather(*[_request(url) for url in dict.fromkeys(urls)])
+    return statuses
@@ -0,0 +1,49 @@
+from collections.abc import Callable, Iterable
+from typing import Any
+
+import pytest
+from ftmq.store import get_store
+from ftmq.store.sql import SQLStore
+from ftmq.util import make_proxy
+
+ORGS = [
+    {"id": f"o-{i}", "schema": "Organization", "properties": {"name": [f"Org {i}"]}}
+    for i in range(2)
+]
+PERSONS = [
+    {"id": f"p-{i}", "schema": "Person", "properties": {"name": [f"P {i}"]}}
+    for i in range(5)
+]
+MEMBERSHIPS = [
+    {
+        "id": f"m-{i}",
+        "schema": "Membership",
+        "properties": {"member": [f"p-{i}"], "organization": [f"o-{i % 2}"]},
+    }
+    for i in range(5)
+]
+
+
+@pytest.fixture
+def make_store(tmp_path) -> Callable[[Iterable[dict[str, Any]]], SQLStore]:
+    """
+    Factory for a sqlite store at `tmp_path/store.db` with the given entities
+    (dataset `test`)
+    """
+
+    def _make_store(entities: Iterable[dict[str, Any]]) -> SQLStore:
+        store = get_store(f"sqlite:///{tmp_path}/store.db", dataset="test")
+        with store.writer() as bulk:
+            for data in entities:
+                bulk.add_entity(make_proxy(data, "test"))
+        return store
+
+    return _make_store
+
+
+@pytest.fixture
+def memberships_store(make_store) -> SQLStore:
+    """
+    Organizations, persons and their memberships
+    """
+    return make_store([*ORGS, *PERSONS, *MEMBERSHIPS])
@@ -1,6 +1,28 @@
+import io
+import json
+from unittest import mock
+
+import pytest
+from fastapi import Request
+from fastapi.responses import JSONResponse
 from fastapi.testclient import TestClient
+from ftmq.model import Catalog, Dataset
 
+from ftmq_api import api, arrow, async_views, views
 from ftmq_api.api import app
+from ftmq_api.cache import get_local_cache
+from ftmq_api.query import Query, ViewQueryParams
+from ftmq_api.serialize import (
+    AggregationResponse,
+    AutocompleteResponse,
+    CachedResponse,
+    EntitiesResponse,
+    EntityResponse,
+    ExplainResponse,
+    Redirect,
+)
+from ftmq_api.store import get_dataset, get_view
+from ftmq_api.warmup import make_scope
 
 client = TestClient(app)
 
@@ -254,6 +276,62 @@ def test_api_entities_id_filter():
     assert data["total"] == data["items"] == 0
 
 
+def test_api_entities_batch():
+    ids = ["eu-authorities-chafea", "eu-authorities-cor"]
+    res = client.get("/entities/batch?id=eu-authorities-chafea&id=eu-authorities-cor")
+    assert res.status_code == 200
+    data = res.json()
+    assert list(data["entities"]) == ids
+    assert (
+        data["entities"]["eu-authorities-chafea"]
+        == client.get("/entities/eu-authorities-chafea").json()  # noqa: W503
+    )
+    assert data["merged"] == {}
+    assert data["missing"] == []
+    # in the requested order (not a cached response of the other order)
+    res = client.get("/entities/batch?id=eu-authorities-cor&id=eu-authorities-chafea")
+    assert list(res.json()["entities"]) == ids[::-1]
+
+    res = client.get("/entities/batch?id=eu-authorities-chafea&id=unknown&dehydrate=1")
+    data = res.json()
+    assert list(data["entities"]) == ["eu-authorities-chafea"]
+    assert (
+        data["entities"]["eu-authorities-chafea"]
+        == client.get("/entities/eu-authorities-chafea?dehydrate=1").json()  # noqa: W503
+    )
+    assert data["missing"] == ["unknown"]
+
+    # merged ids are mapped instead of redirected
+    linker = get_view().store.linker
+    canonicals = {"merged-id": "eu-authorities-chafea"}
+    with mock.patch.object(
+        linker, "get_canonical", side_effect=lambda i: canonicals.get(i, i)
+    ):
+        res = client.get("/entities/batch?id=merged-id&id=eu-authorities-cor")
+    data = res.json()
+    assert list(data["entities"]) == ["eu-authorities-chafea", "eu-authorities-cor"]
+    assert data["merged"] == {"merged-id": "eu-authorities-chafea"}
+
+    # redirects are cached as plain data, not as (mutable) responses
+    with mock.patch.object(
+        linker, "get_canonical", side_effect=lambda i: canonicals.get(i, i)
+    ):
+        for _ in range(2):
+            res = client.get("/entities/merged-id", follow_redirects=False)
+            assert res.status_code == 307
+            assert res.headers["location"].endswith("/entities/eu-authorities-chafea")
+            assert res.headers["x-entity-id"] == "eu-authorities-chafea"
+    request = Request(make_scope("/entities/merged-id", "http://testserver"))
+    cached = get_local_cache().get(views.get_cache_key(request))
+    assert isinstance(cached, Redirect)
+
+    with mock.patch.object(views.settings, "batch_limit", 1):
+        res = client.get("/entities/batch?id=a&id=b")
+        assert res.status_code == 400
+    res = client.get("/entities/batch")
+    assert res.status_code == 422
+
+
 def test_api_search_fts():
     res = client.get("/search?dataset=eu_authorities&q=agency")
     data = res.json()
@@ -285,3 +363,339 @@ def test_api_search_fts():
     res = client.get("/autocomplete?q=european defence")
     data = res.json()
     assert len(data["candidates"]) == 1
+
+
+def test_api_entities_cursor():
+    for base_url in (
+        "/entities?dataset=eu_authorities&limit=40",
+        "/entities?dataset=eu_authorities&limit=40&order_by=-name",
+        "/entities?dataset=gdho&limit=40&order_by=name&dehydrate=1",
+    ):
+        res = client.get(f"{base_url}&page=2")
+        paged = res.json()
+        assert "page=3" in paged["next_url"]
+
+        res = client.get(base_url)
+        data = res.json()
+        assert "cursor=" in data["next_url"]
+        assert "page=" not in data["next_url"]
+        res = client.get(data["next_url"])
+        data = res.json()
+        assert data["total"] == paged["total"]
+        assert [e["id"] for e in data["entities"]] == [
+            e["id"] for e in paged["entities"]
+        ]
+
+    # crawl all pages
+    url = "/entities?dataset=eu_authorities&limit=40"
+    ids = []
+    while url:
+        data = client.get(url).json()
+        ids.extend(e["id"] for e in data["entities"])
+        url = data["next_url"]
+    assert len(ids) == len(set(ids)) == 151
+
+    res = client.get("/entities?cursor=foo")
+    assert res.status_code == 400
+
+
+def test_api_entities_stream():
+    res = client.get("/entities/stream?dataset=eu_authorities&limit=10")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/x-ndjson"
+    lines = res.text.splitlines()
+    assert len(lines) == 10
+
+    # public limit
+    res = client.get("/entities/stream?dataset=eu_authorities&limit=1000")
+    assert len(res.text.splitlines()) == 100
+
+    # authenticated: all entities
+    res = client.get(
+        "/entities/stream?dataset=eu_authorities&api_key=secret-key-for-build"
+    )
+    entities = [json.loads(line) for line in res.text.splitlines()]
+    assert len(entities) == 151
+    assert entities[0]["schema"] == "PublicBody"
+
+    res = client.get("/entities?dataset=eu_authorities&limit=10&format=ndjson")
+    assert res.headers["content-type"] == "application/x-ndjson"
+    assert res.text.splitlines() == lines
+
+    res = client.get("/entities?dataset=eu_authorities&limit=10")
+    data = res.json()
+    assert [e["id"] for e in data["entities"]] == [json.loads(x)["id"] for x in lines]
+
+
+def test_api_entities_arrow():
+    pa = pytest.importorskip("pyarrow")
+    from pyarrow import parquet as pq
+
+    url = "/entities?dataset=eu_authorities&limit=10"
+    ids = [e["id"] for e in client.get(url).json()["entities"]]
+
+    res = client.get(url + "&format=arrow")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/vnd.apache.arrow.stream"
+    table = pa.ipc.open_stream(res.content).read_all()
+    assert "value" in table.column_names
+    assert list(dict.fromkeys(table.column("canonical_id").to_pylist())) == ids
+
+    res = client.get(url + "&format=parquet")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/vnd.apache.parquet"
+    assert pq.read_table(io.BytesIO(res.content)).equals(table)
+
+    # authenticated: all entities, in record batches
+    with mock.patch.object(arrow.settings, "record_batch_size", 50):
+        res = client.get(
+            "/entities?dataset=eu_authorities&format=arrow&api_key=secret-key-for-build"
+        )
+    reader = pa.ipc.open_stream(res.content)
+    batches = list(reader)
+    assert len(batches) == 4
+    ids = pa.Table.from_batches(batches).column("canonical_id").unique()
+    assert len(ids) == 151
+
+    res = client.get("/search?q=agency&format=parquet")
+    assert res.status_code == 200
+    assert pq.read_table(io.BytesIO(res.content)).column_names == table.column_names
+    res = client.get("/search?q=a&format=parquet")
+    assert res.status_code == 400
+
+    with mock.patch.object(arrow, "pa", None):
+        res = client.get(url + "&format=arrow")
+        assert res.status_code == 501
+
+
+def test_api_entities_count_cache():
+    res = client.get("/entities?dataset=gdho&limit=5&page=3&order_by=name")
+    total = res.json()["total"]
+    query = Query.from_params(ViewQueryParams(dataset=["gdho"]))
+    key = views.get_count_cache_key(get_view(), query)
+    assert views.get_cache().get(key) == total
+
+
+def test_api_catalog_stats():
+    res = client.get("/catalog/eu_authorities")
+    assert res.json()["entity_count"] == 151
+    # cached catalog objects are not mutated
+    assert get_dataset("eu_authorities").entity_count != 151
+
+
+def test_api_entities_explain():
+    url = "/entities?dataset=gdho&limit=5&order_by=-name&explain=1"
+    res = client.get(url)
+    assert res.status_code == 403
+
+    with mock.patch.object(views, "entity_list") as entity_list:
+        res = client.get(url + "&api_key=secret-key-for-build")
+        entity_list.assert_not_called()
+    assert res.status_code == 200
+    data = ExplainResponse(**res.json())
+    assert data.items == 5
+    assert data.total == 4633
+    assert data.query["dataset__in"] == ["gdho"]
+    assert set(data.queries) == {"entities", "count"}
+    assert "'gdho'" in data.queries["entities"].sql
+    assert "LIMIT 5" in data.queries["entities"].sql
+    assert "count(DISTINCT statement.canonical_id)" in data.queries["count"].sql
+    assert any("ix_statement_dataset" in s for s in data.queries["count"].plan)
+    assert list(data.timings) == [
+        "params",
+        "compile",
+        "entities",
+        "count",
+        "adjacents",
+        "serialize",
+        "total",
+    ]
+    assert data.timings["total"] >= data.timings["entities"]
+
+    # not a filter
+    res = client.get("/entities?dataset=gdho&limit=5&explain=0")
+    assert res.json()["total"] == 4633
+
+
+def test_api_conditional():
+    res = client.get("/entities?dataset=gdho&limit=5")
+    assert res.status_code == 200
+    etag = res.headers["etag"]
+    # weak, as the client accepts compressed responses
+    assert etag.startswith('W/"')
+    assert res.headers["cache-control"] == "public, max-age=60"
+    assert res.headers["last-modified"] == "Wed, 10 May 2023 14:15:54 GMT"
+
+    # same canonical query, same etag
+    res = client.get("/entities?limit=5&dataset=gdho&page=1")
+    assert res.headers["etag"] == etag
+    assert client.get("/entities?dataset=gdho&limit=6").headers["etag"] != etag
+
+    res = client.get("/entities?dataset=gdho&limit=5", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+    assert res.headers["etag"] == etag
+    res = client.get(
+        "/entities?dataset=gdho&limit=5",
+        headers={"If-None-Match": '"foo", ' + etag[2:]},
+    )
+    assert res.status_code == 304
+    res = client.get(
+        "/entities?dataset=gdho&limit=5", headers={"If-None-Match": '"foo"'}
+    )
+    assert res.status_code == 200
+
+    res = client.get("/catalog")
+    assert res.headers["last-modified"] == "Wed, 10 May 2023 14:17:00 GMT"
+    res = client.get("/catalog", headers={"If-None-Match": res.headers["etag"]})
+    assert res.status_code == 304
+
+    # 304 before any store query
+    with mock.patch.object(views, "entity_list") as entity_list:
+        res = client.get(
+            "/entities?dataset=gdho&limit=5", headers={"If-None-Match": etag}
+        )
+        assert res.status_code == 304
+        entity_list.assert_not_called()
+
+    res = client.get("/entities?dataset=gdho&limit=5&api_key=secret-key-for-build")
+    assert res.headers["cache-control"] == "private"
+    assert res.headers["etag"] != etag
+
+    # streams and the batch endpoint are not conditional
+    for url in (
+        "/entities?dataset=gdho&limit=5&format=ndjson",
+        "/entities/stream?dataset=gdho&limit=5",
+        "/entities/batch?id=gdho-1",
+    ):
+        res = client.get(url, headers={"If-None-Match": "*"})
+        assert res.status_code == 200
+        assert "etag" not in res.headers
+        assert "cache-control" not in res.headers
+
+
+def test_api_serialization():
+    # same output as FastAPI's response model serialization
+    for url in (
+        "/entities?dataset=gdho&limit=50",
+        "/entities?dataset=gdho&limit=50&nested=true&dehydrate_nested=false",
+        "/entities?dataset=eu_authorities&stats=true",
+        "/entities/eu-authorities-cdt",
+    ):
+        res = client.get(url)
+        assert res.headers["content-type"] == "application/json"
+        model = EntitiesResponse if "?" in url else EntityResponse
+        data = model.model_validate(res.json()).model_dump(mode="json", by_alias=True)
+        assert res.content == JSONResponse(data).body
+    for url, model in (
+        ("/catalog", Catalog),
+        ("/catalog/gdho", Dataset),
+        ("/aggregate?dataset=gdho&aggCount=country", AggregationResponse),
+        ("/autocomplete?q=mini", AutocompleteResponse),
+    ):
+        res = client.get(url)
+        data = model.model_validate(res.json()).model_dump(mode="json", by_alias=True)
+        assert res.content == JSONResponse(data).body
+
+
+def test_api_response_cache():
+    with (
+        mock.patch.object(views.settings, "cache_responses", True),
+        mock.patch.object(api.settings, "cache_responses", True),
+    ):
+        url = "/entities?dataset=gdho&limit=3&page=2"
+        res = client.get(url)
+        assert res.status_code == 200
+        request = Request(make_scope(url, "http://testserver"))
+        key = views.get_response_cache_key(request)
+        assert key.startswith("response/")
+        # model cache is not used
+        assert views.get_cache_key(request) is None
+        cached = CachedResponse.load(
+            views.get_cache().get(key, serialization_mode="raw")
+        )
+        assert cached.encoding == "zstd"
+        assert cached.to_response().body == res.content
+        assert "etag" not in cached.headers
+
+        with (
+            mock.patch.object(views, "entity_list") as entity_list,
+            mock.patch("ftmq_api.compression.compress") as compress,
+        ):
+            res2 = client.get(url)
+            entity_list.assert_not_called()
+            # served as stored
+            compress.assert_not_called()
+        assert res2.content == res.content
+        assert res2.headers["content-encoding"] == "zstd"
+        assert res2.headers["content-type"] == "application/json"
+        assert res2.headers["etag"] == res.headers["etag"]
+
+        # redirects for merged entities
+        redirect = Redirect(url="/entities/foo", headers={"X-Entity-ID": "foo"})
+        with mock.patch.object(views, "entity_detail", return_value=redirect):
+            res = client.get("/entities/bar", follow_redirects=False)
+        assert res.status_code == 307
+        request = Request(make_scope("/entities/bar", "http://testserver"))
+        cached = views.get_cache().get(
+            views.get_response_cache_key(request), serialization_mode="raw"
+        )
+        cached = CachedResponse.load(cached)
+        assert cached.encoding is None
+        assert cached.status_code == 307
+        assert cached.headers["location"] == "/entities/foo"
+        assert cached.headers["x-entity-id"] == "foo"
+        res = client.get("/entities/bar", follow_redirects=False)
+        assert res.status_code == 307
+        assert res.headers["x-entity-id"] == "foo"
+
+
+def test_api_async_store():
+    urls = [
+        "/entities?dataset=eu_authorities&limit=5&order_by=-name&stats=1",
+        "/entities?dataset=eu_authorities&limit=5&order_by=name&dehydrate=1",
+        "/entities/eu-authorities-cdt?nested=1",
+        "/entities/not-existing",
+        "/aggregate?dataset=gdho&aggCount=country&aggGroups=country",
+    ]
+    with mock.patch.object(views.settings, "use_cache", False):
+        expected = [client.get(url) for url in urls]
+        with mock.patch.object(api.settings, "async_store", True):
+            with mock.patch.object(views, "entity_list") as entity_list:
+                results = [client.get(url) for url in urls]
+                entity_list.assert_not_called()
+    for res, exp in zip(results, expected):
+        assert res.status_code == exp.status_code
+        assert res.json() == exp.json()
+
+    # cache entries are shared with the sync views
+    url = "/entities?dataset=eu_authorities&limit=3&page=7"
+    with mock.patch.object(api.settings, "async_store", True):
+        res = client.get(url)
+    request = Request(make_scope(url, "http://testserver"))
+    cached = views.get_cache().get(views.get_cache_key(request), model=EntitiesResponse)
+    assert cached.model_dump(mode="json", by_alias=True) == res.json()
+    with mock.patch.object(get_view(), "get_entities") as get_entities:
+        assert client.get(url).json() == res.json()
+        get_entities.assert_not_called()
+
+    # rendered responses cache
+    with (
+        mock.patch.object(views.settings, "cache_responses", True),
+        mock.patch.object(api.settings, "cache_responses", True),
+        mock.patch.object(api.settings, "async_store", True),
+    ):
+        url = "/entities/eu-authorities-cor"
+        res = client.get(url)
+        request = Request(make_scope(url, "http://testserver"))
+        cached = CachedResponse.load(
+            views.get_cache().get(
+                views.get_response_cache_key(request), serialization_mode="raw"
+            )
+        )
+        assert cached.to_response().body == res.content
+        with mock.patch.object(
+            async_views.get_async_view(), "get_entity"
+        ) as get_entity:
+            assert client.get(url).content == res.content
+            get_entity.assert_not_called()
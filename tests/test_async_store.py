@@ -0,0 +1,102 @@
+import asyncio
+from unittest import mock
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import MetaData, create_engine
+
+from ftmq_api import async_store
+from ftmq_api.async_store import AsyncView, get_async_uri, get_async_view
+from ftmq_api.query import Query, RetrieveParams, ViewQueryParams
+from ftmq_api.resolver import MemoryResolver
+from ftmq_api.store import View, get_view
+
+PARAMS = RetrieveParams(
+    nested=False, featured=False, dehydrate=False, dehydrate_nested=True, stats=False
+)
+
+
+def test_async_store_uri():
+    assert get_async_uri("sqlite:///nomenklatura.db") == (
+        "sqlite+aiosqlite:///nomenklatura.db"
+    )
+    assert get_async_uri("postgresql+psycopg2://localhost/ftm") == (
+        "postgresql+asyncpg://localhost/ftm"
+    )
+    with pytest.raises(NotImplementedError):
+        get_async_uri("redis://localhost")
+
+
+def test_async_store_view():
+    view = get_view()
+    aview = get_async_view()
+    params = ViewQueryParams(dataset=["eu_authorities"], order_by="-name", limit=10)
+    query = Query.from_params(params)
+
+    async def _entities(q):
+        return [e async for e in aview.get_entities(q, PARAMS)]
+
+    entities = asyncio.run(_entities(query))
+    assert [e.id for e in entities] == [e.id for e in view.get_entities(query, PARAMS)]
+    assert entities[0].id == "eu-authorities-cdt"
+    assert asyncio.run(aview.count(query)) == view.count(query) == 151
+
+    stats = asyncio.run(aview.stats(query))
+    assert stats.entity_count == 151
+    assert stats.model_dump() == view.stats(query).model_dump()
+
+    entity = asyncio.run(aview.get_entity("eu-authorities-cdt", PARAMS))
+    assert entity.to_dict() == view.get_entity("eu-authorities-cdt", PARAMS).to_dict()
+    with pytest.raises(HTTPException):
+        asyncio.run(aview.get_entity("not-existent", PARAMS))
+    # other linkers are called in the executor
+    linker = mock.Mock(wraps=aview.store.linker)
+    with (
+        mock.patch.object(aview.store, "linker", linker),
+        mock.patch.object(async_store, "dispatch", wraps=async_store.dispatch) as run,
+    ):
+        entity = asyncio.run(aview.get_entity("eu-authorities-cdt", PARAMS))
+        assert entity.id == "eu-authorities-cdt"
+        assert run.call_args.args[1] == linker.get_canonical
+
+    params = ViewQueryParams(dataset=["gdho"], aggCount=["country"])
+    query = Query.from_params(params)
+    assert asyncio.run(aview.aggregations(query)) == view.aggregations(query)
+
+
+def test_async_store_nested(memberships_store):
+    view = View(store=memberships_store)
+    aview = AsyncView(view=view)
+    persons = view.get_entities_by_id(["p-0"])
+    memberships = view.get_entities_by_id([f"m-{i}" for i in range(5)])
+    for entities, inverted in ((persons, True), (memberships, False)):
+        levels = asyncio.run(aview.get_nested(entities, depth=3, inverted=inverted))
+        assert levels
+        assert [[e.id for e in level] for level in levels] == [
+            [e.id for e in level]
+            for level in view.get_nested(entities, depth=3, inverted=inverted)
+        ]
+    assert asyncio.run(aview.get_entities_by_id([])) == []
+    assert asyncio.run(aview.get_entities_by_id(["not-existent"])) == []
+
+
+def test_async_store_similar(tmp_path):
+    aview = get_async_view()
+
+    async def _similar(entity_id):
+        return [r async for r in aview.similar(entity_id, PARAMS)]
+
+    assert asyncio.run(_similar("not-existent")) == []
+    with mock.patch.object(aview.store, "linker", object()):
+        with pytest.raises(NotImplementedError):
+            asyncio.run(_similar("eu-authorities-cdt"))
+
+    # the resolver table of the linker is queried
+    engine = create_engine(f"sqlite:///{tmp_path}/resolver.db")
+    resolver = MemoryResolver(engine, MetaData(), create=True, table_name="judgements")
+    resolver.begin()
+    resolver.suggest("eu-authorities-cdt", "eu-authorities-cor", 0.9)
+    resolver.commit()
+    with mock.patch.object(aview.store, "linker", resolver):
+        res = asyncio.run(_similar("eu-authorities-cdt"))
+    assert [(e.id, score) for e, score in res] == [("eu-authorities-cor", 0.9)]
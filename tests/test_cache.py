@@ -0,0 +1,213 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from anystore.store import get_store
+from fastapi import Response
+
+from ftmq_api import cache as cache_module
+from ftmq_api.cache import (
+    AsyncSingleFlight,
+    LocalLock,
+    LRUCache,
+    SingleFlight,
+    anycache,
+    async_cache,
+    get_local_cache,
+    get_size,
+    local_cache,
+)
+
+
+def test_cache_lru():
+    lru = LRUCache(items=2, size=100)
+    lru.put("a", b"a" * 10, ttl=60)
+    lru.put("b", b"b" * 10, ttl=60)
+    assert lru.get("a") == b"a" * 10
+    # "b" is least recently used
+    lru.put("c", b"c" * 10, ttl=60)
+    assert "b" not in lru
+    assert "a" in lru and "c" in lru
+    assert lru.current_size == 20
+
+    # bounded by size
+    lru.put("d", b"d" * 95, ttl=60)
+    assert len(lru) == 1
+    assert lru.current_size == 95
+    # too big to be cached at all
+    lru.put("e", b"e" * 101, ttl=60)
+    assert "e" not in lru
+    assert "d" in lru
+
+    # ttl
+    lru.put("f", b"f", ttl=-1)
+    with pytest.raises(KeyError):
+        lru.get("f")
+    assert "f" not in lru
+    assert lru.hits == 1
+    assert lru.misses == 1
+
+    assert get_size({"a": 1}) > 0
+
+
+def test_cache_decorator():
+    calls = []
+
+    @local_cache(key_func=lambda value: f"test/{value}")
+    def entity_list(value: int) -> int:
+        calls.append(value)
+        return value
+
+    assert entity_list(1) == 1
+    assert entity_list(1) == 1
+    assert calls == [1]
+    assert entity_list(2) == 2
+    assert calls == [1, 2]
+    assert "test/1" in get_local_cache()
+
+    @local_cache(key_func=lambda value: None)
+    def uncached(value: int) -> float:
+        return time.time()
+
+    assert uncached(1) != uncached(1)
+
+    # responses are not shared between requests
+    @local_cache(key_func=lambda value: f"test/response/{value}")
+    def response(value: int) -> Response:
+        return Response(str(value))
+
+    assert response(1) is not response(1)
+    assert "test/response/1" not in get_local_cache()
+
+
+def test_cache_single_flight():
+    store = get_store("redis://localhost")  # fakeredis
+    calls = []
+    shared = {}
+
+    def compute(value: int) -> int:
+        # simulate an `anycache` decorated view
+        if value in shared:
+            return shared[value]
+        calls.append(value)
+        time.sleep(0.1)
+        shared[value] = value
+        return value
+
+    # two workers
+    flights = [SingleFlight(store, timeout=5), SingleFlight(store, timeout=5)]
+    with ThreadPoolExecutor(10) as pool:
+        futures = [
+            pool.submit(flights[i % 2].run, "test/1", compute, 1) for i in range(10)
+        ]
+        assert [f.result() for f in futures] == [1] * 10
+    assert calls == [1]
+    assert flights[0].coalesced + flights[1].coalesced > 0
+
+    # errors are propagated to waiting callers
+    def fail() -> None:
+        time.sleep(0.1)
+        raise ValueError("fail")
+
+    flight = SingleFlight(store, timeout=5)
+    with ThreadPoolExecutor(3) as pool:
+        futures = [pool.submit(flight.run, "test/fail", fail) for _ in range(3)]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+
+    # process local stand-in
+    lock = LocalLock("test", blocking_timeout=0.01)
+    assert lock.acquire()
+    assert not LocalLock("test", blocking_timeout=0.01).acquire()
+    lock.release()
+    assert LocalLock._locks == {}
+
+    # redis lock: only released by its owner
+    lock = cache_module.get_lock(store, "test/2", timeout=5)
+    assert lock.acquire()
+    other = cache_module.get_lock(store, "test/2", timeout=0.01)
+    assert not other.acquire()
+    lock.release()
+    assert other.acquire()
+    other.release()
+
+
+def test_cache_shared(monkeypatch):
+    store = get_store("memory://")
+    calls = []
+
+    @anycache(key_func=lambda value: f"test/shared/{value}", store=store)
+    def entity_list(value: int) -> int:
+        calls.append(value)
+        return value
+
+    assert entity_list(1) == 1
+    assert store.get("test/shared/1") == 1
+
+    # shared hits don't take the lock
+    def _no_flight():
+        raise AssertionError("Shared cache hit took the lock")
+
+    with monkeypatch.context() as m:
+        m.setattr(cache_module, "get_single_flight", _no_flight)
+        assert entity_list(1) == 1
+    assert calls == [1]
+
+    # another worker computes it while we wait for the lock
+    lock = cache_module.get_lock(cache_module.get_cache(), "test/shared/2", timeout=5)
+    assert lock.acquire()
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(entity_list, 2)
+        time.sleep(0.1)
+        store.put("test/shared/2", 2)
+        lock.release()
+        assert future.result() == 2
+    assert calls == [1]
+
+
+def test_cache_async():
+    store = get_store("memory://")
+    calls = []
+
+    @async_cache(key_func=lambda value: f"test/async/{value}", store=store)
+    async def entity_list(value: int) -> int:
+        calls.append(value)
+        await asyncio.sleep(0.1)
+        return value
+
+    async def _run():
+        # concurrent calls are coalesced
+        return await asyncio.gather(*(entity_list(1) for _ in range(5)))
+
+    assert asyncio.run(_run()) == [1] * 5
+    assert calls == [1]
+    assert "test/async/1" in get_local_cache()
+    assert store.get("test/async/1") == 1
+    # shared cache
+    get_local_cache().clear()
+    assert asyncio.run(entity_list(1)) == 1
+    assert calls == [1]
+
+    @async_cache(key_func=lambda value: None, store=store)
+    async def uncached(value: int) -> float:
+        return time.time()
+
+    assert asyncio.run(uncached(1)) != asyncio.run(uncached(1))
+
+    # errors are propagated to waiting callers
+    async def fail() -> None:
+        await asyncio.sleep(0.1)
+        raise ValueError("fail")
+
+    flight = AsyncSingleFlight(store, timeout=5)
+
+    async def _fail():
+        return await asyncio.gather(
+            *(flight.run("test/fail", fail) for _ in range(3)),
+            return_exceptions=True,
+        )
+
+    assert all(isinstance(r, ValueError) for r in asyncio.run(_fail()))
+    assert flight.coalesced == 2
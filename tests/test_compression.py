@@ -0,0 +1,107 @@
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from ftmq_api import compression
+from ftmq_api.api import app
+from ftmq_api.compression import (
+    BROTLI,
+    GZIP,
+    ZSTD,
+    Compressor,
+    compress,
+    decompress,
+    negotiate,
+)
+from ftmq_api.serialize import CachedResponse
+
+client = TestClient(app)
+
+
+def test_compression_negotiate():
+    assert negotiate(None) is None
+    assert negotiate("identity") is None
+    assert negotiate("gzip") == GZIP
+    assert negotiate("gzip, deflate, br, zstd") == ZSTD  # server preference
+    assert negotiate("gzip, br;q=0.5") == BROTLI
+    assert negotiate("zstd;q=0, br;q=0, gzip") == GZIP
+    assert negotiate("*") == ZSTD
+    assert negotiate("*, zstd;q=0") == BROTLI
+    assert negotiate("GZIP;q=0.1") == GZIP
+    assert negotiate("br, gzip", [ZSTD]) is None
+    with mock.patch.object(compression, "zstandard", None):
+        assert negotiate("zstd, gzip") == GZIP
+
+
+def test_compression_compress():
+    data = b'{"foo": "bar"}' * 100
+    for encoding in (GZIP, BROTLI, ZSTD):
+        compressed = compress(data, encoding)
+        assert len(compressed) < len(data)
+        assert decompress(compressed, encoding) == data
+
+        compressor = Compressor(encoding)
+        chunks = [compressor.compress(data[:700]), compressor.compress(data[700:])]
+        # each chunk is flushed, so it can be decoded on arrival
+        assert all(chunks)
+        compressed = b"".join(chunks) + compressor.finish()
+        assert decompress(compressed, encoding) == data
+
+
+def test_compression_cached_response():
+    data = b'{"foo": "bar"}' * 100
+    cached = CachedResponse(
+        status_code=200,
+        headers={"content-type": "application/json", "vary": "Origin"},
+        encoding=GZIP,
+        body=compress(data, GZIP),
+    )
+    res = cached.to_response("gzip")
+    assert res.headers["content-encoding"] == GZIP
+    assert res.headers.getlist("vary") == ["Origin, Accept-Encoding"]
+    res = cached.to_response(None)
+    assert res.body == data
+    assert "content-encoding" not in res.headers
+    assert res.headers.getlist("vary") == ["Origin, Accept-Encoding"]
+
+
+def test_compression_api():
+    url = "/entities?dataset=gdho&limit=100"
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert not plain.headers["etag"].startswith("W/")
+    for encoding in (GZIP, BROTLI, ZSTD):
+        res = client.get(url, headers={"Accept-Encoding": encoding})
+        assert res.headers["content-encoding"] == encoding
+        assert res.headers["vary"] == "Accept-Encoding"
+        assert res.headers["etag"] == "W/" + plain.headers["etag"]
+        assert int(res.headers["content-length"]) < len(plain.content)
+        assert res.content == plain.content  # decoded by the client
+
+    # small responses are not compressed
+    res = client.get(
+        "/entities?dataset=gdho&limit=1", headers={"Accept-Encoding": GZIP}
+    )
+    assert "content-encoding" not in res.headers
+    assert res.headers["vary"] == "Accept-Encoding"
+    assert not res.headers["etag"].startswith("W/")
+
+    with mock.patch.object(compression.settings.compression, "enabled", False):
+        res = client.get(url, headers={"Accept-Encoding": GZIP})
+        assert "content-encoding" not in res.headers
+
+
+def test_compression_api_stream():
+    url = "/entities?dataset=gdho&limit=100&format=ndjson"
+    plain = client.get(url, headers={"Accept-Encoding": "identity"})
+    with client.stream("GET", url, headers={"Accept-Encoding": ZSTD}) as res:
+        assert res.headers["content-encoding"] == ZSTD
+        assert "content-length" not in res.headers
+        assert b"".join(res.iter_bytes()) == plain.content
+
+    # binary formats are passed through
+    res = client.get(
+        "/entities?dataset=gdho&limit=10&format=arrow",
+        headers={"Accept-Encoding": GZIP},
+    )
+    assert "content-encoding" not in res.headers
@@ -0,0 +1,43 @@
+import asyncio
+import threading
+import time
+
+from ftmq_api.executor import Dispatcher
+
+
+def test_executor():
+    dispatcher = Dispatcher(4, {"heavy": 1})
+    lock = threading.Lock()
+    running = {"heavy": 0, "max": 0}
+
+    def heavy() -> str:
+        with lock:
+            running["heavy"] += 1
+            running["max"] = max(running["max"], running["heavy"])
+        time.sleep(0.05)
+        with lock:
+            running["heavy"] -= 1
+        return threading.current_thread().name
+
+    def cheap(value: int) -> int:
+        return value
+
+    async def main():
+        return await asyncio.gather(
+            *[dispatcher.run("heavy", heavy) for _ in range(3)],
+            dispatcher.run("cheap", cheap, 1),
+        )
+
+    res = asyncio.run(main())
+    assert res[-1] == 1
+    assert res[0].startswith("ftmq-api")
+    # heavy endpoint never ran concurrently
+    assert running["max"] == 1
+
+    stats = dispatcher.stats()
+    assert stats["heavy"].dispatched == 3
+    assert stats["heavy"].limit == 1
+    assert stats["heavy"].queued == stats["heavy"].running == 0
+    assert stats["heavy"].wait_max >= 0.05
+    assert stats["cheap"].limit is None
+    assert dispatcher.queue_depth == 0
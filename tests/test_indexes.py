@@ -0,0 +1,147 @@
+import json
+from collections import Counter
+from unittest import mock
+
+from ftmq_api import indexes
+from ftmq_api.explain import compile_sql, get_plan
+from ftmq_api.indexes import (
+    Shape,
+    create_indexes,
+    ensure_indexes,
+    get_existing,
+    get_indexes,
+    get_query_shapes,
+    get_shapes,
+    to_sql,
+)
+from ftmq_api.query import Query
+
+PAYMENTS = [
+    {
+        "id": f"p-{i}",
+        "schema": "Payment",
+        "properties": {
+            "amount": [str(i * 10)],
+            "date": [f"2024-01-{i + 1:02d}"],
+            "purpose": ["rent" if i % 2 else "tax"],
+        },
+    }
+    for i in range(20)
+]
+
+
+def test_indexes_shapes():
+    assert get_query_shapes("/entities?dataset=gdho") == {Shape("base")}
+    assert get_query_shapes(
+        "/entities?dataset=gdho&schema=Organization&country=fr&order_by=-name"
+    ) == {
+        Shape("base"),
+        Shape("filter", "country", "Organization"),
+        Shape("sort", "name"),
+    }
+    # no specific schema
+    assert get_query_shapes(
+        "/entities/stream?schema=LegalEntity&schema_include_descendants=1"
+        "&name__ilike=foo"
+    ) == {Shape("base"), Shape("filter", "name")}
+    assert get_query_shapes("/search?q=foo") == set()
+    assert get_query_shapes("/entities?foo=bar") == set()  # invalid
+
+    counts = Counter(
+        {
+            "/entities?country=fr&schema=Company": 5,
+            "/entities?country=fr&schema=Company&page=2": 2,
+            "/entities?order_by=amount": 1,
+        }
+    )
+    assert get_shapes(counts) == {
+        Shape("base"): 8,
+        Shape("filter", "country", "Company"): 7,
+        Shape("sort", "amount"): 1,
+    }
+    assert get_shapes(counts, threshold=2) == {
+        Shape("base"): 8,
+        Shape("filter", "country", "Company"): 7,
+    }
+
+
+def test_indexes_create(make_store):
+    store = make_store(PAYMENTS)
+    shapes = [
+        Shape("base"),
+        Shape("filter", "purpose", "Payment"),
+        Shape("sort", "amount"),
+        Shape("sort", "date"),
+    ]
+    base, purpose, amount, date = get_indexes(store, shapes)
+    assert to_sql(base, store) == (
+        "CREATE INDEX IF NOT EXISTS ix_ftmq_api_base "
+        "ON statement (dataset, canonical_id)"
+    )
+    assert to_sql(purpose, store) == (
+        "CREATE INDEX IF NOT EXISTS ix_ftmq_api_filter_purpose_payment "
+        "ON statement (dataset, value, canonical_id) "
+        "WHERE prop = 'purpose' AND schema = 'Payment'"
+    )
+    # precomputed numeric sort key
+    assert to_sql(amount, store) == (
+        "CREATE INDEX IF NOT EXISTS ix_ftmq_api_sort_amount "
+        "ON statement (canonical_id, CAST(value AS NUMERIC)) WHERE prop = 'amount'"
+    )
+    # iso dates sort as they are
+    assert to_sql(date, store) == (
+        "CREATE INDEX IF NOT EXISTS ix_ftmq_api_sort_date "
+        "ON statement (canonical_id, value) WHERE prop = 'date'"
+    )
+
+    assert create_indexes(store, [base, purpose, amount, date]) == [
+        "ix_ftmq_api_base",
+        "ix_ftmq_api_filter_purpose_payment",
+        "ix_ftmq_api_sort_amount",
+        "ix_ftmq_api_sort_date",
+    ]
+    assert create_indexes(store, [base, purpose, amount, date]) == []
+    assert "ix_ftmq_api_sort_amount" in get_existing(store)
+
+    # the query planner uses them
+    view = store.query()
+    query = view.ensure_scoped_query(Query().where(schema="Payment", purpose="tax"))
+    plan = get_plan(store, compile_sql(store, query.sql.count))
+    assert any("ix_ftmq_api_filter_purpose_payment" in s for s in plan)
+    query = view.ensure_scoped_query(
+        Query()[:5].where(schema="Payment", purpose="tax").order_by("amount")
+    )
+    plan = get_plan(store, compile_sql(store, query.sql.statements))
+    assert any("ix_ftmq_api_sort_amount" in s for s in plan)
+    assert [e.id for e in view.entities(query)] == ["p-0", "p-2", "p-4", "p-6", "p-8"]
+    query = view.ensure_scoped_query(Query()[:3].order_by("date", ascending=False))
+    plan = get_plan(store, compile_sql(store, query.sql.statements))
+    assert any("ix_ftmq_api_sort_date" in s for s in plan)
+    assert [e.id for e in view.entities(query)] == ["p-19", "p-18", "p-17"]
+
+
+def test_indexes_ensure(tmp_path, make_store):
+    store = make_store(PAYMENTS)
+    recorded = tmp_path / "requests.jsonl"
+    recorded.write_text(
+        "\n".join(
+            json.dumps(r)
+            for r in [
+                {"url": "/entities?schema=Payment&purpose=tax", "count": 3},
+                {"url": "/entities?order_by=-amount"},
+            ]
+        )
+    )
+    with (
+        mock.patch.object(indexes, "get_store", return_value=store),
+        mock.patch.object(indexes.settings.indexes, "recorded", str(recorded)),
+        mock.patch.object(indexes.settings.indexes, "threshold", 2),
+    ):
+        assert ensure_indexes() == []
+        assert not any(i.startswith("ix_ftmq_api") for i in get_existing(store))
+        with mock.patch.object(indexes.settings.indexes, "create", True):
+            assert len(ensure_indexes()) == 2
+    assert {i for i in get_existing(store) if i.startswith("ix_ftmq_api")} == {
+        "ix_ftmq_api_base",
+        "ix_ftmq_api_filter_purpose_payment",
+    }
@@ -0,0 +1,137 @@
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+from unittest import mock
+
+from anystore.store import get_store
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from ftmq_api import gunicorn_config, metrics
+from ftmq_api.api import app
+from ftmq_api.cache import anycache
+from ftmq_api.metrics import render, timed
+
+client = TestClient(app)
+
+
+def get_value(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_metrics_cache():
+    @anycache(store=get_store(uri="memory://"), key_func=lambda x: x)
+    def cached_view(x: str | None) -> str:
+        return f"result {x}"
+
+    with mock.patch.object(metrics.settings.metrics, "enabled", True):
+        name = "ftmq_api_cache_requests_total"
+        labels = {"view": "cached_view", "cache": "shared"}
+        assert cached_view("a") == "result a"
+        assert cached_view("a") == "result a"
+        assert cached_view("b") == "result b"
+        assert get_value(name, result="miss", **labels) == 2
+        assert get_value(name, result="hit", **labels) == 1
+        # uncached calls are not counted
+        cached_view(None)
+        assert get_value(name, result="miss", **labels) == 2
+
+
+def test_metrics_timed():
+    @timed("test")
+    def func():
+        return 1
+
+    @timed("test_iter")
+    def iterate():
+        yield from range(3)
+
+    name = "ftmq_api_store_duration_seconds_count"
+    func()
+    assert get_value(name, operation="test") == 0  # disabled
+    with mock.patch.object(metrics.settings.metrics, "enabled", True):
+        assert func() == 1
+        assert get_value(name, operation="test") == 1
+        assert list(iterate()) == [0, 1, 2]
+        assert get_value(name, operation="test_iter") == 1
+        # observed when closed early as well
+        items = iterate()
+        next(items)
+        items.close()
+        assert get_value(name, operation="test_iter") == 2
+
+
+def test_metrics_api():
+    res = client.get("/metrics")
+    assert res.status_code == 404
+
+    with mock.patch.object(metrics.settings.metrics, "enabled", True):
+        name = "ftmq_api_request_duration_seconds_count"
+        labels = {"route": "/entities/{entity_id}", "method": "GET"}
+        before = get_value(name, status="404", **labels)
+        client.get("/entities/not-existing")
+        assert get_value(name, status="404", **labels) == before + 1
+        client.get("/entities?dataset=gdho&limit=5")
+
+        res = client.get("/metrics")
+        assert res.status_code == 200
+        assert res.headers["content-type"].startswith("text/plain")
+        assert (
+            'ftmq_api_request_duration_seconds_bucket{le="0.005",method="GET",'
+            'route="/entities/{entity_id}",status="404"}'
+        ) in res.text
+        assert 'ftmq_api_response_size_bytes_count{route="/entities"}' in res.text
+        assert 'ftmq_api_store_duration_seconds_count{operation="entities"}' in (
+            res.text
+        )
+        assert 'ftmq_api_executor_queue_depth{endpoint="entities"} 0.0' in res.text
+        assert 'ftmq_api_executor_wait_seconds_count{endpoint="entities"}' in res.text
+        # the metrics endpoint itself is not observed
+        assert 'route="/metrics"' not in res.text
+
+    with mock.patch.object(metrics, "prometheus_client", None):
+        with mock.patch.object(metrics.settings.metrics, "enabled", True):
+            res = client.get("/metrics")
+            assert res.status_code == 501
+
+
+def test_metrics_multiprocess(tmp_path):
+    # each process writes its metrics, the scrape aggregates them
+    env = {
+        **os.environ,
+        "PROMETHEUS_MULTIPROC_DIR": str(tmp_path),
+        "FTMQ_API_METRICS_ENABLED": "1",
+    }
+    script = (
+        "from ftmq_api import metrics;"
+        "metrics.observe_request('/entities', 'GET', 200, 0.1, 1000);"
+        "metrics.set_queue_depth('entities', 2);"
+        "import os; print(os.getpid())"
+    )
+    pids = [
+        int(
+            subprocess.run(
+                [sys.executable, "-c", script], env=env, check=True, capture_output=True
+            ).stdout
+        )
+        for _ in range(2)
+    ]
+    with (
+        mock.patch.dict(os.environ, {"PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}),
+        mock.patch.object(metrics.settings.metrics, "enabled", True),
+    ):
+        data, _ = render()
+        assert (
+            b'ftmq_api_request_duration_seconds_count{method="GET",route="/entities",'
+            b'status="200"} 2.0'
+        ) in data
+        assert b'ftmq_api_response_size_bytes_sum{route="/entities"} 2000.0' in data
+        assert b'ftmq_api_executor_queue_depth{endpoint="entities"} 4.0' in data
+
+        # exited workers don't count for the queue depth
+        for pid in pids:
+            gunicorn_config.child_exit(None, SimpleNamespace(pid=pid))
+        data, _ = render()
+        assert b"ftmq_api_executor_queue_depth{" not in data
+        assert b'ftmq_api_response_size_bytes_sum{route="/entities"} 2000.0' in data
@@ -0,0 +1,79 @@
+import json
+import pstats
+from unittest import mock
+
+from fastapi.testclient import TestClient
+
+from ftmq_api import profile
+from ftmq_api.api import app
+
+client = TestClient(app)
+
+URL = "/entities?dataset=gdho&limit=5&api_key=secret-key-for-build"
+
+
+def get_frames(data: dict) -> set[str]:
+    return {f["name"] for f in data["shared"]["frames"]}
+
+
+def test_profile_speedscope():
+    res = client.get(f"{URL}&profile=1")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/json"
+    assert res.headers["content-disposition"].endswith('.speedscope.json"')
+    data = res.json()
+    assert data["$schema"] == profile.SPEEDSCOPE_SCHEMA
+    events = data["profiles"][0]["events"]
+    assert len([e for e in events if e["type"] == "O"]) == len(
+        [e for e in events if e["type"] == "C"]
+    )
+    assert [e["at"] for e in events] == sorted(e["at"] for e in events)
+    # executor endpoint, view function and store work
+    assert {"entities", "entity_list", "View.get_entities"} <= get_frames(data)
+
+    # streams are profiled chunk by chunk
+    res = client.get(f"{URL}&format=ndjson&profile=speedscope")
+    assert "stream" in get_frames(res.json())
+
+
+def test_profile_pstats(tmp_path):
+    res = client.get(f"{URL}&profile=pstats")
+    assert res.status_code == 200
+    assert res.headers["content-type"] == "application/octet-stream"
+    path = tmp_path / "profile.prof"
+    path.write_bytes(res.content)
+    stats = pstats.Stats(str(path))
+    assert any(func == "entity_list" for _, _, func in stats.stats)
+
+
+def test_profile_store(tmp_path):
+    with mock.patch.object(profile.settings.profile, "uri", str(tmp_path)):
+        res = client.get(f"{URL}&profile=1")
+        assert res.status_code == 200
+        assert len(res.json()["entities"]) == 5  # the actual response
+        link = res.headers["x-profile"]
+        assert link.startswith(f"file://{tmp_path}/")
+        assert link.endswith(".speedscope.json")
+        stored = next(tmp_path.glob("*.speedscope.json"))
+        assert "entity_list" in get_frames(json.loads(stored.read_text()))
+
+        with mock.patch.object(profile.settings.profile, "url", "https://x.org/p"):
+            res = client.get(f"{URL}&profile=pstats")
+            assert res.headers["x-profile"].startswith("https://x.org/p/")
+            assert len(list(tmp_path.glob("*.prof"))) == 1
+
+
+def test_profile_params():
+    res = client.get(f"{URL.split('&api_key')[0]}&profile=1")
+    assert res.status_code == 403
+    res = client.get(f"{URL}&profile=foo")
+    assert res.status_code == 400
+    # not treated as property filter
+    res = client.get(f"{URL}&profile=0")
+    assert res.status_code == 200
+    assert len(res.json()["entities"]) == 5
+
+    # one profiled request at a time
+    with profile._lock:
+        res = client.get(f"{URL}&profile=1")
+        assert res.status_code == 429
@@ -1,7 +1,16 @@
 import pytest
+from fastapi import Request
 from pydantic import ValidationError
 
-from ftmq_api.query import Query, ViewQueryParams
+from ftmq_api.query import (
+    Cursor,
+    Query,
+    RetrieveParams,
+    ViewQueryParams,
+    get_query_fingerprint,
+)
+from ftmq_api.store import View
+from ftmq_api.views import get_next_cursor
 
 
 def test_query():
@@ -61,3 +70,102 @@ def test_query():
     # invalid schema lookups
     with pytest.raises(ValidationError):
         ViewQueryParams(schema="foo")
+
+
+def test_query_cursor():
+    cursor = Cursor(id="eu-authorities-cdt", value="Translation Centre")
+    assert Cursor.decode(cursor.encode()) == cursor
+    with pytest.raises(ValueError):
+        Cursor.decode("foo")
+
+    params = ViewQueryParams(limit=10, page=3, cursor=cursor.encode())
+    q = Query.from_params(params)
+    assert q.to_dict() == {"limit": 10, "offset": 0, "cursor": cursor.encode()}
+    assert q.cursor == cursor
+    # cursor is not a property lookup
+    assert "cursor" not in params.to_where_lookup_dict()
+
+
+def test_query_filter_key():
+    params = ViewQueryParams(dataset=["gdho", "eu_authorities"], schema="Event")
+    key = Query.from_params(params).filter_key
+    params = ViewQueryParams(
+        dataset=["eu_authorities", "gdho"],
+        schema="Event",
+        page=3,
+        limit=10,
+        order_by="-date",
+    )
+    assert Query.from_params(params).filter_key == key
+    params = ViewQueryParams(dataset=["gdho"], schema="Event")
+    assert Query.from_params(params).filter_key != key
+
+
+def _request(path: str, query: str) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "scheme": "http",
+            "server": ("testserver", 80),
+            "path": path,
+            "query_string": query.encode(),
+            "headers": [],
+        }
+    )
+
+
+def test_query_fingerprint():
+    def fp(query: str, path: str = "/entities", **kwargs) -> str:
+        return get_query_fingerprint(_request(path, query), **kwargs)
+
+    base = fp("dataset=gdho&schema=Organization")
+    assert base == fp("schema=Organization&dataset=gdho")
+    assert base == fp("dataset=gdho&schema=Organization&limit=100&page=1")
+    assert base == fp("dataset=gdho&schema=Organization&api_key=foo")
+    assert base == fp("dataset=gdho&schema=Organization&nested=false&format=json")
+    # public limit is capped
+    assert base == fp("dataset=gdho&schema=Organization&limit=1000")
+    assert base != fp("dataset=gdho&schema=Organization&limit=1000", authenticated=True)
+    assert base != fp("dataset=gdho&schema=Organization&nested=true")
+    assert base != fp("dataset=gdho&schema=Organization&page=2")
+    assert base != fp("dataset=gdho&schema=Organization&cursor=abc")
+    assert base != fp("dataset=gdho&schema=Organization&country=de")
+
+    # list params
+    assert fp("dataset=gdho&dataset=eu_authorities") == fp(
+        "dataset=eu_authorities&dataset=gdho&dataset=gdho"
+    )
+    assert fp("q=foo&country=de&country=fr", "/search") == fp(
+        "country=fr&q=foo&country=de", "/search"
+    )
+    # non-list params: last value wins
+    assert fp("country=de&country=fr") == fp("country=fr")
+    # batch ids
+    batch = fp("id=a&id=b", "/entities/batch")
+    assert batch == fp("id=a&id=b&id=a", "/entities/batch")
+    assert batch != fp("id=b", "/entities/batch")
+    # the response follows the requested order
+    assert batch != fp("id=b&id=a", "/entities/batch")
+
+    with pytest.raises(ValidationError):
+        fp("dataset=unknown")
+
+
+def test_query_cursor_sort_value(make_store):
+    # sql casts "1,000" to 1 (sqlite), the cursor has to use the same value
+    amounts = ["0.5", "1,000", "5", "20"]
+    store = make_store(
+        {"id": f"pay-{i}", "schema": "Payment", "properties": {"amount": [a]}}
+        for i, a in enumerate(amounts)
+    )
+    view = View(store=store)
+    query = Query().where(dataset="test").order_by("amount")[:2]
+    params = RetrieveParams()
+    ids = []
+    while query is not None:
+        entities = list(view.get_entities(query, params))
+        ids.extend(e.id for e in entities)
+        cursor = get_next_cursor(view, entities, query)
+        query = query.after(cursor) if cursor is not None else None
+    assert ids == ["pay-0", "pay-1", "pay-2", "pay-3"]
@@ -0,0 +1,70 @@
+from unittest import mock
+
+from nomenklatura.judgement import Judgement
+from nomenklatura.resolver.identifier import Identifier
+from sqlalchemy import MetaData, create_engine
+
+from ftmq_api import resolver as resolver_module
+from ftmq_api import versions
+from ftmq_api.resolver import MemoryResolver, get_resolver
+from ftmq_api.store import get_store
+
+
+def test_resolver(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/resolver.db")
+    resolver = MemoryResolver(engine, MetaData(), create=True)
+    resolver.load_index()
+    assert resolver.get_canonical("a") == "a"
+    assert resolver.get_referents("a") == set()
+
+    resolver.begin()
+    canonical = resolver.decide("a", "b", Judgement.POSITIVE).id
+    canonical = resolver.decide(canonical, "c", Judgement.POSITIVE).id
+    resolver.decide("a", "d", Judgement.NEGATIVE)
+    resolver.commit()
+    # not reloaded yet
+    assert resolver.get_canonical("a") == "a"
+
+    resolver.load_index()
+    assert canonical.startswith("NK-")
+    for i in ("a", "b", "c", canonical):
+        assert resolver.get_canonical(i) == canonical
+    assert resolver.get_canonical("d") == "d"
+    assert resolver.get_referents(canonical) == {"a", "b", "c"}
+    assert resolver.get_referents("a") == {"b", "c", canonical}
+    assert resolver.get_referents("a", canonicals=False) == {"b", "c"}
+    assert {i.id for i in resolver.connected(Identifier.get("b"))} == {
+        "a",
+        "b",
+        "c",
+        canonical,
+    }
+
+
+def test_resolver_store():
+    resolver = get_resolver()
+    assert get_store().linker is resolver
+    assert get_store("gdho").linker is resolver
+
+    # reload if the resolver version changes
+    data_versions = versions.DataVersions()
+    data_versions.load()
+    with mock.patch.object(resolver, "load_index") as load:
+        data_versions.load()
+        assert not load.called
+        data_versions.resolver = "changed"
+        data_versions.load()
+        assert load.called
+
+
+def test_resolver_readonly(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/resolver.db")
+    with (
+        mock.patch.object(resolver_module, "get_engine", return_value=engine),
+        mock.patch.object(resolver_module, "MemoryResolver") as cls,
+    ):
+        get_resolver.__wrapped__()
+        assert cls.call_args.kwargs["create"] is True
+        with mock.patch.object(resolver_module.settings.sqlite, "readonly", True):
+            get_resolver.__wrapped__()
+            assert cls.call_args.kwargs["create"] is False
@@ -0,0 +1,56 @@
+from fastapi import Request
+from ftmq.util import make_proxy
+
+from ftmq_api.serialize import EntitiesResponse, EntityResponse
+from ftmq_api.warmup import make_scope
+
+
+def make_memberships(n: int) -> tuple[list, list]:
+    org = make_proxy(
+        {"id": "org", "schema": "Organization", "properties": {"name": ["Org"]}},
+        "test",
+    )
+    persons, memberships = [], []
+    for i in range(n):
+        persons.append(
+            make_proxy(
+                {
+                    "id": f"p-{i}",
+                    "schema": "Person",
+                    "properties": {"name": [f"P {i}"]},
+                },
+                "test",
+            )
+        )
+        memberships.append(
+            make_proxy(
+                {
+                    "id": f"m-{i}",
+                    "schema": "Membership",
+                    "properties": {"member": [f"p-{i}"], "organization": ["org"]},
+                },
+                "test",
+            )
+        )
+    return memberships, [org, *persons]
+
+
+def test_serialize_nested():
+    memberships, adjacents = make_memberships(10)
+    request = Request(make_scope("/entities?nested=true"))
+    res = EntitiesResponse.from_view(
+        request=request, entities=memberships, adjacents=[adjacents]
+    )
+    assert res.items == 10
+    first, second = res.entities[:2]
+    assert first.properties["member"][0].id == "p-0"
+    assert second.properties["member"][0].id == "p-1"
+    # nested entities are built once per response
+    org = first.properties["organization"][0]
+    assert org.caption == "Org"
+    assert second.properties["organization"][0] is org
+
+    # single entity, not indexed
+    entity = EntityResponse.from_entity(memberships[0], adjacents)
+    assert entity.properties["organization"][0].id == "org"
+    assert entity.model_dump(by_alias=True) == first.model_dump(by_alias=True)
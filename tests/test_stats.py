@@ -0,0 +1,90 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from unittest import mock
+
+from ftmq_api import stats as stats_module
+from ftmq_api.stats import Stats, get_stats_uri, read_snapshot, write_snapshot
+from ftmq_api.store import get_catalog, get_view
+from ftmq_api.versions import DataVersions
+
+
+def test_stats(tmp_path):
+    uri = str(tmp_path / "stats.json")
+    stats = Stats(uri)
+    assert read_snapshot(uri) is None
+    eu = stats.get("eu_authorities")
+    assert eu.entity_count == 151
+    assert eu.model_dump() == get_view("eu_authorities").stats().model_dump()
+
+    snapshot = read_snapshot(uri)
+    assert set(snapshot.datasets) == set(get_catalog().names)
+    assert snapshot.datasets["eu_authorities"] == eu
+
+    # loaded from persisted snapshot
+    stats = Stats(uri)
+    stats.init()
+    assert stats.snapshot.created_at == snapshot.created_at
+
+    # datasets that are not in the snapshot (e.g. added to the catalog later)
+    # are computed, but not added to it
+    stats.snapshot = snapshot.model_copy(deep=True)
+    del stats.snapshot.datasets["gdho"]
+    gdho = stats.get("gdho")
+    assert gdho.model_dump() == get_view("gdho").stats().model_dump()
+    assert stats.fallbacks == {"gdho": gdho}
+    assert "gdho" not in stats.snapshot.datasets
+
+    # stale snapshot is recomputed
+    stats = Stats(uri, refresh=60)
+    assert not stats.is_stale(snapshot)
+    snapshot.created_at = datetime.now() - timedelta(seconds=120)
+    assert stats.is_stale(snapshot)
+
+    # data has changed
+    snapshot.created_at = datetime.now()
+    assert not stats.is_stale(snapshot)
+    snapshot.versions["eu_authorities"] = "changed"
+    assert stats.is_stale(snapshot)
+
+
+def test_stats_workers(tmp_path):
+    uri = str(tmp_path / "stats.json")
+    compute = stats_module.compute_snapshot
+    calls = []
+
+    def _compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return compute()
+
+    # only the first worker computes the snapshot, the others read it
+    with mock.patch.object(stats_module, "compute_snapshot", _compute):
+        with ThreadPoolExecutor(3) as pool:
+            futures = [pool.submit(Stats(uri).load) for _ in range(3)]
+            snapshots = [f.result() for f in futures]
+    assert len(calls) == 1
+    assert len({s.created_at for s in snapshots}) == 1
+
+    # not written next to the store
+    assert get_stats_uri().startswith(stats_module.tempfile.gettempdir())
+    with mock.patch.object(stats_module.settings, "stats_uri", uri):
+        assert get_stats_uri() == uri
+
+
+def test_stats_versions(tmp_path):
+    # at boot, the data versions are not loaded yet
+    uri = str(tmp_path / "stats.json")
+    versions = DataVersions()
+    with mock.patch.object(stats_module, "get_versions", return_value=versions):
+        snapshot = Stats(uri).load()
+    assert snapshot.versions
+    assert snapshot.versions == versions.datasets
+
+    # a persisted snapshot of other data is re-computed
+    snapshot.datasets["eu_authorities"].entity_count = 12345
+    snapshot.versions["eu_authorities"] = "changed"
+    write_snapshot(snapshot, uri)
+    with mock.patch.object(stats_module, "get_versions", return_value=DataVersions()):
+        stats = Stats(uri)
+        assert stats.get("eu_authorities").entity_count == 151
@@ -0,0 +1,78 @@
+from unittest import mock
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from ftmq_api import store as store_module
+from ftmq_api.serialize import EntityResponse
+from ftmq_api.store import View, get_readonly_store, is_readonly_sqlite
+
+
+def test_store_nested(memberships_store):
+    view = View(store=memberships_store)
+    persons = view.get_entities_by_id(["p-0"])
+    assert [e.id for e in persons] == ["p-0"]
+
+    queries = []
+
+    def _count(conn, cursor, statement, *args) -> None:
+        queries.append(statement)
+
+    event.listen(view.store.engine, "before_cursor_execute", _count)
+    levels = view.get_nested(persons, depth=3, inverted=True)
+    event.remove(view.store.engine, "before_cursor_execute", _count)
+    # per level max one query for the referenced and one for the
+    # referencing entities (persons and organizations don't reference any)
+    assert len(queries) == 4
+    # person -> membership -> organization -> other memberships
+    assert [[e.id for e in level] for level in levels] == [
+        ["m-0"],
+        ["o-0"],
+        ["m-2", "m-4"],
+    ]
+    entity = EntityResponse.from_levels(persons, levels, inverted=True)[0]
+    membership = entity.properties["membershipMember"][0]
+    assert membership.id == "m-0"
+    assert membership.properties["member"] == ["p-0"]  # visited
+    org = membership.properties["organization"][0]
+    assert org.caption == "Org 0"
+    assert [m.id for m in org.properties["membershipOrganization"]] == ["m-2", "m-4"]
+
+    # forward only, dedup across entities
+    memberships = view.get_entities_by_id([f"m-{i}" for i in range(5)])
+    levels = view.get_nested(memberships, depth=2)
+    assert len(levels) == 1
+    assert {e.id for e in levels[0]} == {"o-0", "o-1", *[f"p-{i}" for i in range(5)]}
+
+    # fan-out limit per level
+    levels = view.get_nested(memberships, limit=3)
+    assert len(levels[0]) == 3
+    levels = view.get_nested(persons, depth=3, inverted=True, limit=1)
+    assert [len(level) for level in levels] == [1, 1, 1]
+
+    # depth is capped
+    with mock.patch("ftmq_api.store.settings.nested_max_depth", 1):
+        assert len(view.get_nested(persons, depth=3, inverted=True)) == 1
+
+
+def test_store_readonly(tmp_path, memberships_store):
+    uri = f"sqlite:///{tmp_path}/store.db"
+    assert not is_readonly_sqlite(uri)
+    with mock.patch.object(store_module.settings.sqlite, "readonly", True):
+        assert is_readonly_sqlite(uri)
+        assert not is_readonly_sqlite("postgresql://localhost/ftm")
+        with pytest.raises(ValueError):
+            get_readonly_store("sqlite://")
+
+    with mock.patch.object(store_module.settings.sqlite, "immutable", True):
+        store = get_readonly_store(uri, dataset="test")
+    assert store.engine.pool.size() == store_module.settings.executor.workers
+    view = View(store=store)
+    assert [e.id for e in view.get_entities_by_id(["p-0", "o-1"])] == ["o-1", "p-0"]
+    with store.engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA query_only").scalar() == 1
+        assert conn.exec_driver_sql("PRAGMA temp_store").scalar() == 2  # memory
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -65536
+        with pytest.raises(OperationalError):
+            conn.exec_driver_sql("DELETE FROM statement")
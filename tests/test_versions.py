@@ -0,0 +1,63 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from ftmq_api import versions as versions_module
+from ftmq_api import views
+from ftmq_api.query import Query, ViewQueryParams
+from ftmq_api.store import get_view
+from ftmq_api.versions import DataVersions, get_versions
+
+
+def test_versions():
+    versions = DataVersions()
+    assert versions.loaded_at is None
+    gdho = versions.get(["gdho"])
+    assert versions.loaded_at is not None
+    assert set(versions.datasets) == {"eu_authorities", "gdho"}
+    assert gdho == versions.get(["gdho"])
+    assert gdho != versions.get(["eu_authorities"])
+    assert versions.get() == versions.get(["gdho", "eu_authorities"])
+    assert versions.get(["unknown"])
+
+    # new data invalidates only the affected datasets' cache keys
+    view = get_view()
+    gdho = Query.from_params(ViewQueryParams(dataset=["gdho"]))
+    eu = Query.from_params(ViewQueryParams(dataset=["eu_authorities"]))
+    gdho_key = views.get_count_cache_key(view, gdho)
+    eu_key = views.get_count_cache_key(view, eu)
+    versions = get_versions()
+    version = versions.datasets["gdho"]
+    try:
+        versions.datasets["gdho"] = "changed"
+        assert views.get_count_cache_key(view, gdho) != gdho_key
+        assert views.get_count_cache_key(view, eu) == eu_key
+    finally:
+        versions.datasets["gdho"] = version
+
+
+def test_versions_refresh():
+    compute = versions_module.compute_versions
+    calls = []
+
+    def _compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return compute()
+
+    versions = DataVersions(refresh=1)
+    versions.refresh = 0.2
+    with mock.patch.object(versions_module, "compute_versions", _compute):
+        # concurrent first requests compute the versions only once
+        with ThreadPoolExecutor(5) as pool:
+            tokens = list(pool.map(lambda _: versions.get(), range(5)))
+        assert len(calls) == 1
+        assert len(set(tokens)) == 1
+
+        # refreshed in the background, not within requests
+        versions.get()
+        assert len(calls) == 1
+        time.sleep(0.5)
+        assert len(calls) > 1
+        assert versions.get() == tokens[0]
+    versions.refresh = 3600  # let the refresh thread sleep
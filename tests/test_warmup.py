@@ -0,0 +1,48 @@
+import asyncio
+import json
+
+from fastapi import Request
+
+from ftmq_api import views
+from ftmq_api.api import app
+from ftmq_api.warmup import get_catalog_urls, get_recorded_urls, make_scope, warmup
+
+
+def test_warmup(tmp_path):
+    urls = get_catalog_urls()
+    assert urls[0] == "/catalog"
+    assert "/catalog/gdho" in urls
+    assert "/entities?dataset=gdho" in urls
+    assert "/entities?dataset=gdho&schema=Organization" in urls
+
+    recorded = tmp_path / "requests.jsonl"
+    recorded.write_text(
+        "\n".join(
+            json.dumps(r)
+            for r in [
+                {"url": "/entities?dataset=gdho&page=2"},
+                {"url": "http://example.org/entities?dataset=gdho&page=2"},
+                {"path": "/entities", "query": "dataset=gdho&page=3", "count": 3},
+                {"url": "/search?q=ministry"},
+            ]
+        )
+    )
+    assert get_recorded_urls(str(recorded), 2) == [
+        "/entities?dataset=gdho&page=3",
+        "/entities?dataset=gdho&page=2",
+    ]
+
+    urls = [
+        "/catalog",
+        "/catalog/gdho",
+        "/entities?dataset=gdho&page=3",
+        "/catalog/foo",
+    ]
+    statuses = asyncio.run(warmup(urls, "http://api.example.org", app=app))
+    assert statuses == {200: 3, 422: 1}
+
+    # cache is populated for the public host
+    request = Request(
+        make_scope("/entities?dataset=gdho&page=3", "http://api.example.org")
+    )
+    assert views.get_cache().exists(views.get_cache_key(request))